@@ -744,6 +744,8 @@ public class Scratch extends Actor implements Comparable<Scratch>
         // since it must wake up to check if greenfoot has been reset, this
         // will tell the thread if it has timed out or been notified
         protected boolean isReady;
+        // number of batchedYield() calls since this sequence last yielded in one.
+        private int batchedYields;
         
         private Object objToCall;
         private String methodToCall;
@@ -981,23 +983,23 @@ public class Scratch extends Actor implements Comparable<Scratch>
     private ArrayList<StageClickedSeq> stageClickedSeqs = new ArrayList<StageClickedSeq>();
 
     public class MesgRecvdSeq extends Sequence {
-        private String mesg;
+        private int mesgId;     // see ScratchWorld.getMessageId()
 
-        public String getMesg() { return mesg; }
+        public int getMesgId() { return mesgId; }
 
-        public MesgRecvdSeq(String mesg, Object obj, String method) {
+        public MesgRecvdSeq(int mesgId, Object obj, String method) {
             super(obj, method);
-            this.mesg = mesg;
+            this.mesgId = mesgId;
             // A message received sequence is not triggered until the message is received.
             this.triggered = false;
         }
 
         public MesgRecvdSeq(MesgRecvdSeq other) {
-            this(other.mesg, other.getObj(), other.getMethod());
+            this(other.mesgId, other.getObj(), other.getMethod());
         }
 
         public boolean isTriggered() {
-            if (getWorld().bcastPending(mesg)) {
+            if (getWorld().bcastPending(mesgId)) {
                 if (! triggered) {
                     // System.out.println("mesgRecvdSeq: for mesg " + mesg +
                     //     " changing from NOT triggered to triggered.");
@@ -1090,6 +1092,57 @@ public class Scratch extends Actor implements Comparable<Scratch>
     }
     private ArrayList<SwitchToBackdropSeq> switchToBackdropSeqs = new ArrayList<SwitchToBackdropSeq>();
 
+    /**
+     * A script compiled to a state machine (s2g.py --stepped_scripts).  It has
+     * no thread of its own: act() calls step() on the Greenfoot thread, which
+     * runs the script from where it stopped last time, recorded in stepPc,
+     * up to where it next yields, returning true, or to its end, returning false.
+     */
+    public abstract class SteppedScript
+    {
+        protected int stepPc = 0;               // where step() carries on from.
+        protected long stepWaitEnd;             // when the wait the script is in ends.
+        private int stepBatchedYields = 0;
+        private long stepDeferredWait = -1;
+        private boolean stepStopped = false;    // set to stop the script.
+        private boolean stepTriggered = false;  // for clone scripts: true once the clone starts.
+        private String stepMethod;              // the method that made this script.
+
+        public abstract boolean step();
+
+        /**
+         * return true, to yield, on every n-th call only.  See batchedYield().
+         */
+        protected boolean stepBatchedYield(int n)
+        {
+            stepBatchedYields++;
+            if (stepBatchedYields >= n) {
+                stepBatchedYields = 0;
+                return true;
+            }
+            return false;
+        }
+
+        /**
+         * return true, to yield, only every half second.  See deferredYield().
+         */
+        protected boolean stepDeferredYield()
+        {
+            if (stepDeferredWait == -1) {
+                stepDeferredWait = System.currentTimeMillis() + 500;
+            } else if (stepDeferredWait < System.currentTimeMillis()) {
+                stepDeferredWait = -1;
+                return true;
+            }
+            return false;
+        }
+    }
+    // The "when flag clicked" and "when I start as a clone" scripts compiled to state machines.
+    private ArrayList<SteppedScript> steppedScripts = new ArrayList<SteppedScript>();
+    private ArrayList<SteppedScript> cloneStartSteppedScripts = new ArrayList<SteppedScript>();
+    // The one step() is running for, if any.
+    private SteppedScript currentSteppedScript = null;
+
     /* -------------------  Variables ------------------------ */
 
     private class Variable extends Scratch implements nonInteractive
@@ -1730,7 +1783,7 @@ public class Scratch extends Actor implements Comparable<Scratch>
         }
         
         for (MesgRecvdSeq m: other.mesgRecvdSeqs) {
-            whenRecvMessage(m.mesg, m.getMethod());
+            whenRecvMessage(m.mesgId, m.getMethod());
         }
 
         /* Copy the CloneStart sequences from the previous sprite, but for this one.
@@ -1738,6 +1791,9 @@ public class Scratch extends Actor implements Comparable<Scratch>
         for (CloneStartSeq css : other.cloneStartSeqs) {
             whenIStartAsAClone(css.getMethod());
         }
+        for (SteppedScript script : other.cloneStartSteppedScripts) {
+            whenIStartAsACloneStepped(script.stepMethod);
+        }
 
         // Initialize everything for this new Actor in Greenfoot.
         super.setLocation(x, y);
@@ -1945,6 +2001,28 @@ public class Scratch extends Actor implements Comparable<Scratch>
                 seq.performSequence();
             } 
         }
+
+        /* ---------- Step the scripts compiled to state machines, on this thread. ------------- */
+
+        for (ListIterator<SteppedScript> iter = steppedScripts.listIterator(); iter.hasNext(); ) {
+            if (! stepScript(iter.next())) {
+                iter.remove();
+            }
+        }
+
+        for (ListIterator<SteppedScript> iter = cloneStartSteppedScripts.listIterator(); iter.hasNext(); ) {
+            SteppedScript script = iter.next();
+            if (! script.stepTriggered) {
+                if (getWorld() == null || ! getWorld().clonePending(this)) {
+                    continue;
+                }
+                script.stepTriggered = true;
+            }
+            if (! stepScript(script)) {
+                // Start over, waiting for a clone to be started again.
+                iter.set(makeSteppedScript(script.stepMethod));
+            }
+        }
         
         if (sayActor != null) {
             sayActorUpdateLocation();
@@ -1966,6 +2044,56 @@ public class Scratch extends Actor implements Comparable<Scratch>
         s.start();   // call run() on the sequence's thread.
     }
 
+    /**
+     * register a method that makes a "when flag clicked" script compiled to a
+     * state machine, which act() then steps until it ends.
+     */
+    public void whenFlagClickedStepped(String methodName)
+    {
+        steppedScripts.add(makeSteppedScript(methodName));
+    }
+
+    /**
+     * register a method that makes a "when I start as a clone" script compiled to
+     * a state machine, which act() steps once this clone starts.
+     */
+    public void whenIStartAsACloneStepped(String methodName)
+    {
+        cloneStartSteppedScripts.add(makeSteppedScript(methodName));
+    }
+
+    /**
+     * call the method of this actor with the given name to make a SteppedScript.
+     */
+    private SteppedScript makeSteppedScript(String methodName)
+    {
+        try {
+            SteppedScript script = (SteppedScript) getClass().getMethod(methodName).invoke(this);
+            script.stepMethod = methodName;
+            return script;
+        } catch (ReflectiveOperationException e) {
+            throw new RuntimeException("Cannot make stepped script " + methodName, e);
+        }
+    }
+
+    /**
+     * run script up to where it next yields.  return false if it has ended.
+     */
+    private boolean stepScript(SteppedScript script)
+    {
+        if (script.stepStopped) {
+            return false;
+        }
+        currentSteppedScript = script;
+        try {
+            return script.step();
+        } catch (StopScriptException e) {
+            return false;
+        } finally {
+            currentSteppedScript = null;
+        }
+    }
+
     /**
      * register a method to be called each time a key press is noticed.
      * There will be a 30 second window where holding a key will be ignored
@@ -2028,7 +2156,16 @@ public class Scratch extends Actor implements Comparable<Scratch>
      */
     public void whenRecvMessage(String messageName, String methodName)
     {
-        MesgRecvdSeq m = new MesgRecvdSeq(messageName, this, methodName);
+        whenRecvMessage(ScratchWorld.getMessageId(messageName), methodName);
+    }
+
+    /**
+     * register a method to be called when the message with the given id is
+     * broadcast.  See ScratchWorld.getMessageId().
+     */
+    public void whenRecvMessage(int messageId, String methodName)
+    {
+        MesgRecvdSeq m = new MesgRecvdSeq(messageId, this, methodName);
         mesgRecvdSeqs.add(m);
         m.start();
     }
@@ -2051,7 +2188,15 @@ public class Scratch extends Actor implements Comparable<Scratch>
      */
     public void broadcast(String message)
     {
-        getWorld().registerBcast(message);
+        broadcast(ScratchWorld.getMessageId(message));
+    }
+
+    /**
+     * broadcast the message with the given id to all sprites.
+     */
+    public void broadcast(int messageId)
+    {
+        getWorld().registerBcast(messageId);
     }
 
 
@@ -2060,13 +2205,22 @@ public class Scratch extends Actor implements Comparable<Scratch>
      * waiting for that message complete.  Then, continue.
      */
     public void broadcastAndWait(Sequence s, String message)
+    {
+        broadcastAndWait(s, ScratchWorld.getMessageId(message));
+    }
+
+    /**
+     * broadcast the message with the given id and wait until the scripts
+     * waiting for it complete.
+     */
+    public void broadcastAndWait(Sequence s, int messageId)
     {
         /* Make a copy of all sequences from all Scratch Actors that are
          * waiting for this message. */
-        ArrayList<MesgRecvdSeq> mesgScriptSeqs = getWorld().getAllMessageScripts(message);
+        ArrayList<MesgRecvdSeq> mesgScriptSeqs = getWorld().getAllMessageScripts(messageId);
 
         /* Send the broadcast */
-        getWorld().registerBcast(message);
+        getWorld().registerBcast(messageId);
 
         while (true) {
             int countActive = 0;
@@ -2171,7 +2325,10 @@ public class Scratch extends Actor implements Comparable<Scratch>
     {
         if (isClone) {        
             getWorld().removeObject(this);
-            Thread.currentThread().interrupt();
+            // A stepped script runs on the Greenfoot thread, and ends itself instead.
+            if (Thread.currentThread() instanceof Sequence) {
+                Thread.currentThread().interrupt();
+            }
         }
     }
 
@@ -2250,6 +2407,16 @@ public class Scratch extends Actor implements Comparable<Scratch>
                 s.interrupt();
             }
         }
+        for (SteppedScript script : steppedScripts) {
+            if (script != currentSteppedScript) {
+                script.stepStopped = true;
+            }
+        }
+        for (SteppedScript script : cloneStartSteppedScripts) {
+            if (script != currentSteppedScript && script.stepTriggered) {
+                script.stepStopped = true;
+            }
+        }
     }
 
     /*
@@ -2475,6 +2642,14 @@ public class Scratch extends Actor implements Comparable<Scratch>
         glideTo(s, duration, other.getX(), other.getY());
     }
 
+    /**
+     * glide the sprite to the location of another sprite
+     */
+    public void glideToSprite(Sequence s, Scratch other, Number duration)
+    {
+        glideTo(s, duration, other.getX(), other.getY());
+    }
+
     /**
      * move the sprite to the location on the screen, where (0, 0) is the center and x increases
      * to the right and y increases up.
@@ -4370,6 +4545,20 @@ public class Scratch extends Actor implements Comparable<Scratch>
         }
     }
     
+    /**
+     * offer the CPU to other Sequences, but only on every n-th call.
+     * The converter ends loops with this instead of yield() when told to,
+     * if they never wait and do not read the timer, mouse or keyboard.
+     */
+    public void batchedYield(Sequence s, int n)
+    {
+        s.batchedYields++;
+        if (s.batchedYields >= n) {
+            s.batchedYields = 0;
+            yield(s);
+        }
+    }
+
     /**
      * offer the CPU to other Sequences, but only every half second
      */
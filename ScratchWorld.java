@@ -22,6 +22,7 @@
 import greenfoot.*;  // (World, Actor, GreenfootImage, Greenfoot and MouseInfo)
 
 import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.LinkedList;
 import java.util.List;
 import java.util.HashMap;
@@ -93,9 +94,8 @@ public class ScratchWorld extends World
     private ArrayList<Backdrop> backdrops = new ArrayList<Backdrop>();
 
     /*
-     * This is used for storing bcast message as a string object
-     * for handling broadcasts, and for storing the sprite object
-     * to clone in the handling cloning.
+     * This is used for storing the sprite object to clone in the
+     * handling of cloning.
      */
     private class ObjectFrameNumPair {
         public Object obj;
@@ -107,8 +107,18 @@ public class ScratchWorld extends World
         }
     }
 
-    // A list of pending broadcast messages.
-    private LinkedList<ObjectFrameNumPair> mesgs = new LinkedList<ObjectFrameNumPair>();
+    // Broadcast messages are known by integer ids: the indexes of their names
+    // in messageNames.  The World subclass generated by s2g.py gives ids to all
+    // the messages in the project (see setMessages()); other names get theirs
+    // when they are first used.
+    private static ArrayList<String> messageNames = new ArrayList<String>();
+    private static HashMap<String, Integer> messageIds = new HashMap<String, Integer>();
+    // For each message id, the classes with scripts that receive it, or null if not known.
+    private static ArrayList<Class<?>[]> messageReceivers = new ArrayList<Class<?>[]>();
+
+    // For each message id, the last two frames it was sent to be received in.
+    private long[] mesgFrames = new long[0];
+    private long[] prevMesgFrames = new long[0];
 
     // A list of pending clone objects that need to be activated.
     private LinkedList<ObjectFrameNumPair> clones2Activate = new LinkedList<ObjectFrameNumPair>();
@@ -196,20 +206,6 @@ public class ScratchWorld extends World
         frameNumber++;
         // System.out.println("ScratchWorld: starting frame " + frameNumber);
 
-        if (mesgs.size() != 0) {
-            // Go through the messages in the bcast message list and remove the
-            // first ones that are old -- with frameNumber in the past.
-            while (true) {
-                ObjectFrameNumPair bcmsg = mesgs.peekFirst();
-                if (bcmsg != null && bcmsg.frameNum < frameNumber) {
-                    mesgs.removeFirst();
-                } else {
-                    // The list is empty or the pending messages are for the next
-                    // iteration.
-                    break;
-                }
-            }
-        }
         if (clones2Activate.size() != 0) {
             // Go through the messages in the bcast message list and remove the
             // first ones that are old -- with frameNumber in the past.
@@ -246,33 +242,80 @@ public class ScratchWorld extends World
         }
     }
 
+    /**
+     * Not to be called by users: the World subclass generated by s2g.py calls
+     * this first thing, to give the project's broadcast messages the ids it
+     * uses for them, which are their indexes in names.  receivers[i] lists the
+     * classes with scripts that receive message i.
+     */
+    protected static void setMessages(String[] names, Class<?>[][] receivers)
+    {
+        messageNames.clear();
+        messageIds.clear();
+        messageReceivers.clear();
+        for (int i = 0; i < names.length; i++) {
+            messageNames.add(names[i]);
+            messageIds.put(names[i], i);
+            messageReceivers.add(receivers[i]);
+        }
+    }
+
+    /**
+     * Not to be called by users: return the id of the message with the given name.
+     */
+    public static int getMessageId(String message)
+    {
+        Integer id = messageIds.get(message);
+        if (id == null) {
+            id = messageNames.size();
+            messageNames.add(message);
+            messageIds.put(message, id);
+            messageReceivers.add(null);
+        }
+        return id;
+    }
+
+    /**
+     * Not to be called by users: return true if the message with the given id
+     * is to be received in this frame.
+     */
+    public boolean bcastPending(int id)
+    {
+        return id < mesgFrames.length && (mesgFrames[id] == frameNumber || prevMesgFrames[id] == frameNumber);
+    }
+
     /**
      * Not to be called by users.
      */
     public boolean bcastPending(String message)
     {
-        for (ObjectFrameNumPair bcmsg : mesgs) {
-            // Look for the correct message, to be triggered in the frame.
-            if ((String) (bcmsg.obj) == message && bcmsg.frameNum == frameNumber) {
-                return true;
-            }
-        }
-        return false;
+        return bcastPending(getMessageId(message));
     }
 
     /**
-     * Not to be called by the user: go through all Scratch actors and look
-     * at all their MesgRecvdSeq's.  Return a list of all that are for the
-     * given message.
+     * Not to be called by the user: look at the MesgRecvdSeq's of all the
+     * Scratch actors that receive the message with the given id (of all the
+     * actors if those are not known).  Return a list of all that are for it.
      */
-    public ArrayList<Scratch.MesgRecvdSeq> getAllMessageScripts(String message)
+    public ArrayList<Scratch.MesgRecvdSeq> getAllMessageScripts(int id)
     {
         ArrayList<Scratch.MesgRecvdSeq> resSeq = new ArrayList<Scratch.MesgRecvdSeq>();
-        List<Scratch> allScr = getObjects(Scratch.class);
+        Class<?>[] receivers = messageReceivers.get(id);
+        List<Scratch> allScr;
+        if (receivers == null) {
+            allScr = getObjects(Scratch.class);
+        } else {
+            allScr = new ArrayList<Scratch>();
+            for (Class<?> cls : receivers) {
+                for (Object obj : getObjects(cls)) {
+                    allScr.add((Scratch) obj);
+                }
+            }
+        }
         for (Scratch scr : allScr) {
             ArrayList<Scratch.MesgRecvdSeq> seqs = scr.getMesgRecvdSeqs();
             for (Scratch.MesgRecvdSeq s: seqs) {
-                if (s.getMesg() == message) {
+                if (s.getMesgId() == id) {
                     resSeq.add(s);
                 }
             }
@@ -280,20 +323,37 @@ public class ScratchWorld extends World
         return resSeq;
     }
 
+    public ArrayList<Scratch.MesgRecvdSeq> getAllMessageScripts(String message)
+    {
+        return getAllMessageScripts(getMessageId(message));
+    }
+
     /**
      * Not to be called by the user: register a bcast message, to be sent to all 
      * Scratch Actors during the next frame.
      */
+    public void registerBcast(int id)
+    {
+        if (id >= mesgFrames.length) {
+            int oldLength = mesgFrames.length;
+            mesgFrames = Arrays.copyOf(mesgFrames, messageNames.size());
+            prevMesgFrames = Arrays.copyOf(prevMesgFrames, messageNames.size());
+            Arrays.fill(mesgFrames, oldLength, mesgFrames.length, -1L);
+            Arrays.fill(prevMesgFrames, oldLength, prevMesgFrames.length, -1L);
+        }
+        // The actors registered to receive this message should execute their
+        // methods in the *next* frame -- thus we add 1 to the current frame number.
+        // Keep the frame it was sent in before too, which may be this one.
+        long frame = frameNumber + 1;
+        if (mesgFrames[id] != frame) {
+            prevMesgFrames[id] = mesgFrames[id];
+            mesgFrames[id] = frame;
+        }
+    }
+
     public void registerBcast(String message)
     {
-        // Create a new ObjectFrameNumPair object, saving the message string, and the
-        // frame in which the actor's registered to receive this message
-        // should execute their methods.  This frame is the *next* time
-        // around -- thus we add 1 to the current frame number. 
-        /* System.out.println("Adding message " + message +
-        " to bcastList with frame " + (frameNumber + 1));  */
-        ObjectFrameNumPair msg = new ObjectFrameNumPair(message, frameNumber + 1);
-        mesgs.addLast(msg);
+        registerBcast(getMessageId(message));
     }
 
     /**
@@ -0,0 +1,69 @@
+#!/bin/env python3
+
+"""Measure the memory that the Block objects of a large sprite take, and
+the time to build them: SpriteOrStage.genBlocksList() on the Cat sprite of
+a synthetic project (see make_project.py), by default with 4800 copies of
+its scripts, 250k blocks in all.  Memory is measured with tracemalloc, so
+it is what the block graph allocates, not the process's RSS.
+
+usage: block_memory.py [--copies COPIES | --scratch_file FILE.sb3]
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os, os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s2g
+from make_project import makeProject
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory and time of building a sprite's blocks")
+    parser.add_argument("--copies", type=int, default=4800,
+                        help="copies of the Cat's scripts in the synthetic project (default: %(default)s)")
+    parser.add_argument("--scratch_file", help="measure the Cat sprite of this project instead of a synthetic one")
+    args = parser.parse_args()
+
+    scratchFile = args.scratch_file
+    with tempfile.TemporaryDirectory() as tmpDir:
+        if scratchFile is None:
+            scratchFile = os.path.join(tmpDir, "project.sb3")
+            makeProject(scratchFile, args.copies)
+        with zipfile.ZipFile(scratchFile) as z:
+            project = json.loads(z.read("project.json"))
+    cat = [target for target in project['targets'] if target['name'] == 'Cat'][0]
+
+    s2g.resetConversionState()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sprite = s2g.Sprite(cat)
+
+        # Without a parse cache, as in a conversion that does not use one.
+        s2g.parsedProject = s2g.ParsedProject(keepBlocks=False)
+        gc.collect()
+        tracemalloc.start()
+        blocks = sprite.genBlocksList(cat['blocks'])
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del blocks
+
+        # Timed separately, as tracemalloc slows allocation down.
+        s2g.parsedProject = s2g.ParsedProject(keepBlocks=False)
+        gc.collect()
+        start = time.perf_counter()
+        sprite.genBlocksList(cat['blocks'])
+        seconds = time.perf_counter() - start
+
+    print("%d blocks: block graph %.1f MB, genBlocksList %.2f s" % (len(cat['blocks']), size / 1e6, seconds))
+
+
+if __name__ == "__main__":
+    main()
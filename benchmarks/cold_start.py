@@ -0,0 +1,56 @@
+#!/bin/env python3
+
+"""Measure how long s2g.py takes to start: the wall time of 's2g.py --help'
+(best of several runs) and the cumulative time to import s2g, as reported
+by python -X importtime.
+
+usage: cold_start.py [-n RUNS] [--python PYTHON]
+"""
+
+import argparse
+import os, os.path
+from subprocess import run, PIPE, DEVNULL
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timeHelp(python, runs):
+    """Return the best wall time, in seconds, of runs runs of 's2g.py --help'."""
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        run([python, os.path.join(REPO_DIR, "s2g.py"), "--help"], stdout=DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def timeImport(python, runs):
+    """Return the best cumulative import time, in seconds, of the s2g module."""
+    best = None
+    for i in range(runs):
+        res = run([python, "-X", "importtime", "-c", "import s2g"], cwd=REPO_DIR,
+                  stdout=DEVNULL, stderr=PIPE, check=True)
+        # Lines look like "import time:  self [us] | cumulative | imported package".
+        for line in res.stderr.decode().splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "s2g":
+                elapsed = int(fields[1]) / 1e6
+                best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up time of s2g.py")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="number of runs; the best is reported")
+    parser.add_argument("--python", default=sys.executable, help="python interpreter to run s2g.py with")
+    args = parser.parse_args()
+
+    print("import s2g (cumulative): %.1f ms" % (timeImport(args.python, args.runs) * 1e3))
+    print("s2g.py --help wall time: %.1f ms" % (timeHelp(args.python, args.runs) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
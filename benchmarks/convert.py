@@ -0,0 +1,54 @@
+#!/bin/env python3
+
+"""Measure the wall time and peak memory (RSS) of converting a whole project
+with convertProject(), by default a synthetic one (see make_project.py)
+with 4000 copies of the Cat's scripts, 208k blocks in all.  The image
+conversion tools (ImageMagick, rsvg-convert) must be on the PATH.
+
+usage: convert.py [--copies COPIES | --scratch_file FILE.sb3]
+"""
+
+import argparse
+import contextlib
+import io
+import os, os.path
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s2g
+from make_project import makeProject
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time and peak memory of converting a project")
+    parser.add_argument("--copies", type=int, default=4000,
+                        help="copies of the Cat's scripts in the synthetic project (default: %(default)s)")
+    parser.add_argument("--scratch_file", help="convert this project instead of a synthetic one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        scratchFile = args.scratch_file
+        if scratchFile is None:
+            scratchFile = os.path.join(tmpDir, "project.sb3")
+            makeProject(scratchFile, args.copies)
+        projectDir = os.path.join(tmpDir, "Project")
+        os.makedirs(projectDir)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = s2g.convertProject(scratchFile, projectDir, s2g.ConversionOptions(incremental=False))
+        seconds = time.perf_counter() - start
+
+    if not result.ok():
+        print("Conversion failed:", result.error)
+        sys.exit(1)
+    # ru_maxrss is in kilobytes on Linux.
+    peakMB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print("converted in %.2f s, peak RSS %d MB" % (seconds, peakMB))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/bin/env python3
+
+"""Measure the per-block cost of generating code for a script: the time
+SpriteOrStage.statements() takes on one long script of simple statements,
+which is dominated by looking up each block's code generator.
+
+usage: dispatch.py [-n STATEMENTS]
+"""
+
+import argparse
+import contextlib
+import io
+import os, os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s2g
+
+# Statements with no inputs, so that the time is spent in dispatch, not in
+# generating expressions.
+OPCODES = ['looks_show', 'pen_penDown', 'motion_ifonedgebounce', 'control_delete_this_clone']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-block cost of code generation")
+    parser.add_argument("-n", "--statements", type=int, default=2000, help="number of statements in the script")
+    args = parser.parse_args()
+
+    s2g.resetConversionState()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sprite = s2g.Sprite({'name': 'Cat'})
+    blocks = []
+    for i in range(args.statements):
+        block = s2g.Block('b%d' % i, OPCODES[i % len(OPCODES)])
+        if blocks:
+            blocks[-1].setNext(block)
+        blocks.append(block)
+
+    number = 20
+    # Into a string, so that the time is not spent in writing to a file.
+    out = s2g.CodeEmitter(io.StringIO())
+    seconds = min(timeit.repeat(lambda: sprite.statements(out, 0, blocks[0]), number=number, repeat=5)) / number
+    print("%.2f ms per %d-statement script, %.2f us per statement" %
+          (seconds * 1e3, args.statements, seconds / args.statements * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/bin/env python3
+
+"""Write a synthetic Scratch 3 project for the benchmarks: a Stage, a Ball
+sprite and a Cat sprite whose scripts are copies of a set of scripts that
+use motion, looks, events, control, sensing, operators, variables, lists
+and a custom block.  Each copy is 52 blocks, so, e.g., 4000 copies make a
+208k-block project and 4800 copies a 250k-block one.
+
+usage: make_project.py out.sb3 [COPIES]
+"""
+
+import json
+import struct
+import sys
+import zipfile
+import zlib
+
+BLOCKS_PER_COPY = 52
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="95" height="100.5" viewBox="0 0 95 100.5"></svg>'
+
+
+def genPng(width, height):
+    """Return a transparent png image of the given size."""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    raw = b''.join(b'\x00' + b'\x00\x00\x00\x00' * width for i in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def num(value, shadowType=4):
+    return [1, [shadowType, str(value)]]
+
+
+def block(opcode, next=None, parent=None, inputs=None, fields=None, topLevel=False, **rest):
+    b = {"opcode": opcode, "next": next, "parent": parent, "inputs": inputs or {},
+         "fields": fields or {}, "shadow": False, "topLevel": topLevel}
+    b.update(rest)
+    return b
+
+
+def procMutation(warp, names=None):
+    mutation = {"tagName": "mutation", "children": [], "proccode": "draw %s %b",
+                "argumentids": json.dumps(["argA", "argB"]), "warp": warp}
+    if names is not None:
+        mutation["argumentnames"] = json.dumps(names)
+        mutation["argumentdefaults"] = json.dumps(["", "false"])
+    return mutation
+
+
+def genScripts(p, other):
+    """Return the blocks of one copy of the scripts, with ids starting with
+    p, that refer to the sprite named other."""
+    score = ["score", p + "var1"]
+    b = {}
+    # when flag clicked: a forever loop of moves, turns, a custom block call, ...
+    b[p + 'hat'] = block('event_whenflagclicked', p + 's1', topLevel=True, x=0, y=0)
+    b[p + 's1'] = block('data_setvariableto', p + 's2', p + 'hat', {"VALUE": [1, [10, "0"]]}, {"VARIABLE": score})
+    b[p + 's2'] = block('control_forever', None, p + 's1', {"SUBSTACK": [2, p + 'if1']})
+    b[p + 'if1'] = block('control_if', p + 'mv', p + 's2', {"CONDITION": [2, p + 'touch'], "SUBSTACK": [2, p + 'chg']})
+    b[p + 'touch'] = block('sensing_touchingobject', None, p + 'if1', {"TOUCHINGOBJECTMENU": [1, p + 'tmenu']})
+    b[p + 'tmenu'] = block('sensing_touchingobjectmenu', None, p + 'touch', {},
+                           {"TOUCHINGOBJECTMENU": [other, None]}, shadow=True)
+    b[p + 'chg'] = block('data_changevariableby', p + 'bc', p + 'if1', {"VALUE": num(1)}, {"VARIABLE": score})
+    b[p + 'bc'] = block('event_broadcast', None, p + 'chg', {"BROADCAST_INPUT": [1, [11, "hit", "msg1"]]})
+    b[p + 'mv'] = block('motion_movesteps', p + 'rep', p + 'if1', {"STEPS": [3, p + 'add', [4, "10"]]})
+    b[p + 'add'] = block('operator_add', None, p + 'mv', {"NUM1": [3, p + 'mul', [4, ""]], "NUM2": num(2)})
+    b[p + 'mul'] = block('operator_multiply', None, p + 'add', {"NUM1": num(3), "NUM2": [3, [12] + score, [4, ""]]})
+    b[p + 'rep'] = block('control_repeat', p + 'say', p + 'mv', {"TIMES": num(10), "SUBSTACK": [2, p + 'turn']})
+    b[p + 'turn'] = block('motion_turnright', p + 'call', p + 'rep', {"DEGREES": [3, p + 'mop', [4, ""]]})
+    b[p + 'mop'] = block('operator_mathop', None, p + 'turn', {"NUM": num(2)}, {"OPERATOR": ["10 ^", None]})
+    b[p + 'call'] = block('procedures_call', p + 'add2', p + 'rep',
+                          {"argA": [3, p + 'xpos', [10, ""]], "argB": [2, p + 'gt']}, mutation=procMutation("false"))
+    b[p + 'xpos'] = block('motion_xposition', None, p + 'call')
+    b[p + 'gt'] = block('operator_gt', None, p + 'call',
+                        {"OPERAND1": [3, p + 'dist', [10, ""]], "OPERAND2": [1, [10, "50"]]})
+    b[p + 'dist'] = block('sensing_distanceto', None, p + 'gt', {"DISTANCETOMENU": [1, p + 'dmenu']})
+    b[p + 'dmenu'] = block('sensing_distancetomenu', None, p + 'dist', {}, {"DISTANCETOMENU": [other, None]},
+                           shadow=True)
+    b[p + 'add2'] = block('data_addtolist', None, p + 'call', {"ITEM": [3, p + 'join', [10, ""]]},
+                          {"LIST": ["things", p + "list1"]})
+    b[p + 'join'] = block('operator_join', None, p + 'add2',
+                          {"STRING1": [1, [10, "a"]], "STRING2": [3, p + 'join2', [10, ""]]})
+    b[p + 'join2'] = block('operator_join', None, p + 'join',
+                           {"STRING1": [1, [10, "b"]], "STRING2": [3, [12] + score, [10, ""]]})
+    b[p + 'say'] = block('looks_sayforsecs', p + 'wait', p + 'rep', {"MESSAGE": [1, [10, "Hello!"]], "SECS": num(2)})
+    b[p + 'wait'] = block('control_wait', None, p + 'say', {"DURATION": num(0.5, 5)})
+    # A custom block that runs without screen refresh.
+    b[p + 'def'] = block('procedures_definition', p + 'd1', None, {"custom_block": [1, p + 'proto']},
+                         topLevel=True, x=0, y=300)
+    b[p + 'proto'] = block('procedures_prototype', None, p + 'def', {"argA": [1, p + 'pa'], "argB": [1, p + 'pb']},
+                           shadow=True, mutation=procMutation("true", ["len", "flag"]))
+    b[p + 'pa'] = block('argument_reporter_string_number', None, p + 'proto', {}, {"VALUE": ["len", None]},
+                        shadow=True)
+    b[p + 'pb'] = block('argument_reporter_boolean', None, p + 'proto', {}, {"VALUE": ["flag", None]}, shadow=True)
+    b[p + 'd1'] = block('control_repeat_until', None, p + 'def', {"CONDITION": [2, p + 'lt'], "SUBSTACK": [2, p + 'd2']})
+    b[p + 'lt'] = block('operator_lt', None, p + 'd1', {"OPERAND1": [3, p + 'pa2', [10, ""]], "OPERAND2": [1, [10, "5"]]})
+    b[p + 'pa2'] = block('argument_reporter_string_number', None, p + 'lt', {}, {"VALUE": ["len", None]})
+    b[p + 'd2'] = block('motion_changexby', None, p + 'd1', {"DX": [3, p + 'pa3', [4, ""]]})
+    b[p + 'pa3'] = block('argument_reporter_string_number', None, p + 'd2', {}, {"VALUE": ["len", None]})
+    # when I receive hit: clone, then an if-else.
+    b[p + 'rcv'] = block('event_whenbroadcastreceived', p + 'r1', None, {}, {"BROADCAST_OPTION": ["hit", "msg1"]},
+                         topLevel=True, x=0, y=600)
+    b[p + 'r1'] = block('control_create_clone_of', p + 'r2', p + 'rcv', {"CLONE_OPTION": [1, p + 'cmenu']})
+    b[p + 'cmenu'] = block('control_create_clone_of_menu', None, p + 'r1', {}, {"CLONE_OPTION": ["_myself_", None]},
+                           shadow=True)
+    b[p + 'r2'] = block('control_if_else', None, p + 'r1',
+                        {"CONDITION": [2, p + 'and'], "SUBSTACK": [2, p + 'r3'], "SUBSTACK2": [2, p + 'r4']})
+    b[p + 'and'] = block('operator_and', None, p + 'r2', {"OPERAND1": [2, p + 'eq'], "OPERAND2": [2, p + 'not']})
+    b[p + 'eq'] = block('operator_equals', None, p + 'and',
+                        {"OPERAND1": [3, [12] + score, [10, ""]], "OPERAND2": [1, [10, "50"]]})
+    b[p + 'not'] = block('operator_not', None, p + 'and', {"OPERAND": [2, p + 'md']})
+    b[p + 'md'] = block('sensing_mousedown', None, p + 'not')
+    b[p + 'r3'] = block('data_setvariableto', None, p + 'r2', {"VALUE": [3, p + 'div', [10, ""]]}, {"VARIABLE": score})
+    b[p + 'div'] = block('operator_divide', None, p + 'r3', {"NUM1": num(7), "NUM2": num(2)})
+    b[p + 'r4'] = block('looks_say', None, p + 'r2', {"MESSAGE": [3, p + 'xof', [10, ""]]})
+    b[p + 'xof'] = block('sensing_of', None, p + 'r4', {"OBJECT": [1, p + 'ofmenu']},
+                         {"PROPERTY": ["x position", None]})
+    b[p + 'ofmenu'] = block('sensing_of_object_menu', None, p + 'xof', {}, {"OBJECT": [other, None]}, shadow=True)
+    # A script with no hat block, which is not converted.
+    b[p + 'orph'] = block('motion_movesteps', p + 'orph2', None, {"STEPS": num(5)}, topLevel=True, x=500, y=0)
+    b[p + 'orph2'] = block('looks_show', None, p + 'orph')
+    # when space key pressed
+    b[p + 'key'] = block('event_whenkeypressed', p + 'k1', None, {}, {"KEY_OPTION": ["space", None]},
+                         topLevel=True, x=0, y=900)
+    b[p + 'k1'] = block('event_broadcastandwait', p + 'k2', p + 'key', {"BROADCAST_INPUT": [1, [11, "go", "msg2"]]})
+    b[p + 'k2'] = block('motion_goto', None, p + 'k1', {"TO": [1, p + 'gmenu']})
+    b[p + 'gmenu'] = block('motion_goto_menu', None, p + 'k2', {}, {"TO": [other, None]}, shadow=True)
+    return b
+
+
+def genSprite(name, other, prefix, copies=1):
+    sprite = {"isStage": False, "name": name, "variables": {}, "lists": {}, "broadcasts": {}, "blocks": {},
+              "comments": {}, "currentCostume": 0,
+              "costumes": [{"assetId": prefix + "c0", "name": "costume1", "md5ext": prefix + "c0.svg",
+                            "dataFormat": "svg"},
+                           {"assetId": prefix + "c1", "name": "costume2", "md5ext": prefix + "c1.png",
+                            "dataFormat": "png"}],
+              "sounds": [{"assetId": prefix + "s0", "name": "pop", "dataFormat": "wav", "format": "",
+                          "md5ext": prefix + "s0.wav"}],
+              "volume": 100, "layerOrder": 1, "visible": True, "x": 10, "y": -20, "size": 80,
+              "direction": 90, "draggable": False, "rotationStyle": "all around"}
+    for i in range(copies):
+        p = prefix if copies == 1 else "%s%d_" % (prefix, i)
+        sprite["blocks"].update(genScripts(p, other))
+        sprite["variables"][p + "var1"] = ["score" if copies == 1 else "score%d" % i, 0]
+        sprite["lists"][p + "list1"] = ["things" if copies == 1 else "things%d" % i, ["x", 1, 2.5]]
+    return sprite
+
+
+def makeProject(filename, copies=1):
+    """Write the project, with copies copies of the Cat's scripts, to filename."""
+    stage = {"isStage": True, "name": "Stage", "variables": {}, "lists": {},
+             "broadcasts": {"msg1": "hit", "msg2": "go"}, "blocks": {}, "comments": {}, "currentCostume": 0,
+             "costumes": [{"assetId": "bg0", "name": "backdrop1", "md5ext": "bg0.png", "dataFormat": "png"}],
+             "sounds": [], "volume": 100, "layerOrder": 0}
+    project = {"targets": [stage, genSprite("Cat", "Ball", "ca_", copies), genSprite("Ball", "Cat", "ba_")],
+               "monitors": [], "extensions": [], "meta": {"semver": "3.0.0"}}
+    with zipfile.ZipFile(filename, 'w') as z:
+        z.writestr('project.json', json.dumps(project))
+        z.writestr('bg0.png', genPng(48, 36))
+        for prefix in ('ca_', 'ba_'):
+            z.writestr(prefix + 'c0.svg', SVG)
+            z.writestr(prefix + 'c1.png', genPng(40, 30))
+            z.writestr(prefix + 's0.wav', b'RIFF0000WAVEfmt ')
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    makeProject(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 1)
+
+
+if __name__ == "__main__":
+    main()
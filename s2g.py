@@ -19,68 +19,108 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 
+import contextlib
+import filecmp
 import glob
+import hashlib
+import io
 import json
+import math
 import os, os.path
 import platform
 import argparse
 import re
-from pprint import pprint
 import shutil
-from subprocess import call, getstatusoutput
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run, PIPE
 import sys
-import tkinter
-import tkinter.messagebox
+import tempfile
+import time
+from types import MappingProxyType
+import zipfile
+import zlib
+
+# tkinter is slow to import, and is missing altogether on some systems, so
+# it is only imported, by importTkinter(), when the GUI is used.
+tkinter = None
 
 # Global Variables that can be set via command-line arguments.
 debug = False
 inference = False
 name_resolution = False
 useGui = False
+# Number of image conversion commands to run at the same time.
+numImageWorkers = os.cpu_count() or 1
+# Directory holding converted images (and, in its "parsed" subdirectory,
+# parsed projects) shared between conversions, and the maximum sizes in
+# megabytes of the two caches, each of which is kept within its own limit.
+# No cache is used if the directory is None.
+imageCacheDir = None
+imageCacheMaxMB = 512
+parseCacheMaxMB = 128
+# If True, sprites that have not changed since the last conversion into the
+# same greenfoot directory are not generated again.
+incremental = True
+# If True, "when flag clicked" and "when I start as a clone" scripts are
+# compiled to state machines that the Greenfoot thread steps through,
+# instead of each running on a thread of its own, where they can be (see
+# SpriteOrStage.canStepScript()).
+steppedScripts = False
+# How often loops that cannot wait and do not read the timer or user input
+# (see SpriteOrStage.loopCanBatchYields()) let other sequences run: every
+# yieldEvery iterations, or, if it is 0, every half second.  1, as in
+# Scratch, redraws the screen after every iteration of every loop.
+yieldEvery = 1
 
 # Indentation level in outputted Java code.
 NUM_SPACES_PER_LEVEL = 4
 
+# Statement lists nested deeper than this are generated after the
+# statements around them (see SpriteOrStage.statements()), marked by
+# placeholders with the index of the list until then.  Then converting
+# deeply nested scripts does not reach Python's recursion limit.
+MAX_STATEMENT_NESTING = 50
+
+# Size of the buffer used when writing each .java file.
+OUTPUT_BUFFER_BYTES = 64 * 1024
+
 # This variable tracks how many cloud variables have been generated, and
 # serves as each cloud var's id
 cloudVars = 0
 
 worldClassName = ""
 
-# A list of all variables, some local, some global
-allVars = []
-
-# Set up arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
-parser.add_argument("-d", "--dotypeinference", action="store_true", help="Automatically infer variable types")
-parser.add_argument("-r", "--resolvevariablenames", action="store_true", help="Automatically convert to java ids")
-parser.add_argument("-g", "--gui", action="store_true", help="Use GUI converter (Experimental)")
-parser.add_argument('-o', "--onlydecode", action="store_true",
-                    help="Only decode the project.json, don't move files, etc.")
-parser.add_argument("--scratch_file", help="Location of scratch sb2/sb3 file", default=os.getcwd(), required=False)
-parser.add_argument("--greenfoot_dir", help="Location of greenfoot project directory", default=os.getcwd(),
-                    required=False)
-args = parser.parse_args()
-
-# Apply arguments
-if args.verbose:
-    debug = True
-if args.dotypeinference:
-    inference = True
-if args.resolvevariablenames:
-    name_resolution = True
-if args.gui:
-    useGui = True
-onlyDecode = args.onlydecode
-
-SCRATCH_FILE = args.scratch_file.strip()
-# Take off spaces and a possible trailing "/"
-PROJECT_DIR = args.greenfoot_dir.strip().rstrip("/")
-SCRATCH_PROJ_DIR = "scratch_code"
-if SCRATCH_FILE.endswith('.sb2'):
-    print('Scratch conversion only works with Scratch 3.0')
-    sys.exit(-1)
+# All variables and lists, some local, some global: a VariableRegistry,
+# created in resetConversionState().
+allVars = None
+
+# The broadcast messages of the project being converted: a
+# BroadcastMessages, created in convertArchive().
+broadcastMessages = None
+
+# The inferred types of the variables of the project being converted: a
+# VariableTypes, created in convertArchive().
+variableTypes = None
+
+# The java class name of each sprite of the project being converted, by
+# sprite name.  Set in convertArchive().
+spriteClassNames = {}
+
+# Block graphs and variable choices for the project being converted,
+# possibly loaded from a ParseCache.
+parsedProject = None
+
+# Set by main() or convertProject() for the conversion being done.
+onlyDecode = False
+SCRATCH_FILE = ""
+PROJECT_DIR = ""
+imagesDir = ""
+soundsDir = ""
+
+# Scratch.java, ScratchWorld.java and the say/think images are copied
+# into the Greenfoot project from the directory holding this file.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # Initialize stage globally
 stage = None
@@ -95,18 +135,19 @@ JAVA_KEYWORDS = ('abstract', 'continue', 'for', 'new', 'switch', 'assert', 'defa
 
 class CodeAndCb:
     """This class binds together code, and possibly code that that code
-    will call that belongs in a callback."""
+    will call that belongs in a callback.  Both are CodeEmitters, which
+    the code is written to as it is generated."""
 
     # class variable
     cbScriptId = 0
 
-    def __init__(self):
-        self.code = ""
-        self.cbCode = ""
+    def __init__(self, code, cbCode):
+        self.code = code
+        self.cbCode = cbCode
         # self.varInitCode = ""
 
     def addToCbCode(self, code):
-        self.cbCode += code
+        self.cbCode.write(code)
 
     def getNextScriptId(self):
         ret = CodeAndCb.cbScriptId
@@ -114,13 +155,134 @@ class CodeAndCb:
         return ret
 
     def addToCode(self, code):
-        self.code += code
+        self.code.write(code)
+
+
+class CodeEmitter:
+    """Generated code, written a piece at a time to a text stream, instead
+    of being concatenated into one big string.  The stream is the .java
+    file being written or, for code that goes into the file after code
+    that is generated later (e.g., a sprite's callbacks, which follow its
+    constructor), a temporary file, kept in memory until it grows beyond
+    SPOOL_BYTES, which is copied into the file with copyTo()."""
+
+    SPOOL_BYTES = 1024 * 1024
+
+    def __init__(self, out=None):
+        if out is None:
+            out = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_BYTES, mode="w+")
+        self._out = out
+        # The streams written before self._out, and the emitters made by
+        # insertEmitter() between them, in order.
+        self._parts = []
+
+    def write(self, code):
+        self._out.write(code)
+
+    def writeLine(self, level, line):
+        """Write line, indented to the given level, and a newline."""
+        self._out.write(genIndent(level) + line + "\n")
+
+    def insertEmitter(self):
+        """Return a new emitter for code that goes here, after the code
+        written to this one so far, but that is generated later.  (Not for
+        an emitter that writes to the .java file itself.)"""
+        emitter = CodeEmitter()
+        self._parts += [self._out, emitter]
+        self._out = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_BYTES, mode="w+")
+        return emitter
+
+    def copyTo(self, other):
+        """Write everything written to this emitter to the other one."""
+        for part in self._parts + [self._out]:
+            if isinstance(part, CodeEmitter):
+                part.copyTo(other)
+            else:
+                part.seek(0)
+                shutil.copyfileobj(part, other._out)
+
+    def getCode(self):
+        """Return everything written to this emitter, as a string."""
+        code = io.StringIO()
+        self.copyTo(CodeEmitter(code))
+        return code.getvalue()
+
+    def close(self):
+        for part in self._parts + [self._out]:
+            part.close()
+
+
+class StepCode:
+    """The body of the step() method of a script compiled to a state
+    machine (see SpriteOrStage.genSteppedScript()), as it is generated: a
+    switch on stepPc, the state the script stopped in, with a case for
+    each place it carries on from after yielding or jumping.  Code that
+    follows a return or jump cannot be reached, and is left out, as javac
+    rejects it."""
+
+    def __init__(self, level):
+        # level of the statements in the cases.
+        self.level = level
+        self.lines = []
+        # Loop counters, which become fields of the script.
+        self.counters = []
+        self._numStates = 1
+        self._reachable = True
+
+    def newState(self):
+        """Return a new state, for startState() and the jumps to it."""
+        self._numStates += 1
+        return self._numStates - 1
+
+    def newCounter(self):
+        name = "stepCount%d" % len(self.counters)
+        self.counters.append(name)
+        return name
+
+    def add(self, code):
+        """Add code for statements, at self.level."""
+        if self._reachable:
+            self.lines.append(code)
+
+    def addLine(self, line):
+        self.add(genIndent(self.level) + line + "\n")
+
+    def startState(self, state):
+        """Start the code that runs in state, which may also be reached
+        from the code before it."""
+        self.lines.append(genIndent(self.level - 1) + "case %d:\n" % state)
+        self._reachable = True
+
+    def jumpIf(self, cond, state):
+        self.addLine("if %s { stepPc = %d; continue; }" % (cond, state))
+
+    def jump(self, state):
+        self.addLine("stepPc = %d;" % state)
+        self.addLine("continue;")
+        self._reachable = False
+
+    def endScript(self):
+        self.addLine("return false;")
+        self._reachable = False
+
+    def yieldTo(self, state, yieldCall=None):
+        """Yield, to carry on in state next time.  yieldCall, if given, is
+        a call that says whether to yield now, or to carry on at once."""
+        self.addLine("stepPc = %d;" % state)
+        if yieldCall is None:
+            self.addLine("return true;")
+        else:
+            self.addLine("if (%s) return true;" % yieldCall)
+            self.addLine("continue;")
+        self._reachable = False
 
 
-def execOrDie(cmd, descr):
+def execOrDie(cmd, descr, input=None):
+    """Run cmd in a shell, exiting if it cannot be run.  If input is given,
+    it is a bytes-like object that is fed to the command's stdin."""
     try:
         print("Executing shell command: " + cmd)
-        retcode = call(cmd, shell=True)
+        retcode = run(cmd, shell=True, input=input).returncode
         if retcode < 0:
             print("Command to " + descr + " was terminated by signal", -retcode, \
                   file=sys.stderr)
@@ -133,10 +295,133 @@ def execOrDie(cmd, descr):
         sys.exit(1)
 
 
+class Sb3Archive:
+    """A read-only view of a downloaded Scratch 3 (.sb3) file.
+
+    The .sb3 file is a zip archive holding project.json and one file per
+    costume and sound, each named by its assetId.  Members are read
+    straight out of the archive when they are needed, so nothing is
+    unpacked to disk.
+    """
+
+    PROJECT_JSON = "project.json"
+
+    def __init__(self, filename):
+        """filename is the path of the .sb3 file, or its contents as a
+        bytes-like object."""
+        if isinstance(filename, str):
+            self._name = filename
+        else:
+            self._name = "<%d bytes>" % len(filename)
+            filename = io.BytesIO(filename)
+        self._zip = zipfile.ZipFile(filename)
+        self._names = set(self._zip.namelist())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def getName(self):
+        return self._name
+
+    def getProjectJsonHash(self):
+        """Return a hash of the contents of project.json."""
+        return hashlib.sha1(self._zip.read(self.PROJECT_JSON)).hexdigest()
+
+    def getProjectJson(self):
+        """Return the parsed project.json."""
+        with self._zip.open(self.PROJECT_JSON) as f:
+            return json.load(io.TextIOWrapper(f, encoding="utf_8"))
+
+    def hasMember(self, name):
+        return name in self._names
+
+    def getMemberNames(self, ext):
+        """Return the sorted names of all members ending with ext, e.g., ".png"."""
+        return sorted(n for n in self._names if n.endswith(ext))
+
+    def readMember(self, name):
+        """Return the contents of the member as a memoryview."""
+        return memoryview(self._zip.read(name))
+
+    def openMember(self, name):
+        """Return a binary stream for reading the member."""
+        return self._zip.open(name)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def getPngSize(data):
+    """Return (width, height) of a png image, read from its IHDR chunk,
+    which the png spec requires to be the first chunk in the file."""
+    data = bytes(data[:24])
+    if len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        raise ValueError('not a png image')
+    return struct.unpack('>II', data[16:24])
+
+
+# Pixels per unit of the absolute lengths an svg image's size can be in,
+# as in CSS, which has 96 pixels to the inch.
+SVG_UNITS = {'': 1.0, 'px': 1.0, 'in': 96.0, 'cm': 96 / 2.54, 'mm': 96 / 25.4,
+             'pt': 96 / 72.0, 'pc': 16.0}
+
+
+def getSvgSize(data):
+    """Return (width, height) of an svg image, in pixels, from the width and
+    height attributes of the <svg> element, or from its viewBox if they are
+    missing or not absolute lengths (e.g., "100%" or "2em")."""
+    text = bytes(data).decode('utf_8', errors='replace')
+    m = re.search(r'<svg\b([^>]*)>', text)
+    if m is None:
+        raise ValueError('not an svg image')
+    attrs = dict(re.findall(r'([\w:-]+)\s*=\s*["\']([^"\']*)["\']', m.group(1)))
+
+    def length(name):
+        val = re.match(r'\s*([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)\s*([a-z]*)\s*$',
+                       attrs.get(name, ''))
+        if val is None or val.group(2) not in SVG_UNITS:
+            return None
+        return float(val.group(1)) * SVG_UNITS[val.group(2)]
+
+    width, height = length('width'), length('height')
+    if (width is None or height is None) and 'viewBox' in attrs:
+        viewBox = re.split(r'[\s,]+', attrs['viewBox'].strip())
+        if len(viewBox) == 4:
+            width = float(viewBox[2]) if width is None else width
+            height = float(viewBox[3]) if height is None else height
+    if width is None or height is None:
+        raise ValueError('svg image has no width/height or viewBox')
+    return width, height
+
+
+def getImageSize(fname, data):
+    """Return (width, height) for the png or svg image whose contents are
+    in data, without running any external program."""
+    if fname.endswith('.svg'):
+        return getSvgSize(data)
+    return getPngSize(data)
+
+
 def genIndent(level):
     return (" " * (level * NUM_SPACES_PER_LEVEL))
 
 
+def isNumericLiteral(val):
+    """Return True if the literal value val, from a Scratch block's input,
+    is an int or float."""
+    try:
+        float(val)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
 def convertKeyPressName(keyname):
     # Single letter/number keynames in Scratch and Greenfoot are identical.
     # Keyname "space" is the same in each.
@@ -232,7 +517,7 @@ class Variable:
         self._typeStringVar = None
         self._initValueEntry = None
         # print(str(self))
-        allVars.append(self)
+        allVars.add(self)
 
     def setGfName(self, name):
         self._gfName = name
@@ -241,7 +526,9 @@ class Variable:
         self._type = type
 
     def setOwner(self, owner):
+        oldOwner = self._owner
         self._owner = owner
+        allVars.ownerChanged(self, oldOwner)
 
     def setGlobal(self):
         self._local_or_global = 'global'
@@ -282,39 +569,485 @@ class Variable:
         return 'Variable with name %s, gfname %s, uniqId %s initValue %s owner %s' % (self._scratchName, self._gfName, self._uniqId, self._initValue, self._owner)
 
 
+class VariableRegistry:
+    """All the Variables (and lists) of the project being converted,
+    indexed by unique id and by (owner, scratch name), so that each
+    reference to a variable in the generated code is found without
+    searching through all of them."""
+
+    def __init__(self):
+        self._vars = []
+        self._byId = {}
+        self._byOwnerAndName = {}
+        # Unique ids that were looked up but never defined, so each is
+        # reported only once.
+        self._missingIds = set()
+
+    def add(self, var):
+        self._vars.append(var)
+        uniqId = var.getUniqueId()
+        if uniqId in self._byId:
+            # Keep the first, as a reference always found it first.
+            print("Warning: variable or list '%s' has the same id (%s) as '%s'" %
+                  (var.getName(), uniqId, self._byId[uniqId].getName()))
+        else:
+            self._byId[uniqId] = var
+        self._byOwnerAndName.setdefault((var.getOwner(), var.getName()), var)
+
+    def ownerChanged(self, var, oldOwner):
+        """Re-index var, which was indexed under oldOwner."""
+        key = (oldOwner, var.getName())
+        if self._byOwnerAndName.get(key) is var:
+            del self._byOwnerAndName[key]
+        self._byOwnerAndName.setdefault((var.getOwner(), var.getName()), var)
+
+    def getByUniqueId(self, uniqId):
+        var = self._byId.get(uniqId)
+        if var is None and uniqId not in self._missingIds:
+            self._missingIds.add(uniqId)
+            print("Warning: no variable or list with id", uniqId)
+        return var
+
+    def getBySpriteAndName(self, sprite, name):
+        return self._byOwnerAndName.get((sprite, name))
+
+    def getMissingIds(self):
+        return sorted(self._missingIds)
+
+    def __iter__(self):
+        return iter(self._vars)
+
+    def __len__(self):
+        return len(self._vars)
+
+
+class BroadcastMessages:
+    """The broadcast messages of the project being converted, each with an
+    integer id, and the classes with scripts that receive each.  The World
+    class gets a constant for each id and the table of receivers (see
+    genWorldCode()), and the generated code broadcasts and receives the
+    messages by id.  It is built from the whole project, before any code is
+    generated, so that a message has the same id in the code of sprites
+    that are not generated again (see TargetFingerprints)."""
+
+    def __init__(self, targets):
+        self._ids = {}
+        self._names = []
+        self._receivers = []
+        self._constNames = []
+        # The stage lists the project's messages, though it may miss some.
+        for t in targets:
+            if t['isStage']:
+                for name in t.get('broadcasts', {}).values():
+                    self._add(name)
+        for t in targets:
+            className = "Stage" if t['isStage'] else convertToJavaId(t['name'], True, True)
+            for vals in t['blocks'].values():
+                # Loose variable and list reporters are lists, not dictionaries.
+                if not isinstance(vals, dict):
+                    continue
+                if vals['opcode'] == 'event_whenbroadcastreceived':
+                    receivers = self._receivers[self._add(vals['fields']['BROADCAST_OPTION'][0])]
+                    if className not in receivers:
+                        receivers.append(className)
+                elif 'BROADCAST_INPUT' in vals['inputs']:
+                    value = vals['inputs']['BROADCAST_INPUT'][1]
+                    if isinstance(value, list) and len(value) > 1:
+                        self._add(value[1])
+
+    def _add(self, name):
+        """Return the id of the message name, giving it one if it has none."""
+        if name not in self._ids:
+            self._ids[name] = len(self._names)
+            constName = "MSG_" + re.sub('[^A-Z0-9]+', '_', name.upper()).strip('_')
+            if constName in self._constNames:
+                constName += "_%d" % len(self._names)
+            self._names.append(name)
+            self._receivers.append([])
+            self._constNames.append(constName)
+        return self._ids[name]
+
+    def getConstant(self, name):
+        """Return the World class constant for the id of the message name, or
+        None if it is not one of the project's messages."""
+        if name not in self._ids:
+            return None
+        return worldClassName + "." + self._constNames[self._ids[name]]
+
+    def getNames(self):
+        return list(self._names)
+
+    def genWorldCode(self):
+        """Return the code that defines the constants and tables in the
+        World class."""
+        code = genIndent(1) + "// Broadcast messages, by id.\n"
+        for id, constName in enumerate(self._constNames):
+            code += genIndent(1) + "public static final int %s = %d;\n" % (constName, id)
+        code += genIndent(1) + "// Each message's name, and the classes with scripts that receive it.\n"
+        code += genIndent(1) + "private static final String[] MESSAGE_NAMES = {\n"
+        for name in self._names:
+            code += genIndent(2) + json.dumps(name) + ",\n"
+        code += genIndent(1) + "};\n"
+        code += genIndent(1) + "private static final Class<?>[][] MESSAGE_RECEIVERS = {\n"
+        for receivers in self._receivers:
+            code += genIndent(2) + "{ " + "".join(className + ".class, " for className in receivers) + "},\n"
+        code += genIndent(1) + "};\n"
+        return code
+
+
+class VariableTypes:
+    """The java type ('Int', 'Double', 'String' or 'Boolean') of each variable
+    of the project being converted, inferred from its initial value and from
+    every value that the scripts of all the sprites and the stage set it to
+    or change it by.  A variable set to another variable gets that one's
+    type too, so the types are found together, by repeating until none
+    changes.  Each variable gets the narrowest type that holds all its
+    values: an Int and a Double make a Double, and numbers and text, or
+    booleans and anything else, make a String, which is a conflict (see
+    getConflict()).  The number or text parameters of custom blocks get
+    types the same way, from the values passed to them, except that one
+    that is only used as text stays a String (see getParamType())."""
+
+    def __init__(self, targets):
+        # The value of each expression is a node: (rule, arg, child nodes),
+        # with a node's children always before it, so the values of all of
+        # them can be found in one pass (see _evalNodes()).
+        self._nodes = []
+        # The variables, by unique id, and the number or text parameters of
+        # the custom blocks, by ('param', target name, proccode, name).
+        self._initTypes = {}
+        # The nodes for the values each is set to, or passed to it.
+        self._sites = {}
+        # How each parameter is used in its custom block: as a 'number'
+        # and/or as 'text'.
+        self._paramUses = {}
+        for t in targets:
+            for uniqId, (name, value) in t['variables'].items():
+                # Scratch saves the value of a variable set to a boolean as text.
+                if isinstance(value, str) and value.lower() in ('true', 'false'):
+                    self._initTypes[uniqId] = None
+                else:
+                    self._initTypes[uniqId] = self._valueType(value)
+        for t in targets:
+            self._targetName = t['name']
+            blocks = t['blocks']
+            self._findProcParams(blocks)
+            for blockId, vals in blocks.items():
+                # Loose variable and list reporters are lists, not dictionaries.
+                if not isinstance(vals, dict):
+                    continue
+                opcode = vals['opcode']
+                if opcode in ('data_setvariableto', 'data_changevariableby'):
+                    uniqId = vals['fields']['VARIABLE'][1]
+                    value = self._exprNode(blocks, vals['inputs'].get('VALUE'),
+                                           opcode == 'data_changevariableby')
+                    if opcode == 'data_changevariableby':
+                        value = self._addNode('numeric', None, [self._addNode('var', uniqId, []), value])
+                    self._sites.setdefault(uniqId, []).append(value)
+                elif opcode == 'procedures_call':
+                    proccode = vals['mutation']['proccode']
+                    for argId in json.loads(vals['mutation'].get('argumentids', '[]')):
+                        key = self._procParams.get((proccode, argId))
+                        if key is not None:
+                            self._sites[key].append(self._exprNode(blocks, vals['inputs'].get(argId)))
+                elif opcode == 'argument_reporter_string_number' and not vals.get('shadow'):
+                    key = self._paramKey(blocks, blockId)
+                    if key is not None:
+                        self._paramUses[key].add(self._paramUse(blocks, blockId))
+
+        # A parameter only used as text is left text, so its value is not
+        # converted to a number and back.
+        params = list(self._paramUses)
+        for key in params:
+            if 'text' in self._paramUses[key] and 'number' not in self._paramUses[key]:
+                self._initTypes[key] = 'String'
+
+        self._types = dict(self._initTypes)
+        while True:
+            while True:
+                values = self._evalNodes()
+                types = {}
+                for key, initType in self._initTypes.items():
+                    types[key] = initType
+                    for node in self._sites.get(key, ()):
+                        types[key] = self._join(types[key], values[node])
+                if types == self._types:
+                    break
+                self._types = types
+            # A parameter used as a number, but passed nothing that tells
+            # which kind, is a Double.  That may change what others are passed.
+            undecided = [key for key in params if self._types[key] is None and 'number' in self._paramUses[key]]
+            if not undecided:
+                break
+            for key in undecided:
+                self._initTypes[key] = 'Double'
+
+        # The different kinds of value each variable is given.
+        self._conflicts = {}
+        for uniqId, initType in self._initTypes.items():
+            if uniqId in self._paramUses:
+                continue
+            kinds = {'number' if t in ('Int', 'Double') else t
+                     for t in [initType] + [values[node] for node in self._sites.get(uniqId, ())]
+                     if t is not None}
+            if len(kinds) > 1:
+                self._conflicts[uniqId] = sorted(kinds)
+
+    def _findProcParams(self, blocks):
+        """Find the number or text parameters of the target's custom blocks:
+        set self._procParams to map (proccode, argument id) to the key of
+        each, and self._procParamKeys to map (proccode, name) to it."""
+        self._procParams = {}
+        self._procParamKeys = {}
+        # The proccode of the custom block definition each block is in, or None.
+        self._procCodes = {}
+        for vals in blocks.values():
+            if not isinstance(vals, dict) or vals['opcode'] != 'procedures_definition':
+                continue
+            proto = self._inputBlock(blocks, vals['inputs'].get('custom_block'))
+            if proto is None:
+                continue
+            mutation = proto['mutation']
+            proccode = mutation['proccode']
+            argIds = json.loads(mutation.get('argumentids', '[]'))
+            argNames = json.loads(mutation.get('argumentnames', '[]'))
+            for argId, name in zip(argIds, argNames):
+                reporter = self._inputBlock(blocks, proto['inputs'].get(argId))
+                if reporter is not None and reporter['opcode'] == 'argument_reporter_boolean':
+                    continue
+                key = ('param', self._targetName, proccode, name)
+                self._procParams[(proccode, argId)] = key
+                self._procParamKeys[(proccode, name)] = key
+                self._initTypes.setdefault(key, None)
+                self._sites.setdefault(key, [])
+                self._paramUses.setdefault(key, set())
+
+    @staticmethod
+    def _inputBlock(blocks, expr):
+        """Return the block in the input expr, or None if it has none."""
+        if isinstance(expr, list) and len(expr) > 1 and isinstance(expr[1], str):
+            block = blocks.get(expr[1])
+            if isinstance(block, dict):
+                return block
+        return None
+
+    def _paramKey(self, blocks, blockId):
+        """Return the key of the parameter that the argument reporter block
+        names, or None if it is not in the definition of a custom block that
+        has one by that name."""
+        # Go up to the top block of the script, noting it for the blocks on the way.
+        path = []
+        topId = blockId
+        while topId not in self._procCodes and len(path) <= len(blocks):
+            path.append(topId)
+            block = blocks.get(topId)
+            parent = block.get('parent') if isinstance(block, dict) else None
+            if parent is None:
+                proccode = None
+                if isinstance(block, dict) and block['opcode'] == 'procedures_definition':
+                    proto = self._inputBlock(blocks, block['inputs'].get('custom_block'))
+                    if proto is not None:
+                        proccode = proto['mutation']['proccode']
+                self._procCodes[topId] = proccode
+                break
+            topId = parent
+        proccode = self._procCodes.get(topId)
+        for b in path:
+            self._procCodes[b] = proccode
+        return self._procParamKeys.get((proccode, blocks[blockId]['fields']['VALUE'][0]))
+
+    @staticmethod
+    def _paramUse(blocks, blockId):
+        """Return how the argument reporter block is used: as a 'number', as
+        'text' or, where either would do, as 'any'."""
+        parent = blocks.get(blocks[blockId].get('parent'))
+        if not isinstance(parent, dict) or parent['opcode'] in \
+                ('operator_lt', 'operator_gt', 'operator_equals', 'procedures_call', 'data_setvariableto'):
+            return 'any'
+        for expr in parent['inputs'].values():
+            if len(expr) > 1 and expr[1] == blockId:
+                # The shadow block under it tells what kind of input it is in.
+                shadow = expr[2] if len(expr) > 2 else None
+                if isinstance(shadow, list) and shadow[0] in (4, 5, 6, 7, 8):
+                    return 'number'
+                return 'text'
+        return 'any'
+
+    @staticmethod
+    def _valueType(value, numeric=False):
+        """Return the type of a variable's initial value or of a literal in a
+        block's input, or None if it could be any type: an empty input is
+        taken to be 0 where a number is expected."""
+        if isinstance(value, bool):
+            return 'Boolean'
+        if isinstance(value, int):
+            return 'Int'
+        if isinstance(value, float):
+            return 'Double'
+        if value == '':
+            return 'Int' if numeric else None
+        try:
+            int(value)
+            return 'Int'
+        except (TypeError, ValueError):
+            pass
+        return 'Double' if isNumericLiteral(value) else 'String'
+
+    @staticmethod
+    def _join(a, b):
+        """Return the narrowest type that holds values of types a and b."""
+        if a is None or a == b:
+            return b
+        if b is None:
+            return a
+        if {a, b} == {'Int', 'Double'}:
+            return 'Double'
+        return 'String'
+
+    def _addNode(self, rule, arg, children):
+        self._nodes.append((rule, arg, children))
+        return len(self._nodes) - 1
+
+    def _exprNode(self, blocks, expr, numeric=False):
+        """Add the nodes for the expression expr, a block's input, and return
+        the one for its value.  Nested reporters are done from a work stack,
+        not by recursion, as they can be nested very deeply."""
+        results = []
+        stack = [(expr, numeric)]
+        while stack:
+            item = stack.pop()
+            if item[0] == 'done':
+                _, rule, arg, numChildren = item
+                children = results[len(results) - numChildren:]
+                del results[len(results) - numChildren:]
+                results.append(self._addNode(rule, arg, children))
+                continue
+            rule, arg, childExprs = self._exprRule(blocks, *item)
+            stack.append(('done', rule, arg, len(childExprs)))
+            # Pushed in reverse, so they are done, and their results are, in order.
+            for childExpr in reversed(childExprs):
+                stack.append((childExpr, rule == 'numeric'))
+        return results[0]
+
+    def _exprRule(self, blocks, expr, numeric):
+        """Return (rule, arg, child expressions) for the value of expr."""
+        value = expr[1] if isinstance(expr, list) and len(expr) > 1 else None
+        if isinstance(value, list):
+            if value[0] == 12:  # a variable
+                return 'var', value[2], []
+            if value[0] == 13:  # a list
+                return 'type', 'String', []
+            return 'type', self._valueType(value[1], numeric), []
+        block = blocks.get(value) if isinstance(value, str) else None
+        if not isinstance(block, dict):
+            return 'type', None, []
+
+        opcode = block['opcode']
+        inputs = block['inputs']
+        if opcode in ('math_number', 'math_positive_number', 'math_whole_number',
+                      'math_integer', 'math_angle', 'text'):
+            return 'type', self._valueType(list(block['fields'].values())[0][0], numeric), []
+        if opcode in ('operator_add', 'operator_subtract', 'operator_multiply', 'operator_mod'):
+            return 'numeric', None, [inputs.get('NUM1'), inputs.get('NUM2')]
+        if opcode == 'operator_random':
+            return 'numeric', None, [inputs.get('FROM'), inputs.get('TO')]
+        if opcode == 'operator_mathop':
+            if block['fields']['OPERATOR'][0] == 'abs':
+                return 'numeric', None, [inputs.get('NUM')]
+            return 'type', 'Double', []
+        if opcode in ('looks_costumenumbername', 'looks_backdropnumbername'):
+            return 'type', 'Int' if block['fields']['NUMBER_NAME'][0] == 'number' else 'String', []
+        if opcode == 'sensing_of':
+            return 'type', SENSING_OF_VALUE_TYPES.get(block['fields']['PROPERTY'][0]), []
+        if opcode == 'argument_reporter_string_number':
+            key = self._paramKey(blocks, value)
+            if key is not None:
+                return 'var', key, []
+        if opcode in REPORTER_VALUE_TYPES:
+            return 'type', REPORTER_VALUE_TYPES[opcode], []
+        # Otherwise, go by the kinds of code there is for the block.
+        for kind, valueType in (('math', 'Double'), ('str', 'String'), ('bool', 'Boolean')):
+            if opcode in SpriteOrStage.getGenCodeTable(kind):
+                return 'type', valueType, []
+        return 'type', None, []
+
+    def _evalNodes(self):
+        """Return the value of each node, given the current variable types."""
+        values = []
+        for rule, arg, children in self._nodes:
+            if rule == 'type':
+                values.append(arg)
+            elif rule == 'var':
+                values.append(self._types.get(arg))
+            else:  # numeric: Int if all of the operands are.
+                # A variable of no type yet does not count, as it gets one
+                # from the others here or not at all.
+                values.append('Int' if all(values[c] == 'Int' or (values[c] is None and self._nodes[c][0] == 'var')
+                                           for c in children) else 'Double')
+        return values
+
+    def getType(self, uniqId):
+        """Return the inferred type of the variable, or None if it has no
+        initial value or value set that tells."""
+        return self._types.get(uniqId)
+
+    def getConflict(self, uniqId):
+        """Return the different kinds of value ('number', 'String' or
+        'Boolean') the variable is given, if more than one, or else None."""
+        return self._conflicts.get(uniqId)
+
+    def getParamType(self, targetName, proccode, name):
+        """Return the inferred type of the number or text parameter of the
+        target's custom block: 'Int', 'Double' or 'String'."""
+        paramType = self._types.get(('param', targetName, proccode, name))
+        return paramType if paramType in ('Int', 'Double') else 'String'
+
+    def getTypes(self):
+        """Return the inferred types of the variables, by unique id."""
+        return {key: t for key, t in self._types.items() if key not in self._paramUses}
+
+
 def getVariableBySpriteAndName(sprite, name):
-    for v in allVars:
-        if v.getOwner() == sprite and v.getName() == name:
-            return v
-    return None
+    return allVars.getBySpriteAndName(sprite, name)
 
 
 def getVariableByUniqueId(id):
-    for v in allVars:
-        if v.getUniqueId() == id:
-            return v
-    return None
+    return allVars.getByUniqueId(id)
+
+
+# Shared by all the Blocks with no inputs, fields or children.  It is
+# read-only, so that it cannot be changed for all of them by mistake.
+NO_ITEMS = MappingProxyType({})
 
 
 class Block:
     """
     This represents a Scratch Block, with its opcode, parent,
     children, inputs, etc.
+    A project can have hundreds of thousands of blocks, so they are kept
+    small: there is no __dict__, the id is the block's position in its
+    sprite's list of blocks instead of Scratch's 20 character id, the
+    opcode is interned, and empty items are shared.
     """
 
+    __slots__ = ('_id', '_opcode', '_inputs', '_fields', '_topLevel', '_next', '_children',
+                 '_procCode', '_procArgIds', '_procDefnParamNames', '_procWarp')
+
     def __init__(self, id, opcode):
         self._id = id
-        self._opcode = opcode
-        self._inputs = {}
-        self._fields = {}
+        self._opcode = sys.intern(opcode)
+        self._inputs = NO_ITEMS
+        self._fields = NO_ITEMS
         self._topLevel = False
         self._next = None
         # dictionary mapping key -> child block.
-        self._children = {}
+        self._children = NO_ITEMS
         # Used for calling a user-defined procedure.
         self._procCode = None
-        self._procArgIds = []
-        self._procDefnParamNames = []
+        self._procArgIds = ()
+        self._procDefnParamNames = ()
+        # True if the procedure runs without screen refresh.
+        self._procWarp = False
 
     def setInputs(self, inputs):
         """inputs are a json object (for now)"""
@@ -333,6 +1066,8 @@ class Block:
     def setChild(self, key, childBlock):
         if key in self._children:
             raise ValueError('block has child with key %s already' % key)
+        if self._children is NO_ITEMS:
+            self._children = {}
         self._children[key] = childBlock
 
     def setProcCode(self, proccode):
@@ -344,6 +1079,10 @@ class Block:
     def setProcDefnParamNames(self, j):
         self._procDefnParamNames = json.loads(j)
 
+    def setProcWarp(self, warp):
+        # warp is usually the string "true" or "false", but may be a bool.
+        self._procWarp = str(warp).lower() == 'true'
+
     def isTopLevel(self):
         return self._topLevel
 
@@ -377,6 +1116,39 @@ class Block:
     def getChild(self, key):
         return self._children[key]
 
+    def getChildren(self):
+        return self._children
+
+    def toTuple(self):
+        """Return this block as a tuple of plain values, in which other
+        blocks are referred to by their ids.  See Block.fromTuples()."""
+        return (self._opcode, self._inputs or {}, self._fields or {}, self._topLevel,
+                self._next._id if self._next is not None else -1,
+                [(key, child._id) for key, child in self._children.items()],
+                self._procCode, self._procArgIds, self._procDefnParamNames, self._procWarp)
+
+    @staticmethod
+    def fromTuples(tuples):
+        """Rebuild the linked blocks from the tuples made by toTuple(), for
+        the blocks with ids 0, 1, 2, ...  Return the list of them."""
+        blocks = []
+        for id, t in enumerate(tuples):
+            block = Block(id, t[0])
+            if t[1]:
+                block._inputs = t[1]
+            if t[2]:
+                block._fields = t[2]
+            block._topLevel = t[3]
+            block._procCode, block._procArgIds, block._procDefnParamNames = t[6], t[7], t[8]
+            block._procWarp = t[9]
+            blocks.append(block)
+        for block, t in zip(blocks, tuples):
+            if t[4] != -1:
+                block._next = blocks[t[4]]
+            for key, childId in t[5]:
+                block.setChild(key, blocks[childId])
+        return blocks
+
     def getProcCode(self):
         return self._procCode
 
@@ -386,6 +1158,9 @@ class Block:
     def getProcDefnParamNames(self):
         return self._procDefnParamNames
 
+    def isProcWarp(self):
+        return self._procWarp
+
     def strWithIndent(self, indentLevel=0):
         res = ("  " * indentLevel) + str(self)
         n = self._next
@@ -398,6 +1173,246 @@ class Block:
         return "BLOCK: " + self._opcode
 
 
+class ExprCache:
+    """The code generated for each reporter block of a sprite, keyed by the
+    block and the kind of expression ('math', 'str' or 'bool'), so that
+    mathExpr(), strExpr() and boolExpr() generate a block's code as each
+    kind only once, whichever of them asks for it.  genReporterCode() fills
+    it from the innermost reporters out before the statements are
+    generated.  The hits and misses are reported with -v."""
+
+    def __init__(self):
+        self._code = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, block, kind):
+        """Return the code for block as the given kind, or None."""
+        code = self._code.get((block.getId(), kind))
+        if code is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return code
+
+    def put(self, block, kind, code):
+        """Remember and return the code for block as the given kind."""
+        if code is not None:
+            self._code[(block.getId(), kind)] = code
+        return code
+
+    def __contains__(self, key):
+        """key is (block id, kind)."""
+        return key in self._code
+
+    def clear(self):
+        self._code.clear()
+        self.hits = self.misses = 0
+
+    def __str__(self):
+        return "Expression cache: %d hits, %d misses" % (self.hits, self.misses)
+
+
+# The kinds of blocks that code is generated for, and the arguments (after
+# self) of the SpriteOrStage methods that generate it:
+#   'stmt': (level, block, deferYield), returns the code for the statement.
+#   'compound': (out, level, block, deferYield), writes the code for the
+#       statement, which holds lists of statements, to out, a CodeEmitter.
+#   'hat':  (codeObj, topBlock), adds the code for the script to codeObj.
+#   'math', 'str', 'bool': (block), returns the code for the reporter block
+#       as an expression of that type.
+GEN_CODE_KINDS = ('stmt', 'compound', 'hat', 'math', 'str', 'bool')
+
+
+# Java operators for the Scratch binary operator blocks.
+COMPARISON_OPS = {'operator_lt': ' < ', 'operator_gt': ' > ', 'operator_equals': ' == '}
+BOOLEAN_OPS = {'operator_and': ' && ', 'operator_or': ' || '}
+ARITHMETIC_OPS = {'operator_add': ' + ', 'operator_subtract': ' - ',
+                  'operator_multiply': ' * ', 'operator_divide': ' / '}
+
+# How tightly each of those binds in Java.
+ARITHMETIC_PRECEDENCE = {'operator_add': 1, 'operator_subtract': 1,
+                         'operator_multiply': 2, 'operator_divide': 2}
+
+# Java int and double literals, as generated for Scratch's numbers.  (A
+# leading 0 would make an int octal.)
+JAVA_INT_LITERAL = re.compile(r'-?(0|[1-9][0-9]*)$')
+JAVA_DOUBLE_LITERAL = re.compile(r'-?(([0-9]+\.[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?|[0-9]+[eE][-+]?[0-9]+)$')
+JAVA_INT_MIN, JAVA_INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def parseJavaNumber(code):
+    """If the generated code is just an int or double literal, return its
+    value as an int or float, else None."""
+    if JAVA_INT_LITERAL.match(code):
+        val = int(code)
+        return val if JAVA_INT_MIN <= val <= JAVA_INT_MAX else None
+    if JAVA_DOUBLE_LITERAL.match(code):
+        val = float(code)
+        return val if math.isfinite(val) else None
+    return None
+
+
+def javaNumber(val):
+    """Return the Java literal for val, an int or float (the same type in
+    Java), or None if val is None or has no literal."""
+    if isinstance(val, int):
+        return str(val) if JAVA_INT_MIN <= val <= JAVA_INT_MAX else None
+    if isinstance(val, float) and math.isfinite(val):
+        return repr(val)    # the shortest literal that reads back as val.
+    return None
+
+
+def foldArithmetic(opcode, a, b):
+    """Return the value that Java computes for a (opcode) b, given the
+    values of two literals, or None if either is not a literal or the
+    result is not the same in Scratch."""
+    if a is None or b is None:
+        return None
+    if opcode == 'operator_add':
+        return a + b
+    elif opcode == 'operator_subtract':
+        return a - b
+    elif opcode == 'operator_multiply':
+        return a * b
+    elif b == 0:
+        return None
+    elif isinstance(a, int) and isinstance(b, int):
+        # Java's int division truncates, and Scratch's does not: only fold
+        # it when both agree.
+        return a // b if a % b == 0 else None
+    return a / b
+
+
+def foldMathOp(mathop, a):
+    """Return the value of the operator_mathop block's Java code for the
+    literal value a, or None if it is not folded.  sin, etc., are not folded
+    as Scratch's take degrees and Java's radians, nor are ln, log and e ^ as
+    Java only promises those to within the last bit."""
+    if a is None:
+        return None
+    if mathop == "abs":
+        return abs(a)
+    elif mathop in ("floor", "ceiling"):
+        val = float(math.floor(a) if mathop == "floor" else math.ceil(a))
+        # Java's, unlike Python's, keep the sign of a zero result, e.g.,
+        # Math.ceil(-0.5) is -0.0.
+        return math.copysign(val, a) if val == 0 else val
+    elif mathop == "sqrt" and a >= 0:
+        return math.sqrt(a)
+    elif mathop == "10 ^" and isinstance(a, int) and 0 <= a <= 22:
+        # Exactly representable, so Math.pow() is exact too.
+        return float(10 ** a)
+    return None
+
+
+# Java functions for the operator_mathop block's OPERATOR field.
+MATHOP_FUNCS = {
+    "abs": "Math.abs(",
+    "floor": "Math.floor(",
+    "ceiling": "Math.ceil(",
+    "sqrt": "Math.sqrt(",
+    "sin": "Math.sin(",
+    "cos": "Math.cos(",
+    "tan": "Math.tan(",
+    "asin": "Math.asin(",
+    "acos": "Math.acos(",
+    "atan": "Math.atan(",
+    "ln": "Math.log(",
+    "log": "Math.log10(",
+    "e ^": "Math.exp(",
+    "10 ^": "Math.pow(10, "
+}
+
+# Math reporter blocks whose code is always the same.
+MATH_CONSTANT_REPORTERS = {
+    'motion_xposition': 'getX()',
+    'motion_yposition': "getY()",
+    'motion_direction': "getDirection()",
+    "looks_size": "size()",
+    # this will produce uncompileable Java code... but if you try this kind of
+    # thing, you are kind of asking for it...
+    "sensing_mousedown": " (int) isMouseDown()",
+    "sensing_mousex": "getMouseX()",
+    'sensing_mousey': "getMouseY()",
+    "sensing_timer": "getTimer()",
+    "sensing_dayssince2000": "daysSince2000()",
+}
+
+# The type of the value of reporter blocks whose code is always of the same
+# java type, for VariableTypes.
+REPORTER_VALUE_TYPES = {
+    'motion_xposition': 'Int',
+    'motion_yposition': 'Int',
+    'motion_direction': 'Int',
+    'looks_size': 'Double',
+    'sensing_mousedown': 'Boolean',
+    'sensing_mousex': 'Int',
+    'sensing_mousey': 'Int',
+    'sensing_timer': 'Double',
+    'sensing_dayssince2000': 'Double',
+    'sensing_current': 'Int',
+    'sensing_distanceto': 'Int',
+    'operator_divide': 'Double',
+    'operator_round': 'Int',
+    'operator_length': 'Int',
+    'data_lengthoflist': 'Int',
+    # A custom block's parameter outside its definition.
+    'argument_reporter_string_number': None,
+}
+
+# The java type of a custom block's parameter, by the type VariableTypes
+# infers for it.
+JAVA_PARAM_TYPES = {'Int': 'int', 'Double': 'double', 'String': 'String'}
+
+# The properties that the sensing "of" block reports about a sprite or the
+# stage, and their types.  Any other property is a variable.
+SENSING_OF_VALUE_TYPES = {
+    'x position': 'Int', 'y position': 'Int', 'direction': 'Int', 'costume #': 'Int',
+    'backdrop #': 'Int', 'volume': 'Int', 'size': 'Double',
+    'costume name': 'String', 'backdrop name': 'String',
+}
+
+# Blocks that wait or let other sequences run, so that a loop containing
+# them must not yield less often than Scratch does.
+YIELDING_OPCODES = frozenset((
+    'control_forever', 'control_repeat', 'control_repeat_until', 'control_wait',
+    'control_wait_until', 'event_broadcastandwait', 'sensing_askandwait',
+    'motion_glideto', 'motion_glidesecstoxy', 'looks_sayforsecs', 'looks_thinkforsecs',
+    'looks_switchbackdroptoandwait', 'sound_playuntildone', 'music_playDrumForBeats',
+    'music_playNoteForBeats', 'music_restForBeats', 'procedures_call',
+))
+
+# The blocks that compiling a script to a state machine handles itself
+# (see SpriteOrStage.genSteppedStmt()): the others in YIELDING_OPCODES
+# need a Sequence thread, so scripts using them are not compiled so.
+STEPPED_OPCODES = frozenset((
+    'control_forever', 'control_repeat', 'control_repeat_until', 'control_wait',
+    'control_wait_until', 'control_if', 'control_if_else', 'control_stop',
+    'control_delete_this_clone',
+))
+
+# Reporter blocks whose value changes with time or user input, so that a
+# loop reading them must see it change as often as in Scratch.  Menus
+# naming the mouse pointer ("_mouse_") count too.
+INPUT_STATE_OPCODES = frozenset((
+    'sensing_timer', 'sensing_current', 'sensing_dayssince2000', 'sensing_mousedown',
+    'sensing_mousex', 'sensing_mousey', 'sensing_keypressed',
+))
+
+
+def genCodeFor(kind, *opcodes):
+    """Decorator that marks a SpriteOrStage method as the one that
+    generates code for blocks of the given kind with any of the given
+    opcodes.  See SpriteOrStage.getGenCodeTable()."""
+    assert kind in GEN_CODE_KINDS, kind
+
+    def mark(func):
+        func.genCodeFor = getattr(func, 'genCodeFor', ()) + tuple((kind, opcode) for opcode in opcodes)
+        return func
+    return mark
+
+
 class SpriteOrStage:
     """This is an abstract class that represents either a Stage class or
     Sprite class to be generated in Java.  The two are the same for
@@ -418,15 +1433,15 @@ class SpriteOrStage:
 
         self._fileHeaderCode = ""
         self._worldCtorCode = ""
-        self._ctorCode = ""
-        # The next 3 code strings are written into the constructor.
-        self._regCallbacksCode = ""
+        # The next 3 are written into the constructor.
+        self._regCallbacksCode = CodeEmitter()
         self._costumeCode = ""
         self._initSettingsCode = ""
 
         self._varDefnCode = ""
-        self._cbCode = []
-        self._addedToWorldCode = ""
+        # These are written after the constructor, but generated before it.
+        self._cbCode = CodeEmitter()
+        self._addedToWorldCode = CodeEmitter()
 
         # Remember if we've generated code for a copy constructor
         # so that we don't do it multiple times.
@@ -441,10 +1456,71 @@ class SpriteOrStage:
         self.varInfo = {}
         self.listInfo = {}
 
+        # Code generated for this sprite's reporter blocks.
+        self._exprCache = ExprCache()
+
+        # How many statements() calls are in progress, and the statement
+        # lists they left to be generated afterwards.
+        self._stmtNesting = 0
+        self._deferredStmts = []
+
+        # The proccodes of the custom blocks defined to run without screen
+        # refresh, and of the other custom blocks called from those.
+        self._warpProcs = set()
+        self._procsCalledInWarp = set()
+
+        # The java type of each parameter of each custom block, by proccode,
+        # and of the parameter that each argument reporter in a custom
+        # block's definition gets, by block id.  See findProcParamTypes().
+        self._procParamTypes = {}
+        self._argReporterTypes = {}
+
+        # The class names of the other sprites this one refers to by name,
+        # in the order first referred to.  See genSpriteRefsCode().
+        self._spriteRefs = []
+
         print("\n----------- Sprite: %s ----------------" % self._name)
 
-    def copySounds(self, soundsDir):
-        # Move all of this sprites sounds to project/sounds/[spritename]
+    @classmethod
+    def getGenCodeTable(cls, kind):
+        """Return a dictionary mapping opcode -> the function that generates
+        code for blocks of that kind (see GEN_CODE_KINDS) and opcode.  It is
+        built once per class from the methods marked with @genCodeFor, so a
+        subclass that overrides one of those methods gets its own version."""
+        tables = cls.__dict__.get('_genCodeTables')
+        if tables is None:
+            tables = {k: {} for k in GEN_CODE_KINDS}
+            for klass in reversed(cls.__mro__):
+                for name, attr in vars(klass).items():
+                    for k, opcode in getattr(attr, 'genCodeFor', ()):
+                        tables[k][opcode] = getattr(cls, name)
+            cls._genCodeTables = tables
+        return tables[kind]
+
+    @classmethod
+    def registerGenCode(cls, kind, *opcodes):
+        """Decorator that adds a function as a method of this class that
+        generates code for blocks of the given kind and opcodes, e.g., to
+        support an extension's blocks:
+
+            @SpriteOrStage.registerGenCode('stmt', 'videoSensing_videoToggle')
+            def videoToggle(self, level, block, deferYield=False):
+                return genIndent(level) + "// video is not supported\\n"
+        """
+        def register(func):
+            setattr(cls, func.__name__, genCodeFor(kind, *opcodes)(func))
+            # Rebuild the tables of this class and its subclasses when next used.
+            classes = [cls]
+            while classes:
+                klass = classes.pop()
+                if '_genCodeTables' in klass.__dict__:
+                    del klass._genCodeTables
+                classes.extend(klass.__subclasses__())
+            return func
+        return register
+
+    def copySounds(self, soundsDir, archive):
+        # Copy all of this sprites sounds out of the .sb3 archive to project/sounds/[spritename]
         if 'sounds' in self._sprData:
             if not os.path.exists(os.path.join(soundsDir, self.getName())):
                 os.makedirs(os.path.join(soundsDir, self.getName()))
@@ -453,8 +1529,9 @@ class SpriteOrStage:
                 id = sound['assetId']
                 if sound['format'] == 'adpcm':
                     print("Warning: Sound is in adpcm format and will not work:", soundName)
-                shutil.copyfile(os.path.join(PROJECT_DIR, SCRATCH_PROJ_DIR, str(id) + '.wav'),
-                                os.path.join(soundsDir, self.getName(), soundName + '.wav'))
+                with archive.openMember(str(id) + '.wav') as src, \
+                        open(os.path.join(soundsDir, self.getName(), soundName + '.wav'), 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
 
     def getName(self):
         return self._name
@@ -469,6 +1546,7 @@ class SpriteOrStage:
         Otherwise, returns a tuple: (clean name, varType)"""
         return self.listInfo.get(name)
 
+    @genCodeFor('hat', 'event_whenthisspriteclicked')
     def whenClicked(self, codeObj, block):
         raise NotImplementedError('Implemented in subclass')
 
@@ -490,19 +1568,18 @@ class SpriteOrStage:
         self._fileHeaderCode += " */\n"
         self._fileHeaderCode += "public class " + self._name + " extends Scratch\n{\n"
 
-    def genConstructorCode(self):
-        """Generate code for the constructor.
+    def genConstructorCode(self, out):
+        """Write the code for the constructor to out, a CodeEmitter.
         This code will include calls to initialize data, etc., followed by code
         to register callbacks for whenFlagClicked,
         whenKeyPressed, etc.
         """
-        self._ctorCode = genIndent(1) + "public " + self._name + "()\n"
-
-        self._ctorCode += genIndent(1) + "{\n"
-        self._ctorCode += self._costumeCode
-        self._ctorCode += self._initSettingsCode
-        self._ctorCode += self._regCallbacksCode
-        self._ctorCode += genIndent(1) + "}\n"
+        out.writeLine(1, "public " + self._name + "()")
+        out.writeLine(1, "{")
+        out.write(self._costumeCode)
+        out.write(self._initSettingsCode)
+        self._regCallbacksCode.copyTo(out)
+        out.writeLine(1, "}")
 
     def genVariablesDefnCode(self, varsObjects, listsObjects, allChildren, cloudVars):
         """Generate code to define instance variables for this sprite.
@@ -559,6 +1636,7 @@ class SpriteOrStage:
             """Generate code to define instance variables for this sprite.
             Uses a tkinter GUI to simplify the process
             """
+            importTkinter()
             nameList = []
             typeList = []
             valueList = []
@@ -730,13 +1808,13 @@ class SpriteOrStage:
                         value = '"' + re.sub('"', '\\"', value) + '"'
 
                     # Something like "score = createIntVariable((MyWorld) world, "score", 0);
-                    self._addedToWorldCode += '%s%s = create%sVariable((%s) world, "%s", %s);\n' % \
-                                              (genIndent(2), sanname, varType, worldClassName, label, str(value))
+                    self._addedToWorldCode.write('%s%s = create%sVariable((%s) world, "%s", %s);\n' % \
+                                                  (genIndent(2), sanname, varType, worldClassName, label, str(value)))
                     if not visible:
-                        self._addedToWorldCode += genIndent(2) + sanname + ".hide();\n"
+                        self._addedToWorldCode.write(genIndent(2) + sanname + ".hide();\n")
                 # Add blank line after variable definitions.
                 self._varDefnCode += "\n"
-                self._addedToWorldCode += genIndent(2) + "// List initializations.\n"
+                self._addedToWorldCode.write(genIndent(2) + "// List initializations.\n")
                 for l in listOfLists:
                     name = l['listName']
                     contents = l['contents']
@@ -756,16 +1834,16 @@ class SpriteOrStage:
                     else:
                         self._varDefnCode += genIndent(1) + "ScratchList %s;\n" % (sanname)
 
-                    self._addedToWorldCode += '%s%s = createList(world, "%s"' % (genIndent(2), sanname, name)
+                    self._addedToWorldCode.write('%s%s = createList(world, "%s"' % (genIndent(2), sanname, name))
                     for obj in contents:
                         disp = deriveType(name, obj)
-                        self._addedToWorldCode += ', %s' % (str(disp[0]))
-                    self._addedToWorldCode += ');\n'
+                        self._addedToWorldCode.write(', %s' % (str(disp[0])))
+                    self._addedToWorldCode.write(');\n')
                     if not visible:
-                        self._addedToWorldCode += '%s%s.hide();\n' % (genIndent(2), sanname)
+                        self._addedToWorldCode.write('%s%s.hide();\n' % (genIndent(2), sanname))
 
                 # Close the addedToWorld() method definition.
-                self._addedToWorldCode += genIndent(1) + "}\n"
+                self._addedToWorldCode.write(genIndent(1) + "}\n")
                 # Return focus and execution back to the main window
                 root.focus_set()
                 gui.quit()
@@ -826,9 +1904,20 @@ class SpriteOrStage:
             keypress()
             gui.mainloop()
 
-        def chooseType(name, val):
-            i, typechosen = deriveType(name, val)
-            while not inference:
+        def chooseType(name, val, uniqId):
+            # The type inferred from the values the scripts give the
+            # variable, or else from its initial value.  The user is only
+            # asked when it is given both numbers and text, say.
+            inferredType = variableTypes.getType(uniqId)
+            if inferredType is None:
+                i, typechosen = deriveType(name, val)
+            else:
+                typechosen = inferredType
+            conflict = variableTypes.getConflict(uniqId)
+            if conflict:
+                print("Warning: variable \"%s\" is given %s values: it looks like a %s." %
+                      (name, " and ".join(conflict), typechosen))
+            while not inference and conflict:
                 try:
                     print("\n\nWhat type of variable should \"" + name + "\": " + str(val) + " be?")
                     theType = input("\tInt: A number that won't have decimals\n\tDouble:" +
@@ -860,7 +1949,21 @@ class SpriteOrStage:
                             return 0.0, 'Double'
                         elif theType[0] == 'S':
                             return '""', "String"
-            return deriveType(name, val)
+            if inferredType is None:
+                return deriveType(name, val)
+            return convertValue(val, inferredType)
+
+        def convertValue(val, varType):
+            """Return the initial value val converted to java code for the given type."""
+            if varType == 'Boolean':
+                return ("true" if str(val).lower() == "true" else "false"), 'Boolean'
+            if varType in ('Int', 'Double'):
+                # Like Scratch, take text that is not a number to be 0.
+                f = float(val) if isNumericLiteral(val) and math.isfinite(float(val)) else 0
+                return (int(f), 'Int') if varType == 'Int' else (float(f), 'Double')
+            if isinstance(val, bool):
+                val = str(val).lower()
+            return json.dumps(str(val)), 'String'
 
         def deriveType(name, val):
             if isinstance(val, str):
@@ -908,12 +2011,12 @@ class SpriteOrStage:
         # Initialization goes into the method addedToWorld() for Sprites, but
         # into the ctor for World.
         #
-        self._addedToWorldCode += "\n" + genIndent(1) + "private " + worldClassName + " world;"
-        self._addedToWorldCode += "\n" + genIndent(1) + "public void addedToWorld(World w)\n"
-        self._addedToWorldCode += genIndent(1) + "{\n"
-        self._addedToWorldCode += genIndent(2) + "world = (" + worldClassName + ") w;\n"
-        self._addedToWorldCode += genIndent(2) + "super.addedToWorld(w);\n"
-        self._addedToWorldCode += genIndent(2) + "// Variable initializations.\n"
+        self._addedToWorldCode.write("\n" + genIndent(1) + "private " + worldClassName + " world;")
+        self._addedToWorldCode.write("\n" + genIndent(1) + "public void addedToWorld(World w)\n")
+        self._addedToWorldCode.write(genIndent(1) + "{\n")
+        self._addedToWorldCode.write(genIndent(2) + "world = (" + worldClassName + ") w;\n")
+        self._addedToWorldCode.write(genIndent(2) + "super.addedToWorld(w);\n")
+        self._addedToWorldCode.write(genIndent(2) + "// Variable initializations.\n")
         # If running in gui mode, call the gui method instead
         if useGui:
             genVariablesDefnCodeGui(varsObjects, listsObjects, allChildren, cloudVars)
@@ -927,6 +2030,9 @@ class SpriteOrStage:
             # return the varType and the value converted to a java equivalent
             # for that type. (e.g., False --> false)
             # varType is one of 'Boolean', 'Double', 'Int', 'String'
+            # The type and name chosen for the variable when this project was
+            # converted before, if any.
+            choice = parsedProject.getVarChoice(self._name, var.getUniqueId())
             if cloud:  # TODO: this is always False for now.
                 value = cloudVars
                 cloudVars += 1
@@ -934,22 +2040,27 @@ class SpriteOrStage:
                 # The first character is a weird Unicode cloud glyph and the
                 # second is a space.  Get rid of them.
                 name = name[2:]
+            elif choice is not None:
+                value, varType, sanname = choice
             else:
-                value, varType = chooseType(name, value)
+                value, varType = chooseType(name, value, var.getUniqueId())
 
             var.setType(varType)
 
             # Sanitize the name: make it a legal Java identifier.
-            try:
-                if name_resolution:
-                    sanname = convertToJavaId(name)
-                elif not convertToJavaId(name) == name:
-                    sanname = self.resolveName(name)
-                else:
-                    sanname = convertToJavaId(name)
-            except:
-                print("Error converting variable to java id")
-                sys.exit(0)
+            if choice is None:
+                try:
+                    if name_resolution:
+                        sanname = convertToJavaId(name)
+                    elif not convertToJavaId(name) == name:
+                        sanname = self.resolveName(name)
+                    else:
+                        sanname = convertToJavaId(name)
+                except:
+                    print("Error converting variable to java id")
+                    sys.exit(0)
+                if not cloud:
+                    parsedProject.setVarChoice(self._name, var.getUniqueId(), (value, varType, sanname))
 
             var.setGfName(sanname)
             self.setVariableIsLocalOrGlobal(var)
@@ -989,14 +2100,14 @@ class SpriteOrStage:
             self._varDefnCode += self.genVarDefnCode(1, var)
 
             # Something like "score = createIntVariable((MyWorld) world, "score", 0);
-            self._addedToWorldCode += '%s%s = create%sVariable((%s) world, "%s", %s);\n' % \
-                                      (genIndent(2), sanname, varType, worldClassName, name, str(value))
+            self._addedToWorldCode.write('%s%s = create%sVariable((%s) world, "%s", %s);\n' % \
+                                          (genIndent(2), sanname, varType, worldClassName, name, str(value)))
             # if not visible:
-            #     self._addedToWorldCode += genIndent(2) + sanname + ".hide();\n"
+            #     self._addedToWorldCode.write(genIndent(2) + sanname + ".hide();\n")
 
         # Add blank line after variable definitions.
         self._varDefnCode += "\n"
-        self._addedToWorldCode += genIndent(2) + "// List initializations.\n"
+        self._addedToWorldCode.write(genIndent(2) + "// List initializations.\n")
 
         theseVars = [Variable(varId, listsObjects[varId]) for varId in listsObjects]
 
@@ -1015,25 +2126,58 @@ class SpriteOrStage:
 
             self._varDefnCode += self.genListDefnCode(1, alist)
 
-            self._addedToWorldCode += '%s%s = createList(world, "%s"' % (genIndent(2), sanname, name)
+            self._addedToWorldCode.write('%s%s = createList(world, "%s"' % (genIndent(2), sanname, name))
             for obj in contents:
                 # use deriveType to convert to an Int or Double or Boolean, etc.
                 convertedVal, valType = deriveType(name, obj)
-                self._addedToWorldCode += ', %s' % str(convertedVal)
-            self._addedToWorldCode += ');\n'
+                self._addedToWorldCode.write(', %s' % str(convertedVal))
+            self._addedToWorldCode.write(');\n')
 
             # TODO: not supported in scratch 3.0 downloaded file yet.
             # if not visible:
-            #     self._addedToWorldCode += '%s%s.hide();\n' % (genIndent(2), sanname)
+            #     self._addedToWorldCode.write('%s%s.hide();\n' % (genIndent(2), sanname))
 
         # Close the addedToWorld() method definition.
-        self._addedToWorldCode += genIndent(1) + "}\n"
+        self._addedToWorldCode.write(genIndent(1) + "}\n")
 
     def getVarDefnCode(self):
         return self._varDefnCode
 
-    def getAddedToWorldCode(self):
-        return self._addedToWorldCode
+    def spriteExpr(self, block, exprKey):
+        """Generate code for the sprite chosen in a menu, as the argument of a
+        call like isTouching() or goTo().  A sprite chosen by name is got from
+        a field (see genSpriteRefsCode()), not looked up by name each time the
+        code runs.  Otherwise, the code is for the name of the sprite, which is
+        looked up when it runs."""
+        child = block.getChild(exprKey)
+        if not child.hasField(exprKey):
+            return self.strExpr(block, exprKey)
+        name = child.getField(exprKey)
+        className = spriteClassNames.get(name)
+        if className is None:
+            return '"' + name + '"'
+        if className not in self._spriteRefs:
+            self._spriteRefs.append(className)
+        return "getSprite" + className + "()"
+
+    def genSpriteRefsCode(self):
+        """Generate the fields that hold the sprites this one refers to by
+        name, and the methods that get them.  A sprite is looked up the first
+        time it is used, as the sprites are not all in the world yet when
+        this one's addedToWorld() is called."""
+        code = ""
+        for className in self._spriteRefs:
+            if code:
+                code += "\n"
+            code += genIndent(1) + "private %s sprite%s;\n" % (className, className)
+            code += genIndent(1) + "private %s getSprite%s()\n" % (className, className)
+            code += genIndent(1) + "{\n"
+            code += genIndent(2) + "if (sprite%s == null) {\n" % className
+            code += genIndent(3) + 'sprite%s = (%s) getWorld().getActorByName("%s");\n' % (className, className, className)
+            code += genIndent(2) + "}\n"
+            code += genIndent(2) + "return sprite%s;\n" % className
+            code += genIndent(1) + "}\n"
+        return code
 
     def genCodeForScripts(self):
         # The value of the 'blocks' key is the list of the scripts.  It may be a
@@ -1051,12 +2195,15 @@ class SpriteOrStage:
             print(b.strWithIndent())
             print()
 
+        # The block ids are only unique within this sprite.
+        self._exprCache.clear()
+        self.findProcParamTypes(blocks)
+        self.genReporterCode(blocks)
+        self.findWarpProcs(blocks)
         for topBlock in blocks:
-            codeObj = self.genScriptCode(topBlock)
-            self._regCallbacksCode += codeObj.code
-            if codeObj.cbCode != "":
-                # The script generate callback code.
-                self._cbCode.append(codeObj.cbCode)
+            self.genScriptCode(topBlock)
+        if debug:
+            print(self._name + ":", self._exprCache)
 
     def genBlocksList(self, blocksJson):
         """
@@ -1096,13 +2243,29 @@ class SpriteOrStage:
         #     },
         #     ... etc ...
 
-        allBlocks = {}  # Map of blockId to Block object.
+        cached = parsedProject.getBlocks(self._name)
+        if cached is not None:
+            print("Using cached block graph for", self._name)
+            allBlocks = Block.fromTuples(cached)
+            return [block for block in allBlocks if block.isTopLevel()]
+
+        # Only blocks in scripts that start with a hat block are ever run,
+        # so don't make Blocks for any others.
+        reachable = self.findReachableBlocks(blocksJson)
+        if len(reachable) < len(blocksJson):
+            print("Dropped %d blocks of %s that are not in a script with a hat block" %
+                  (len(blocksJson) - len(reachable), self._name))
+        blocksJson = {blockId: vals for blockId, vals in blocksJson.items() if blockId in reachable}
+
+        # Each Block's id is its position in allBlocks: map the Scratch
+        # block ids to those.
+        blockIds = {blockId: id for id, blockId in enumerate(blocksJson)}
+        allBlocks = []
 
         # Create all the block objects first
-        for blockId in blocksJson:
-            vals = blocksJson[blockId]
-            block = Block(blockId, vals['opcode'])
-            allBlocks[blockId] = block
+        for blockId, vals in blocksJson.items():
+            block = Block(blockIds[blockId], vals['opcode'])
+            allBlocks.append(block)
             # print('adding block with id to collection', blockId, vals['opcode'])
             if vals['inputs']:
                 block.setInputs(vals['inputs'])
@@ -1117,14 +2280,15 @@ class SpriteOrStage:
                     block.setProcCallArgIds(vals['mutation']['argumentids'])
                 if 'argumentnames' in vals['mutation']:
                     block.setProcDefnParamNames(vals['mutation']['argumentnames'])
+                if 'warp' in vals['mutation']:
+                    block.setProcWarp(vals['mutation']['warp'])
 
         # Link the blocks together.
-        for blockId in blocksJson:
-            blockJson = blocksJson[blockId]
-            block = allBlocks[blockId]
+        for block, blockJson in zip(allBlocks, blocksJson.values()):
             if blockJson['next'] != None:
-                nextBlock = allBlocks[blockJson['next']]
-                print('setting next block of %s to be %s' % (str(block), str(nextBlock)))
+                nextBlock = allBlocks[blockIds[blockJson['next']]]
+                if debug:
+                    print('setting next block of %s to be %s' % (str(block), str(nextBlock)))
                 block.setNext(nextBlock)
             inputs = blockJson['inputs']
             for inputKey in inputs:
@@ -1144,166 +2308,202 @@ class SpriteOrStage:
                 #     "50"
                 #   ]
                 # ]
-                if isinstance(inputs[inputKey][1], str) and inputs[inputKey][1] in allBlocks:
-                    block.setChild(inputKey, allBlocks[inputs[inputKey][1]])
-                    print('setting child block of %s with key %s to %s' %
-                          (str(block), inputKey, str(allBlocks[inputs[inputKey][1]])))
+                childId = blockIds.get(inputs[inputKey][1]) if isinstance(inputs[inputKey][1], str) else None
+                if childId is not None:
+                    block.setChild(inputKey, allBlocks[childId])
+                    if debug:
+                        print('setting child block of %s with key %s to %s' %
+                              (str(block), inputKey, str(allBlocks[childId])))
+
+        parsedProject.setBlocks(self._name, allBlocks)
 
-        listOfTopLevelBlocks = [block for block in allBlocks.values() if block.isTopLevel()]
+        listOfTopLevelBlocks = [block for block in allBlocks if block.isTopLevel()]
         return listOfTopLevelBlocks
 
+    def findReachableBlocks(self, blocksJson):
+        """Return the set of ids of the blocks in blocksJson that are in,
+        or are inputs to blocks in, a script that starts with a hat block
+        that code is generated for (see genScriptCode()).  Others, e.g.,
+        loose blocks left lying around, are never run."""
+        hatOpcodes = self.getGenCodeTable('hat')
+        # Loose variable and list reporters are lists, not dictionaries.
+        stack = [blockId for blockId, vals in blocksJson.items()
+                 if isinstance(vals, dict) and vals['topLevel'] and vals['opcode'] in hatOpcodes]
+        reachable = set(stack)
+        while stack:
+            vals = blocksJson[stack.pop()]
+            linked = [vals['next']] + [inp[1] for inp in vals['inputs'].values() if isinstance(inp[1], str)]
+            for blockId in linked:
+                if blockId in blocksJson and blockId not in reachable:
+                    reachable.add(blockId)
+                    stack.append(blockId)
+        return reachable
+
+    def findProcParamTypes(self, topBlocks):
+        """Find the java type of each parameter of the custom blocks defined
+        in topBlocks, from the types that VariableTypes inferred, and the
+        type of the parameter that each argument reporter in their
+        definitions gets."""
+        self._procParamTypes = {}
+        self._argReporterTypes = {}
+        for topBlock in topBlocks:
+            if topBlock.getOpcode() != 'procedures_definition' or not topBlock.hasChild('custom_block'):
+                continue
+            proto = topBlock.getChild('custom_block')
+            proccode = proto.getProcCode()
+            paramTypes = {}
+            for kind, name in zip(self.extractInfoFromProcCode(proto)[1], proto.getProcDefnParamNames()):
+                if kind == 'boolean':
+                    paramTypes[name] = 'boolean'
+                else:
+                    paramTypes[name] = JAVA_PARAM_TYPES[variableTypes.getParamType(self._sprData['name'],
+                                                                                   proccode, name)]
+            self._procParamTypes[proccode] = [paramTypes[name] for name in proto.getProcDefnParamNames()]
+
+            stack = [topBlock.getNext()]
+            while stack:
+                block = stack.pop()
+                if block is None:
+                    continue
+                if block.getOpcode() == 'argument_reporter_string_number':
+                    self._argReporterTypes[block.getId()] = paramTypes.get(block.getField('VALUE'), 'String')
+                stack.append(block.getNext())
+                stack.extend(block.getChildren().values())
+        if debug and self._procParamTypes:
+            print("Custom block parameter types:", self._procParamTypes)
+
+    def findWarpProcs(self, topBlocks):
+        """Find the custom blocks defined to run without screen refresh
+        (warp), and the other custom blocks that those call, directly or
+        not.  As in Scratch, a custom block called from a warp one runs
+        without screen refresh too, so it needs a second version of its
+        code for that."""
+        procDefns = {}
+        for topBlock in topBlocks:
+            if topBlock.getOpcode() == 'procedures_definition' and topBlock.hasChild('custom_block'):
+                procDefns[topBlock.getChild('custom_block').getProcCode()] = topBlock
+        self._warpProcs = {proccode for proccode, topBlock in procDefns.items()
+                           if topBlock.getChild('custom_block').isProcWarp()}
+        self._procsCalledInWarp = set()
+
+        # Walk the bodies of the warp custom blocks, and of the ones they call.
+        stack = [procDefns[proccode].getNext() for proccode in self._warpProcs]
+        while stack:
+            block = stack.pop()
+            if block is None:
+                continue
+            proccode = block.getProcCode()
+            if block.getOpcode() == 'procedures_call' and proccode in procDefns and \
+                    proccode not in self._warpProcs and proccode not in self._procsCalledInWarp:
+                self._procsCalledInWarp.add(proccode)
+                stack.append(procDefns[proccode].getNext())
+            stack.append(block.getNext())
+            stack.extend(block.getChildren().values())
+        if debug and (self._warpProcs or self._procsCalledInWarp):
+            print("Custom blocks that run without screen refresh:",
+                  sorted(self._warpProcs), sorted(self._procsCalledInWarp))
+
     def writeCodeToFile(self):
 
         # Open file with correct name and generate code into there.
         filename = os.path.join(PROJECT_DIR, convertSpriteToFileName(self._name))
         print("Writing code to " + filename + ".")
-        outFile = open(filename, "w")
-        self.genHeaderCode()
-        outFile.write(self._fileHeaderCode)
-
-        outFile.write(self._varDefnCode)
-
-        self.genConstructorCode()
-        outFile.write(self._ctorCode)
-
-        for code in self._cbCode:
-            outFile.write(code)
-
-        outFile.write(self._addedToWorldCode)
-
-        outFile.write("}\n")
-        outFile.close()
-
-    def topBlock(self, level, topBlock, deferYield=False):
-        """Handle a top block containing a list of statements wrapped in { }."""
-        return genIndent(level) + "{\n" + self.statements(level, topBlock.getNext(), deferYield) + \
-               genIndent(level) + "}\n"
-
-    def block(self, level, block, deferYield=False):
-        """Handle a block that is the first in a list of statements wrapped in { }."""
-        return genIndent(level) + "{\n" + self.statements(level, block, deferYield) + \
-               genIndent(level) + "}\n"
-
-    def statements(self, level, firstBlock, deferYield=False):
-        """Generate code for the list of statements, by repeatedly calling stmt(), 
-        following the chain of next pointers from the firstBlock."""
+        with open(filename, "w", buffering=OUTPUT_BUFFER_BYTES) as outFile:
+            out = CodeEmitter(outFile)
+            self.genHeaderCode()
+            out.write(self._fileHeaderCode)
+
+            out.write(self._varDefnCode)
+
+            self.genConstructorCode(out)
+
+            self._cbCode.copyTo(out)
+            out.write(self.genSpriteRefsCode())
+
+            self._addedToWorldCode.copyTo(out)
+
+            out.writeLine(0, "}")
+        self._regCallbacksCode.close()
+        self._cbCode.close()
+        self._addedToWorldCode.close()
+
+    def topBlock(self, out, level, topBlock, deferYield=False):
+        """Write the statements under a top block, wrapped in { }, to out,
+        a CodeEmitter."""
+        self.block(out, level, topBlock.getNext(), deferYield)
+
+    def block(self, out, level, block, deferYield=False):
+        """Write the list of statements starting with block, wrapped in { },
+        to out, a CodeEmitter."""
+        out.write(genIndent(level) + "{\n")
+        self.statements(out, level, block, deferYield)
+        out.write(genIndent(level) + "}\n")
+
+    def statements(self, out, level, firstBlock, deferYield=False):
+        """Write the code for the list of statements to out, a CodeEmitter,
+        by repeatedly calling stmt(), following the chain of next pointers
+        from the firstBlock.
+        A list nested more than MAX_STATEMENT_NESTING deep is not generated
+        here, as each level takes several Python stack frames, but is left
+        to genDeferredStatements(), with an emitter for its place in out."""
         if firstBlock is None:
-            return ""
-        retStr = ""
-        aBlock = firstBlock
-        while aBlock:
-            # Call stmt to generate the statement, appending the result to the
-            # overall resulting string.
-            retStr += self.stmt(level + 1, aBlock, deferYield)
-            aBlock = aBlock.getNext()
-        return retStr
-
-    def stmt(self, level, block, deferYield=False):
-        """Handle a statement, which is a block object
-        """
-
-        scratchStmt2genCode = {
-
-            'motion_movesteps': self.moveSteps,
-            'motion_turnleft': self.turnLeft,
-            'motion_turnright': self.turnRight,
-            'motion_pointindirection': self.pointInDirection,
-            'motion_gotoxy': self.gotoXY,
-            'motion_goto': self.goto,
-            'motion_changexby': self.changeXBy,
-            'motion_setx': self.setX,
-            'motion_changeyby': self.changeYBy,
-            'motion_sety': self.setY,
-            'motion_ifonedgebounce': self.ifOnEdgeBounce,
-            'motion_setrotationstyle': self.setRotationStyle,
-            'motion_pointtowards': self.pointTowards,
-            'motion_glideto': self.glideTo,
-
-            'looks_sayforsecs': self.sayForSecs,
-            'looks_say': self.say,
-            'looks_thinkforsecs': self.thinkForSecs,
-            'looks_think': self.think,
-            'looks_show': self.show,
-            'looks_hide': self.hide,
-            'looks_switchcostumeto': self.switchCostumeTo,
-            'looks_nextcostume': self.nextCostume,
-            'looks_switchbackdropto': self.switchBackdropTo,
-            'looks_changesizeby': self.changeSizeBy,
-            'looks_setsizeto': self.setSizeTo,
-            'looks_gotofrontback': self.goToFrontBack,
-            'looks_goforwardbackwardlayers': self.goForwBackNLayers,
-            'looks_nextbackdrop': self.nextBackdrop,
-            'looks_changeeffectby': self.changeGraphicBy,
-            'looks_seteffectto': self.setGraphicTo,
-
-            'pen_clear': self.penClear,
-            'pen_stamp': self.penStamp,
-            'pen_penDown': self.penDown,
-            'pen_penUp': self.penUp,
-            'pen_setPenColorToColor': self.setPenColor,
-            'pen_setPenColorParamTo': self.setPenColorParamTo,
-            'pen_changePenColorParamBy': self.setPenColorParamBy,
-            'pen_setPenSizeTo': self.setPenSizeTo,
-            'pen_changePenSizeBy': self.changePenSizeBy,
-
-            # Data commands
-            'data_setvariableto': self.setVariable,
-            'data_hidevariable': self.hideVariable,
-            'data_showvariable': self.showVariable,
-            'data_changevariableby': self.changeVarBy,
-
-            'data_addtolist': self.listAppend,
-            'data_deleteoflist': self.listDeleteAt,
-            'data_deletealloflist': self.listDeleteAll,
-            'data_insertatlist': self.listInsert,
-            'data_replaceitemoflist': self.listSet,
-            'hideList:': self.hideList,
-            'showList:': self.showList,
-
-            'event_broadcast': self.broadcast,
-            'event_broadcastandwait': self.broadcastAndWait,
-
-            'control_forever': self.doForever,
-            'control_wait': self.doWait,
-            'control_repeat': self.doRepeat,
-            'control_create_clone_of': self.createCloneOf,
-            'control_delete_this_clone': self.deleteThisClone,
-            'control_if': self.doIf,
-            'control_if_else': self.doIfElse,
-            'control_wait_until': self.doWaitUntil,
-            'control_repeat_until': self.repeatUntil,
-            'control_stop': self.stopScripts,
-
-            # Sensing commands
-            'sensing_askandwait': self.doAsk,
-            'sensing_resettimer': self.resetTimer,
-
-            # Sound commands
-            'sound_play': self.playSound,
-            'sound_playuntildone': self.playSoundUntilDone,
-
-            # Midi commands
-            'music_playNoteForBeats': self.playNote,
-            'music_setInstrument': self.instrument,
-            'music_playDrumForBeats': self.playDrum,
-            'music_restForBeats': self.rest,
-            'music_changeTempo': self.changeTempoBy,
-            'music_setTempo': self.setTempoTo,
-
-            # User-defined function
-            'procedures_call': self.callABlock,
-        }
+            return
+        if self._stmtNesting >= MAX_STATEMENT_NESTING:
+            self._deferredStmts.append((out.insertEmitter(), level, firstBlock, deferYield))
+            return
+
+        self._stmtNesting += 1
+        try:
+            aBlock = firstBlock
+            while aBlock:
+                self.stmt(out, level + 1, aBlock, deferYield)
+                aBlock = aBlock.getNext()
+        finally:
+            self._stmtNesting -= 1
+        if self._stmtNesting == 0 and self._deferredStmts:
+            self.genDeferredStatements()
+
+    def genDeferredStatements(self):
+        """Generate the statement lists that statements() left, and the ones
+        those leave, and so on, from a work list, each into the emitter for
+        its place in the code."""
+        pending = self._deferredStmts
+        try:
+            # Generating a list may add more to pending, each after it.
+            done = 0
+            while done < len(pending):
+                self._stmtNesting = 1
+                self.statements(*pending[done])
+                done += 1
+        finally:
+            self._stmtNesting = 0
+            self._deferredStmts = []
+
+    def stmt(self, out, level, block, deferYield=False):
+        """Write the code for a statement, which is a block object, to out,
+        a CodeEmitter.
+        """
         if debug:
             print("stmt: block = ")
             print(block.strWithIndent(level))
 
         cmd = block.getOpcode()
 
-        if cmd in scratchStmt2genCode:
-            genCodeFunc = scratchStmt2genCode[cmd]
-            return genCodeFunc(level, block, deferYield)
+        genCodeFunc = self.getGenCodeTable('compound').get(cmd)
+        if genCodeFunc is not None:
+            genCodeFunc(self, out, level, block, deferYield)
+            return
+        genCodeFunc = self.getGenCodeTable('stmt').get(cmd)
+        if genCodeFunc is not None:
+            out.write(genCodeFunc(self, level, block, deferYield))
         else:
-            return genIndent(level) + 'System.out.println("Unimplemented stmt: ' + cmd + '");\n'
+            out.write(genIndent(level) + 'System.out.println("Unimplemented stmt: ' + cmd + '");\n')
+
+    def stmtCode(self, level, block, deferYield=False):
+        """Return the code for a statement, as a string."""
+        out = CodeEmitter(io.StringIO())
+        self.stmt(out, level, block, deferYield)
+        return out.getCode()
 
     def boolExprOrFalse(self, block, key):
         return self.boolExpr(block.getChild(key)) if block.hasChild(key) else '(false)'
@@ -1311,52 +2511,13 @@ class SpriteOrStage:
     def boolExpr(self, block):
         """Generate code for a boolean expression.
         """
-
-        opcode = block.getOpcode()
-        if opcode == 'operator_lt':
-            return '(' + self.evalMathThenStrThenBool(block, 'OPERAND1') + ' < ' + \
-                   self.evalMathThenStrThenBool(block, 'OPERAND2') + ')'
-        elif opcode == 'operator_gt':
-            return '(' + self.evalMathThenStrThenBool(block, 'OPERAND1') + ' > ' + \
-                   self.evalMathThenStrThenBool(block, 'OPERAND2') + ')'
-        elif opcode == 'operator_equals':
-            # NOTE: Scratch seems to lowercase everything before comparing. "Hello" == "hello".
-            # We are not doing that...
-            return '(' + self.evalMathThenStrThenBool(block, 'OPERAND1') + ' == ' + \
-                   self.evalMathThenStrThenBool(block, 'OPERAND2') + ')'
-        elif opcode == 'operator_and':
-            return '(' + self.boolExprOrFalse(block, 'OPERAND1') + ' && ' + \
-                         self.boolExprOrFalse(block, 'OPERAND2') + ')'
-        elif opcode == 'operator_or':
-            return '(' + self.boolExprOrFalse(block, 'OPERAND1') + ' || ' + \
-                         self.boolExprOrFalse(block, 'OPERAND2') + ')'
-        elif opcode == 'operator_not':
-            return '( !' + self.boolExprOrFalse(block, 'OPERAND') + ')'
-        elif opcode == 'operator_contains':
-            return self.stringContains(block)
-        elif opcode == 'sensing_touchingobject':
-            arg = self.evalExprOrMenuItem(block, 'TOUCHINGOBJECTMENU')
-            if arg == '_mouse_':
-                return "(isTouchingMouse())"
-            elif arg == "_edge_":
-                return "(isTouchingEdge())"
-            else:  # touching another sprite
-                return '(isTouching("' + arg + '"))'
-        elif opcode == 'sensing_touchingcolor':
-            # TODO: does not support expressions that evaluate to a color
-            color = block.getInputs()['COLOR'][1][1][1:]  # remove the leading #-sign
-            return "(isTouchingColor(new java.awt.Color(0x" + color + ")))"
-        elif opcode == 'sensing_coloristouchingcolor':
-            return 'Unsupported boolean expression: ' + opcode
-        elif opcode == 'sensing_mousedown':
-            return "(isMouseDown())"
-        elif opcode == 'sensing_keypressed':
-            keyoption = self.evalExprOrMenuItem(block, 'KEY_OPTION')
-            return '(isKeyPressed("' + convertKeyPressName(keyoption) + '"))'
-        elif opcode == 'data_listcontainsitem':
-            return self.listContains(block)
-        else:
-            raise ValueError('unsupported op', opcode)
+        code = self._exprCache.get(block, 'bool')
+        if code is not None:
+            return code
+        genCodeFunc = self.getGenCodeTable('bool').get(block.getOpcode())
+        if genCodeFunc is None:
+            raise ValueError('unsupported op', block.getOpcode())
+        return self._exprCache.put(block, 'bool', genCodeFunc(self, block))
 
     def strExpr(self, block, exprKey):
         """Evaluate a string-producing expression (or literal).
@@ -1377,40 +2538,21 @@ class SpriteOrStage:
         # e.g., [  3,  'alongidhere', [ 4, "10" ] ]
         # the value after 'alongidhere' is the default value -- we don't care about this.
         child = block.getChild(exprKey)
-        opcode = child.getOpcode()
-        if opcode == 'operator_join':
-            return 'join(' + self.strExpr(child, 'STRING1') + ', ' + self.strExpr(child, 'STRING2') + ')'
-        elif opcode == 'operator_letter_of':
-            return "letterNOf(" + self.mathExpr(child, 'LETTER') + ", " + self.strExpr(child, 'STRING') + ")"
-        elif opcode == 'looks_costumenumbername':
-            numberOrName = child.getField('NUMBER_NAME')
-            if numberOrName == 'name':
-                return 'costumeName()'
-            elif numberOrName == 'number':
-                return "String.valueOf(costumeNumber())"
-        elif opcode == 'looks_backdropnumbername':
-            numberOrName = child.getField('NUMBER_NAME')
-            if numberOrName == 'name':
-                return 'backdropName()'
-            elif numberOrName == 'number':
-                return "String.valueOf(backdropNumber())"
-        elif opcode == 'looks_costume':
-            return '"' + child.getField('COSTUME') + '"'
-        elif opcode == 'looks_backdrops':
-            return '"' + child.getField('BACKDROP') + '"'
-        elif opcode == 'sensing_answer':
-            return 'answer'
-        elif opcode == 'sensing_of':
-            return 'String.valueOf(' + self.getAttributeOf(child) + ')'
-        elif opcode == 'argument_reporter_string_number':
-            return self.procDefnUseParamName(child)
-        elif opcode == 'data_itemnumoflist':
-            return self.listElement(child)
+        code = self._exprCache.get(child, 'str')
+        if code is not None:
+            return code
+        genCodeFunc = self.getGenCodeTable('str').get(child.getOpcode())
+        if genCodeFunc is not None:
+            code = genCodeFunc(self, child)
         else:
             # You can put a math expression in where strings are expected
             # and they are automatically used.  So, we'll try that
-            # too.
-            return "String.valueOf(" + str(self.mathExpr(block, 'MESSAGE')) + ")"
+            # too.  And a boolean one.
+            if child.getOpcode() in self.getGenCodeTable('bool'):
+                code = "String.valueOf(" + self.boolExpr(child) + ")"
+            else:
+                code = "String.valueOf(" + str(self.mathExpr(block, exprKey)) + ")"
+        return self._exprCache.put(child, 'str', code)
 
     def handleVariableReference(self, expr):
         # Handle variable references here.
@@ -1424,25 +2566,89 @@ class SpriteOrStage:
         else:
             return 'Stage.%s.get()' % var.getGfName()
 
+    def genReporterCode(self, topBlocks):
+        """Generate the code for every reporter block in the scripts, as the
+        first kind of expression exprTypes() gives for it, into the
+        expression cache.  Blocks are
+        done from the innermost out, using a work stack instead of
+        recursion, so that when the code for a statement asks for its
+        expressions, each is found in the cache without descending through
+        a long chain of nested reporters.
+        """
+        # Find all the blocks, each after the one it hangs off of.
+        allBlocks = []
+        stack = list(topBlocks)
+        while stack:
+            block = stack.pop()
+            allBlocks.append(block)
+            if block.getNext() is not None:
+                stack.append(block.getNext())
+            stack.extend(block.getChildren().values())
+
+        for block in reversed(allBlocks):
+            for key, child in block.getChildren().items():
+                exprTypes = self.exprTypes(block, key)
+                if not exprTypes or (child.getId(), exprTypes[0]) in self._exprCache:
+                    continue
+                # Only the kind evalMathThenStrThenBool() would choose.
+                # Others are generated when they are asked for, so that
+                # generators, some of which have side effects (e.g.,
+                # spriteExpr()), are not run for every kind a block can be.
+                genCodeFunc = self.getGenCodeTable(exprTypes[0])[child.getOpcode()]
+                try:
+                    self._exprCache.put(child, exprTypes[0], genCodeFunc(self, child))
+                except ValueError:
+                    # e.g., an add of non-numbers, which is only used as a
+                    # string.  If it is used as this kind, the error is
+                    # raised again when it is generated.
+                    pass
+
+    def exprTypes(self, block, exprKey):
+        """Return the kinds of expression ('math', 'str' and/or 'bool', in
+        that order) that the expression in block[exprKey] can be generated
+        as.  This is found from the literal value or the reporter block's
+        opcode, without generating any code, so that the code for each
+        expression is generated just once, as the right kind.
+        """
+        if not block.hasChild(exprKey):
+            expr = block.getInput(exprKey)
+            # if expr[1][0] is 12, then we are referencing a variable (guess).
+            # mathExpr() takes an empty placeholder to be 0.
+            if expr[1][0] == 12 or expr[1][1] == '' or isNumericLiteral(expr[1][1]):
+                return ('math', 'str')
+            return ('str',)
+
+        child = block.getChild(exprKey)
+        opcode = child.getOpcode()
+        if opcode in ('looks_costumenumbername', 'looks_backdropnumbername') and \
+                child.getField('NUMBER_NAME') != 'number':
+            return ('str',)
+        return tuple(kind for kind in ('math', 'str', 'bool') if opcode in self.getGenCodeTable(kind))
+
     def evalMathThenStrThenBool(self, block, key):
-        try:
-            resStr = self.mathExpr(block, key)
-        except:
-            try:
-                resStr = self.strExpr(block, key)
-            except:
-                resStr = self.boolExpr(block.getChild(key))
-        return resStr
+        """Generate code for the expression in block[key] as a math
+        expression if it is one, otherwise as a string, otherwise as a
+        boolean expression."""
+        exprTypes = self.exprTypes(block, key)
+        if not exprTypes:
+            raise ValueError('unsupported op', block.getChild(key).getOpcode())
+        if exprTypes[0] == 'math':
+            return self.mathExpr(block, key)
+        elif exprTypes[0] == 'str':
+            return self.strExpr(block, key)
+        else:
+            return self.boolExpr(block.getChild(key))
 
     def mathExpr(self, block, exprKey):
         """Evaluate the expression in block[exprKey] and its children, as a math expression,
         returning a string equivalent."""
 
-        print('mathExpr: Evaluating block', block, 'and exprKey', exprKey)
         expr = block.getInput(exprKey)
         assert isinstance(expr, list)
 
-        print('mathExpr:                expr ', expr)
+        if debug:
+            print('mathExpr: Evaluating block', block, 'and exprKey', exprKey)
+            print('mathExpr:                expr ', expr)
 
         if not block.hasChild(exprKey):
             # if expr[1][0] is 12, then we are referencing a variable (guess).
@@ -1453,116 +2659,227 @@ class SpriteOrStage:
                 # Scratch allows an empty placeholder and seems to use
                 # the value 0 in this case.
                 return '0'
-            try:
-                int(val)
-                return str(val)
-            except:
-                try:
-                    float(val)
-                    return str(val)
-                except:
-                    # the raw value does not convert to a number, so
-                    # raise an error
-                    raise
+            if not isNumericLiteral(val):
+                raise ValueError("Not a number: %s" % val)
+            return str(val)
 
         # e.g., [  3,  'alongidhere', [ 4, "10" ] ]
         # the value after 'alongidhere' is the default value -- we don't care about this.
         child = block.getChild(exprKey)
-        opcode = child.getOpcode()
-        if opcode == 'operator_add':
-            return '(' + self.mathExpr(child, 'NUM1') + ' + ' + self.mathExpr(child, 'NUM2') + ')'
-        elif opcode == 'operator_subtract':
-            return '(' + self.mathExpr(child, 'NUM1') + ' - ' + self.mathExpr(child, 'NUM2') + ')'
-        elif opcode == 'operator_multiply':
-            return '(' + self.mathExpr(child, 'NUM1') + ' * ' + self.mathExpr(child, 'NUM2') + ')'
-        elif opcode == 'operator_divide':
-            return '(' + self.mathExpr(child, 'NUM1') + ' / ' + self.mathExpr(child, 'NUM2') + ')'
-        elif opcode == 'operator_mod':
-            return '(' + "Math.floorMod(" + self.mathExpr(child, 'NUM1') + ", " + self.mathExpr(child, 'NUM2') + "))"
-        elif opcode == 'operator_round':
-            return '(' + "Math.round((float) " + self.mathExpr(child, 'NUM') + "))"
-        elif opcode == 'operator_mathop':
-            mathop = child.getField('OPERATOR')
-            op2Func = {
-                "abs": "Math.abs(",
-                "floor": "Math.floor(",
-                "ceiling": "Math.ceil(",
-                "sqrt": "Math.sqrt(",
-                "sin": "Math.sin(",
-                "cos": "Math.cos(",
-                "tan": "Math.tan(",
-                "asin": "Math.asin(",
-                "acos": "Math.acos(",
-                "atan": "Math.atan(",
-                "ln": "Math.log(",
-                "log": "Math.log10(",
-                "e ^": "Math.exp(",
-                "10 ^": "Math.pow(10, "
-            }
-            return '(' + op2Func[mathop] + self.mathExpr(child, 'NUM') + "))"
-        elif opcode == 'operator_length':
-            arg = child.getInputs()['STRING'][1][1]
-            # TODO: should call strExpr 
-            return "lengthOf(" + arg + ")"
-        elif opcode == 'operator_random':
-            return "pickRandom(" + self.mathExpr(child, 'FROM') + ", " + self.mathExpr(child, 'TO') + ")"
-        elif opcode == 'motion_xposition':
-            return 'getX()'
-        elif opcode == 'motion_yposition':
-            return "getY()"
-        elif opcode == 'motion_direction':
-            return "getDirection()"
-        elif opcode == "looks_costumenumbername":
-            if child.getField('NUMBER_NAME') == 'number':
-                return "costumeNumber()"
-            else:
-                raise ValueError('not supported yet')
-        elif opcode == 'looks_backdropnumbername':
-            if child.getField('NUMBER_NAME') == 'number':
-                return 'getBackdropNumber()'
-            else:
-                raise ValueError('not supported yet')
-        elif opcode == "looks_size":
-            return "size()"
-        elif opcode == "sensing_mousedown":
-            # this will produce uncompileable Java code... but if you try this kind of
-            # thing, you are kind of asking for it...
-            return " (int) isMouseDown()"
-        elif opcode == "sensing_mousex":
-            return "getMouseX()"
-        elif opcode == 'sensing_mousey':
-            return "getMouseY()"
-        elif opcode == "sensing_timer":
-            return "getTimer()"
-        elif opcode == "sensing_dayssince2000":
-            return "daysSince2000()"
-        elif opcode == 'sensing_current':
-            return self.genSensingCurrentDateEtc(child)
-        elif opcode == "sensing_distanceto":
-            arg = self.evalExprOrMenuItem(child, 'DISTANCETOMENU')
-            if arg == '_mouse_':
-                return "distanceToMouse()"
-            else:  # must be distance to a sprite
-                return 'distanceTo("' + arg + '")'
-        elif opcode == 'sensing_of':
-            return self.getAttributeOf(child)
-        elif opcode == 'argument_reporter_string_number':
-            return self.procDefnUseParamName(child)
-        elif opcode == 'data_lengthoflist':
-            return self.listLength(block)
+        code = self._exprCache.get(child, 'math')
+        if code is not None:
+            return code
+        genCodeFunc = self.getGenCodeTable('math').get(child.getOpcode())
+        if genCodeFunc is None:
+            raise ValueError("Unsupported operator %s" % child.getOpcode())
+        return self._exprCache.put(child, 'math', genCodeFunc(self, child))
+
+    # ----------------------------------------------------------
+    # Reporter blocks.  Each is given the reporter block itself and
+    # returns the code for it as a boolean, string or math expression.
+
+    @genCodeFor('bool', 'operator_lt', 'operator_gt', 'operator_equals')
+    def compare(self, block):
+        # NOTE: Scratch seems to lowercase everything before comparing. "Hello" == "hello".
+        # We are not doing that...
+        return '(' + self.evalMathThenStrThenBool(block, 'OPERAND1') + COMPARISON_OPS[block.getOpcode()] + \
+               self.evalMathThenStrThenBool(block, 'OPERAND2') + ')'
+
+    @genCodeFor('bool', 'operator_and', 'operator_or')
+    def andOr(self, block):
+        return '(' + self.boolExprOrFalse(block, 'OPERAND1') + BOOLEAN_OPS[block.getOpcode()] + \
+                     self.boolExprOrFalse(block, 'OPERAND2') + ')'
+
+    @genCodeFor('bool', 'operator_not')
+    def boolNot(self, block):
+        return '( !' + self.boolExprOrFalse(block, 'OPERAND') + ')'
+
+    @genCodeFor('bool', 'sensing_touchingobject')
+    def touchingObject(self, block):
+        arg = self.evalExprOrMenuItem(block, 'TOUCHINGOBJECTMENU')
+        if arg == '_mouse_':
+            return "(isTouchingMouse())"
+        elif arg == "_edge_":
+            return "(isTouchingEdge())"
+        else:  # touching another sprite
+            return '(isTouching(' + self.spriteExpr(block, 'TOUCHINGOBJECTMENU') + '))'
+
+    @genCodeFor('bool', 'sensing_touchingcolor')
+    def touchingColor(self, block):
+        # TODO: does not support expressions that evaluate to a color
+        color = block.getInputs()['COLOR'][1][1][1:]  # remove the leading #-sign
+        return "(isTouchingColor(new java.awt.Color(0x" + color + ")))"
+
+    @genCodeFor('bool', 'sensing_coloristouchingcolor')
+    def colorIsTouchingColor(self, block):
+        return 'Unsupported boolean expression: ' + block.getOpcode()
+
+    @genCodeFor('bool', 'sensing_mousedown')
+    def boolMouseDown(self, block):
+        return "(isMouseDown())"
+
+    @genCodeFor('bool', 'sensing_keypressed')
+    def keyPressed(self, block):
+        keyoption = self.evalExprOrMenuItem(block, 'KEY_OPTION')
+        return '(isKeyPressed("' + convertKeyPressName(keyoption) + '"))'
+
+    @genCodeFor('str', 'operator_join')
+    def join(self, block):
+        return 'join(' + self.strExpr(block, 'STRING1') + ', ' + self.strExpr(block, 'STRING2') + ')'
+
+    @genCodeFor('str', 'operator_letter_of')
+    def letterOf(self, block):
+        return "letterNOf(" + self.mathExpr(block, 'LETTER') + ", " + self.strExpr(block, 'STRING') + ")"
+
+    @genCodeFor('str', 'looks_costumenumbername')
+    def strCostumeNumberName(self, block):
+        numberOrName = block.getField('NUMBER_NAME')
+        if numberOrName == 'name':
+            return 'costumeName()'
+        elif numberOrName == 'number':
+            return "String.valueOf(costumeNumber())"
+
+    @genCodeFor('str', 'looks_backdropnumbername')
+    def strBackdropNumberName(self, block):
+        numberOrName = block.getField('NUMBER_NAME')
+        if numberOrName == 'name':
+            return 'backdropName()'
+        elif numberOrName == 'number':
+            return "String.valueOf(backdropNumber())"
+
+    @genCodeFor('str', 'looks_costume')
+    def costumeMenu(self, block):
+        return '"' + block.getField('COSTUME') + '"'
+
+    @genCodeFor('str', 'looks_backdrops')
+    def backdropMenu(self, block):
+        return '"' + block.getField('BACKDROP') + '"'
+
+    @genCodeFor('str', 'sensing_answer')
+    def answer(self, block):
+        return 'answer'
+
+    @genCodeFor('str', 'sensing_of')
+    def strAttributeOf(self, block):
+        return 'String.valueOf(' + self.getAttributeOf(block) + ')'
+
+    @genCodeFor('math', 'operator_add', 'operator_subtract', 'operator_multiply', 'operator_divide')
+    def arithmetic(self, block):
+        opcode = block.getOpcode()
+        num1 = self.mathExpr(block, 'NUM1')
+        num2 = self.mathExpr(block, 'NUM2')
+        folded = javaNumber(foldArithmetic(opcode, parseJavaNumber(num1), parseJavaNumber(num2)))
+        if folded is not None:
+            return folded
+        # An operand that is itself an arithmetic expression needs no
+        # parentheses if its operator binds tighter, or equally tightly on the
+        # left, as Java evaluates that operand first either way.
+        if self.isArithmetic(block, 'NUM1') and ARITHMETIC_PRECEDENCE[block.getChild('NUM1').getOpcode()] >= \
+                ARITHMETIC_PRECEDENCE[opcode]:
+            num1 = num1[1:-1]
+        if self.isArithmetic(block, 'NUM2') and ARITHMETIC_PRECEDENCE[block.getChild('NUM2').getOpcode()] > \
+                ARITHMETIC_PRECEDENCE[opcode]:
+            num2 = num2[1:-1]
+        return '(' + num1 + ARITHMETIC_OPS[opcode] + num2 + ')'
+
+    def isArithmetic(self, block, key):
+        """Return True if the code for block[key] is an unfolded arithmetic
+        expression, which is always in parentheses."""
+        return block.hasChild(key) and block.getChild(key).getOpcode() in ARITHMETIC_OPS and \
+               parseJavaNumber(self.mathExpr(block, key)) is None
+
+    @genCodeFor('math', 'operator_mod')
+    def mod(self, block):
+        num1 = self.mathExpr(block, 'NUM1')
+        num2 = self.mathExpr(block, 'NUM2')
+        a, b = parseJavaNumber(num1), parseJavaNumber(num2)
+        # Math.floorMod() is only for ints.  Like Scratch, its result has
+        # the sign of the divisor, as does Python's %.
+        if isinstance(a, int) and isinstance(b, int) and b != 0:
+            return javaNumber(a % b)
+        return "Math.floorMod(" + num1 + ", " + num2 + ")"
+
+    @genCodeFor('math', 'operator_round')
+    def round(self, block):
+        num = self.mathExpr(block, 'NUM')
+        a = parseJavaNumber(num)
+        if a is not None and abs(a) < 2 ** 30:
+            # Math.round() rounds the float nearest a, halves up.
+            return javaNumber(math.floor(struct.unpack('f', struct.pack('f', a))[0] + 0.5))
+        return "Math.round((float) " + num + ")"
+
+    @genCodeFor('math', 'operator_mathop')
+    def mathOp(self, block):
+        mathop = block.getField('OPERATOR')
+        num = self.mathExpr(block, 'NUM')
+        folded = javaNumber(foldMathOp(mathop, parseJavaNumber(num)))
+        if folded is not None:
+            return folded
+        return MATHOP_FUNCS[mathop] + num + ")"
+
+    @genCodeFor('math', 'operator_length')
+    def lengthOf(self, block):
+        arg = block.getInputs()['STRING'][1][1]
+        # TODO: should call strExpr 
+        return "lengthOf(" + arg + ")"
+
+    @genCodeFor('math', 'operator_random')
+    def pickRandom(self, block):
+        return "pickRandom(" + self.mathExpr(block, 'FROM') + ", " + self.mathExpr(block, 'TO') + ")"
+
+    @genCodeFor('math', *MATH_CONSTANT_REPORTERS)
+    def mathConstantReporter(self, block):
+        """Handle reporters, like x position, that are always the same call."""
+        return MATH_CONSTANT_REPORTERS[block.getOpcode()]
+
+    @genCodeFor('math', "looks_costumenumbername")
+    def mathCostumeNumber(self, block):
+        if block.getField('NUMBER_NAME') == 'number':
+            return "costumeNumber()"
         else:
-            raise ValueError("Unsupported operator %s" % opcode)
+            raise ValueError('not supported yet')
 
+    @genCodeFor('math', 'looks_backdropnumbername')
+    def mathBackdropNumber(self, block):
+        if block.getField('NUMBER_NAME') == 'number':
+            return 'getBackdropNumber()'
+        else:
+            raise ValueError('not supported yet')
+
+    @genCodeFor('math', "sensing_distanceto")
+    def distanceTo(self, block):
+        arg = self.evalExprOrMenuItem(block, 'DISTANCETOMENU')
+        if arg == '_mouse_':
+            return "distanceToMouse()"
+        else:  # must be distance to a sprite
+            return 'distanceTo(' + self.spriteExpr(block, 'DISTANCETOMENU') + ')'
+
+    @genCodeFor('bool', 'operator_contains')
     def stringContains(self, block):
         '''Handle operator_contains'''
         bigStr = self.strExpr(block, 'STRING1')
         subStr = self.strExpr(block, 'STRING2')
         return '(%s.contains(%s))' % (bigStr, subStr)
 
+    @genCodeFor('math', 'argument_reporter_string_number')
     def procDefnUseParamName(self, block):
         paramName = block.getField('VALUE')
         return convertToJavaId(paramName)
 
+    @genCodeFor('bool', 'argument_reporter_boolean')
+    def procDefnUseBoolParam(self, block):
+        """Boolean expressions are in parens, as if and while use them as is."""
+        return "(" + self.procDefnUseParamName(block) + ")"
+
+    @genCodeFor('str', 'argument_reporter_string_number')
+    def procDefnUseParamAsString(self, block):
+        """A number parameter used as text is converted to a String."""
+        code = self.procDefnUseParamName(block)
+        if self._argReporterTypes.get(block.getId(), 'String') != 'String':
+            return "String.valueOf(" + code + ")"
+        return code
+
+    @genCodeFor('math', 'sensing_current')
     def genSensingCurrentDateEtc(self, block):
         option = block.getField('CURRENTMENU')
         if option == "MINUTE":
@@ -1582,6 +2899,7 @@ class SpriteOrStage:
         else:
             raise ValueError('Unknown date/time sensing: ' + option)
 
+    @genCodeFor('math', 'sensing_of')
     def getAttributeOf(self, block):
         """Return code to handle the various sensing_of calls
         from the sensing block.
@@ -1611,8 +2929,9 @@ class SpriteOrStage:
                    'size': 'sizeOf',
                    }
         if prop in mapping:
-            print('getAttributeOf returning', mapping[prop] + '("' + objChild + '")')
-            return mapping[prop] + '("' + objChild + '")'
+            code = mapping[prop] + '(' + self.spriteExpr(block, 'OBJECT') + ')'
+            print('getAttributeOf returning', code)
+            return code
         elif prop in ('backdrop #', 'backdrop name', 'volume'):
             return "0"  # bogus in Scratch and here too
         else:
@@ -1621,6 +2940,7 @@ class SpriteOrStage:
             # of the variable, we must use the unsanitized name. TODO fix this 
             return '((' + prop + ')world.getActorByName("' + objChild + '")).' + tok1 + '.get()'
 
+    @genCodeFor('hat', 'event_whenflagclicked')
     def whenFlagClicked(self, codeObj, block):
         """Generate code to handle the whenFlagClicked block.
         All code in block goes into a callback.
@@ -1629,6 +2949,11 @@ class SpriteOrStage:
         # Build a name like whenFlagClickedCb0 
         cbName = 'whenFlagClickedCb' + str(scriptNum)
 
+        if steppedScripts and self.canStepScript(block):
+            codeObj.addToCode(genIndent(2) + 'whenFlagClickedStepped("' + cbName + '");\n')
+            codeObj.addToCbCode(self.genSteppedScript(cbName, block))
+            return
+
         # Code in the constructor is always level 2.
         codeObj.addToCode(genIndent(2) + 'whenFlagClicked("' + cbName + '");\n')
 
@@ -1636,11 +2961,11 @@ class SpriteOrStage:
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(level) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.topBlock(level, block) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(level) + "public void " + cbName + "(Sequence s)\n")
+        self.topBlock(codeObj.cbCode, level, block)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
+    @genCodeFor('hat', 'control_start_as_clone')
     def whenSpriteCloned(self, codeObj, topBlock):
         """Generate code to handle the whenCloned block.
         All code in children of topBlock goes into a callback.
@@ -1648,15 +2973,18 @@ class SpriteOrStage:
         scriptNum = codeObj.getNextScriptId()
         cbName = 'whenIStartAsACloneCb' + str(scriptNum)
 
-        # Code in the constructor is always level 2.
-        codeObj.addToCode(genIndent(2) + 'whenIStartAsAClone("' + cbName + '");\n')
+        if steppedScripts and self.canStepScript(topBlock):
+            codeObj.addToCode(genIndent(2) + 'whenIStartAsACloneStepped("' + cbName + '");\n')
+            codeObj.addToCbCode(self.genSteppedScript(cbName, topBlock))
+        else:
+            # Code in the constructor is always level 2.
+            codeObj.addToCode(genIndent(2) + 'whenIStartAsAClone("' + cbName + '");\n')
 
-        # Generate callback code, into the codeObj's cbCode string.
-        # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(1) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.topBlock(1, topBlock) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+            # Generate callback code, into the codeObj's cbCode string.
+            # Add two blank lines before each method definition.
+            codeObj.addToCbCode("\n\n" + genIndent(1) + "public void " + cbName + "(Sequence s)\n")
+            self.topBlock(codeObj.cbCode, 1, topBlock)
+            codeObj.addToCbCode("\n")  # add blank line after defn.
 
         # Generate a copy constructor too.
         if not self._copyConstructorMade:
@@ -1670,6 +2998,7 @@ class SpriteOrStage:
             codeObj.addToCbCode(cbStr)
             self._copyConstructorMade = True
 
+    @genCodeFor('hat', 'event_whenkeypressed')
     def whenKeyPressed(self, codeObj, topBlock):
         """Generate code to handle the whenKeyPressed block.
         topBlock is the keypressed block. Child block code is generated
@@ -1690,12 +3019,11 @@ class SpriteOrStage:
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(level) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.topBlock(level, topBlock) + "\n"  # add blank line after defn.
-
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(level) + "public void " + cbName + "(Sequence s)\n")
+        self.topBlock(codeObj.cbCode, level, topBlock)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
+    @genCodeFor('hat', 'event_whenbroadcastreceived')
     def whenIReceive(self, codeObj, topBlock):
         """Generate code to handle the whenIReceive block.  
         topBlock contains the message and the list of statements to be put
@@ -1709,16 +3037,17 @@ class SpriteOrStage:
         cbName = 'whenIReceive' + messageId + 'Cb' + str(scriptNum)
 
         # Code in the constructor is always level 2.
-        codeObj.addToCode(genIndent(2) + 'whenRecvMessage("' +
-                          message + '", "' + cbName + '");\n')
+        codeObj.addToCode(genIndent(2) + 'whenRecvMessage(' + broadcastMessages.getConstant(message) +
+                          ', "' + cbName + '");\n')
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
         # All cb code is at level 1
-        cbStr = "\n\n" + genIndent(1) + "public void " + cbName + "(Sequence s)\n"
-        cbStr += self.topBlock(1, topBlock) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(1) + "public void " + cbName + "(Sequence s)\n")
+        self.topBlock(codeObj.cbCode, 1, topBlock)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
+    @genCodeFor('hat', 'event_whenbackdropswitchesto')
     def whenSwitchToBackdrop(self, codeObj, topBlock):
         """Generate code to handle the whenSwitchToBackdrop block.  key is
         the key to wait for, and tokens is the list of statements to be put
@@ -1738,53 +3067,230 @@ class SpriteOrStage:
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(level) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.topBlock(level, topBlock) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(level) + "public void " + cbName + "(Sequence s)\n")
+        self.topBlock(codeObj.cbCode, level, topBlock)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
 
-    def doForever(self, level, block, deferYield=False):
+    @genCodeFor('compound', 'control_forever')
+    def doForever(self, out, level, block, deferYield=False):
         """Generate doForever code.  block is the topblock with 
         children hanging off of it.
         forever loop is turned into a while (true) loop, with the last
         operation being a yield(s) call.
         """
-        retStr = genIndent(level) + "while (true)\t\t// forever loop\n"
-        retStr += genIndent(level) + "{\n"
-        retStr += self.statements(level, block.getChild('SUBSTACK'))
+        out.write(genIndent(level) + "while (true)\t\t// forever loop\n")
+        out.write(genIndent(level) + "{\n")
+        self.statements(out, level, block.getChild('SUBSTACK'), deferYield)
+        out.write(self.loopYieldCode(level + 1, block, deferYield))
+        out.write(genIndent(level) + "}\n")
+
+    def loopYieldCode(self, level, loopBlock, deferYield):
+        """Generate the call that ends each iteration of loopBlock, to let
+        other sequences run.  That is deferredYield(), which does so only
+        every half second, in custom blocks that run without screen
+        refresh.  Otherwise it is yield(), unless yieldEvery is not 1 and
+        loopCanBatchYields(loopBlock): then it is batchedYield(), which
+        yields every yieldEvery calls, or deferredYield() if yieldEvery
+        is 0.
+        """
+        deferred = genIndent(level) + "deferredYield(s);   // allow other sequences to run occasionally\n"
         if deferYield:
-            retStr += genIndent(level + 1) + \
-                      "deferredYield(s);   // allow other sequences to run occasionally\n"
+            return deferred
+        if self.loopYieldsLessOften(loopBlock):
+            if yieldEvery == 0:
+                return deferred
+            return genIndent(level) + "batchedYield(s, %d);   // allow other sequences to run every %d times\n" % \
+                   (yieldEvery, yieldEvery)
+        return genIndent(level) + "yield(s);   // allow other sequences to run\n"
+
+    def loopYieldsLessOften(self, loopBlock):
+        return yieldEvery != 1 and self.loopCanBatchYields(loopBlock)
+
+    def loopCanBatchYields(self, loopBlock):
+        """Return True if nothing in the condition or body of loopBlock
+        waits or yields (a nested loop, wait, ask, glide, broadcast and
+        wait, custom block call, ...) or reads the timer, the clock, the
+        mouse or the keyboard.  Such a loop does not depend on time passing
+        between its iterations, so letting other sequences run, and the
+        screen be redrawn, less often does not change what it does.
+        As the walk stops at nested loops, each block is looked at for its
+        innermost loop only.
+        """
+        stack = list(loopBlock.getChildren().values())
+        while stack:
+            block = stack.pop()
+            if block.getOpcode() in YIELDING_OPCODES or block.getOpcode() in INPUT_STATE_OPCODES:
+                return False
+            if any(field[0] == '_mouse_' for field in block.getFields().values()):
+                return False
+            if block.getNext() is not None:
+                stack.append(block.getNext())
+            stack.extend(block.getChildren().values())
+        return True
+
+    def canStepScript(self, topBlock):
+        """Return True if the script starting with topBlock can be compiled
+        to a state machine: it uses no block that needs a Sequence thread
+        (see STEPPED_OPCODES), and its statement lists are not nested more
+        than MAX_STATEMENT_NESTING deep, as genSteppedStmt() recurses.
+        """
+        stack = [(topBlock, 0)]
+        while stack:
+            block, depth = stack.pop()
+            opcode = block.getOpcode()
+            if (opcode in YIELDING_OPCODES and opcode not in STEPPED_OPCODES) or depth > MAX_STATEMENT_NESTING:
+                return False
+            if block.getNext() is not None:
+                stack.append((block.getNext(), depth))
+            for key, child in block.getChildren().items():
+                stack.append((child, depth + 1 if key.startswith('SUBSTACK') else depth))
+        return True
+
+    def genSteppedScript(self, cbName, topBlock):
+        """Generate a method, named cbName, that makes the script starting
+        with topBlock compiled to a state machine: a Scratch.SteppedScript,
+        whose step() method runs the script from where it stopped, in state
+        stepPc, up to its next yield.  Instead of the Sequence thread, and
+        the lock handed over at every yield, of a script run with
+        whenFlagClicked(), the Greenfoot thread calls step() for each
+        SteppedScript in turn.
+        """
+        code = StepCode(6)
+        code.startState(0)
+        self.genSteppedStatements(code, topBlock.getNext())
+        code.endScript()
+
+        cbStr = "\n\n" + genIndent(1) + "public SteppedScript " + cbName + "()\n"
+        cbStr += genIndent(1) + "{\n"
+        cbStr += genIndent(2) + "return new SteppedScript() {\n"
+        for counter in code.counters:
+            cbStr += genIndent(3) + "private int " + counter + ";\n"
+        cbStr += genIndent(3) + "public boolean step()\n"
+        cbStr += genIndent(3) + "{\n"
+        cbStr += genIndent(4) + "while (true) {\n"
+        cbStr += genIndent(5) + "switch (stepPc) {\n"
+        cbStr += "".join(code.lines)
+        cbStr += genIndent(5) + "default:\n"
+        cbStr += genIndent(6) + "return false;\n"
+        cbStr += genIndent(5) + "}\n"
+        cbStr += genIndent(4) + "}\n"
+        cbStr += genIndent(3) + "}\n"
+        cbStr += genIndent(2) + "};\n"
+        cbStr += genIndent(1) + "}\n"
+        return cbStr + "\n"  # add blank line after defn.
+
+    def genSteppedStatements(self, code, firstBlock):
+        block = firstBlock
+        while block:
+            self.genSteppedStmt(code, block)
+            block = block.getNext()
+
+    def genSteppedStmt(self, code, block):
+        """Add the code for the statement block to code, a StepCode.  Loops
+        and waits become states that step() yields in and goes back to, and
+        ifs with those in them are turned into jumps between states.  Other
+        statements are generated as usual, by stmt().
+        """
+        opcode = block.getOpcode()
+        if opcode == 'control_forever':
+            top = code.newState()
+            code.startState(top)
+            if block.hasChild('SUBSTACK'):
+                self.genSteppedStatements(code, block.getChild('SUBSTACK'))
+            code.yieldTo(top, self.steppedLoopYieldCall(block))
+        elif opcode in ('control_repeat', 'control_repeat_until'):
+            top = code.newState()
+            end = code.newState()
+            if opcode == 'control_repeat':
+                counter = code.newCounter()
+                code.addLine(counter + " = 0;")
+                code.startState(top)
+                code.jumpIf("(%s >= %s)" % (counter, self.mathExpr(block, 'TIMES')), end)
+                code.addLine(counter + "++;")
+            else:
+                code.startState(top)
+                code.jumpIf(self.boolExprOrFalse(block, 'CONDITION'), end)
+            if block.hasChild('SUBSTACK'):
+                self.genSteppedStatements(code, block.getChild('SUBSTACK'))
+            code.yieldTo(top, self.steppedLoopYieldCall(block))
+            code.startState(end)
+        elif opcode == 'control_wait_until':
+            top = code.newState()
+            code.startState(top)
+            code.addLine("if (! %s) { stepPc = %d; return true; }" % (self.boolExprOrFalse(block, 'CONDITION'), top))
+        elif opcode == 'control_wait':
+            # Like wait(): yield until the time is up, which may be at once.
+            top = code.newState()
+            code.addLine("stepWaitEnd = System.currentTimeMillis() + (long) (1000.0 * %s);" %
+                         self.mathExpr(block, 'DURATION'))
+            code.startState(top)
+            code.addLine("if (System.currentTimeMillis() < stepWaitEnd) { stepPc = %d; return true; }" % top)
+        elif opcode in ('control_if', 'control_if_else') and self.hasSteppedStmt(block):
+            end = code.newState()
+            orElse = code.newState() if opcode == 'control_if_else' else end
+            code.jumpIf("(! " + self.boolExprOrFalse(block, 'CONDITION') + ")", orElse)
+            if block.hasChild('SUBSTACK'):
+                self.genSteppedStatements(code, block.getChild('SUBSTACK'))
+            if opcode == 'control_if_else':
+                code.jump(end)
+                code.startState(orElse)
+                if block.hasChild('SUBSTACK2'):
+                    self.genSteppedStatements(code, block.getChild('SUBSTACK2'))
+            code.startState(end)
+        elif opcode == 'control_stop' and block.getField('STOP_OPTION') == "this script":
+            code.endScript()
+        elif opcode == 'control_delete_this_clone':
+            code.add(self.stmtCode(code.level, block))
+            # A clone is removed from the world; the script ends there.
+            code.addLine("if (getWorld() == null) return false;")
         else:
-            retStr += genIndent(level + 1) + \
-                      "yield(s);   // allow other sequences to run\n"
-        return retStr + genIndent(level) + "}\n"
-
-    def doIf(self, level, block, deferYield=False):
+            code.add(self.stmtCode(code.level, block))
+
+    def hasSteppedStmt(self, block):
+        """Return True if any statement nested in block is one that
+        genSteppedStmt() has to handle itself."""
+        stack = [block.getChild(key) for key in ('SUBSTACK', 'SUBSTACK2') if block.hasChild(key)]
+        while stack:
+            child = stack.pop()
+            if child.getOpcode() in STEPPED_OPCODES and child.getOpcode() not in ('control_if', 'control_if_else'):
+                return True
+            if child.getNext() is not None:
+                stack.append(child.getNext())
+            stack.extend(child.getChild(key) for key in ('SUBSTACK', 'SUBSTACK2') if child.hasChild(key))
+        return False
+
+    def steppedLoopYieldCall(self, loopBlock):
+        """Return the call that says whether a loop in a stepped script
+        yields at the end of this iteration (see loopYieldCode()), or None
+        if it always does."""
+        if self.loopYieldsLessOften(loopBlock):
+            if yieldEvery == 0:
+                return "stepDeferredYield()"
+            return "stepBatchedYield(%d)" % yieldEvery
+        return None
+
+    @genCodeFor('compound', 'control_if')
+    def doIf(self, out, level, block, deferYield=False):
         """Generate code for if <test> : <block>.
         """
         # Handle the boolean expression
         # We don't generate parens around the boolExpr as it will put them there.
 
-        resStr = genIndent(level) + "if "
-        resStr += self.boolExprOrFalse(block, 'CONDITION')
-        resStr += "\n"
-        resStr += self.block(level, block.getChild('SUBSTACK'))
-        return resStr
+        out.write(genIndent(level) + "if " + self.boolExprOrFalse(block, 'CONDITION') + "\n")
+        self.block(out, level, block.getChild('SUBSTACK'), deferYield)
 
-    def doIfElse(self, level, block, deferYield=False):
+    @genCodeFor('compound', 'control_if_else')
+    def doIfElse(self, out, level, block, deferYield=False):
         """Generate code for if <test> : <block> else: <block>.
         """
 
-        resStr = genIndent(level) + "if "
-        resStr += self.boolExprOrFalse(block, 'CONDITION')
-        resStr += "\n"
-        resStr += self.block(level, block.getChild('SUBSTACK'))
-        resStr += genIndent(level) + "else\n"
-        resStr += self.block(level, block.getChild('SUBSTACK2'))
-        return resStr
+        out.write(genIndent(level) + "if " + self.boolExprOrFalse(block, 'CONDITION') + "\n")
+        self.block(out, level, block.getChild('SUBSTACK'), deferYield)
+        out.write(genIndent(level) + "else\n")
+        self.block(out, level, block.getChild('SUBSTACK2'), deferYield)
 
+    @genCodeFor('stmt', 'motion_ifonedgebounce')
     def ifOnEdgeBounce(self, level, block, deferYield=False):
         """Generate code to handle Motion blocks with 0 arguments"""
         return genIndent(level) + "ifOnEdgeBounce();\n"
@@ -1794,6 +3300,7 @@ class SpriteOrStage:
             return s[1:-1]
         return s
 
+    @genCodeFor('stmt', 'motion_movesteps')
     def moveSteps(self, level, block, deferYield=False):
         #     "inputs": {
         #       "STEPS": [  1,  [ 4, "10" ] ]
@@ -1801,31 +3308,40 @@ class SpriteOrStage:
         arg = self.stripOutsideParens(self.mathExpr(block, 'STEPS'))
         return genIndent(level) + "move(" + arg + ");\n"
 
+    @genCodeFor('stmt', 'motion_turnright')
     def turnRight(self, level, block, deferYield=False):
         # inputs is similar to moveSteps, but with DEGREES
         return genIndent(level) + "turnRightDegrees(" + self.mathExpr(block, 'DEGREES') + ");\n"
 
+    @genCodeFor('stmt', 'motion_turnleft')
     def turnLeft(self, level, block, deferYield=False):
         return genIndent(level) + "turnLeftDegrees(" + self.mathExpr(block, 'DEGREES') + ");\n"
 
+    @genCodeFor('stmt', 'motion_pointindirection')
     def pointInDirection(self, level, block, deferYield=False):
         return genIndent(level) + "pointInDirection(" + self.mathExpr(block, 'DIRECTION') + ");\n"
 
+    @genCodeFor('stmt', 'motion_goto')
     def goto(self, level, block, deferYield=False):
         return self.genGoto(level, block)
 
+    @genCodeFor('stmt', 'motion_changexby')
     def changeXBy(self, level, block, deferYield=False):
         return genIndent(level) + "changeXBy(" + self.mathExpr(block, 'DX') + ");\n"
 
+    @genCodeFor('stmt', 'motion_changeyby')
     def changeYBy(self, level, block, deferYield=False):
         return genIndent(level) + "changeYBy(" + self.mathExpr(block, 'DY') + ");\n"
 
+    @genCodeFor('stmt', 'motion_setx')
     def setX(self, level, block, deferYield=False):
         return genIndent(level) + "setXTo(" + self.mathExpr(block, 'X') + ");\n"
 
+    @genCodeFor('stmt', 'motion_sety')
     def setY(self, level, block, deferYield=False):
         return genIndent(level) + "setYTo(" + self.mathExpr(block, 'Y') + ");\n"
 
+    @genCodeFor('stmt', 'motion_setrotationstyle')
     def setRotationStyle(self, level, block, deferYield=False):
         arg = block.getField('STYLE')
         return self.genRotationStyle(level, arg)
@@ -1838,7 +3354,7 @@ class SpriteOrStage:
         elif argVal == "_random_":
             return genIndent(level) + "goToRandomPosition();\n"
         else:
-            return genIndent(level) + 'goTo("%s");\n' % argVal
+            return genIndent(level) + 'goTo(%s);\n' % self.spriteExpr(block, 'TO')
 
     def genRotationStyle(self, level, arg):
         resStr = genIndent(level) + "setRotationStyle("
@@ -1851,6 +3367,7 @@ class SpriteOrStage:
         else:
             raise ValueError('setRotationStyle')
 
+    @genCodeFor('stmt', 'motion_gotoxy')
     def gotoXY(self, level, block, deferYield=False):
         """Generate code to handle Motion blocks with 2 arguments:
         gotoxy, etc."""
@@ -1861,6 +3378,7 @@ class SpriteOrStage:
         return genIndent(level) + "goTo(" + self.mathExpr(block, 'X') + \
                ", " + self.mathExpr(block, 'Y') + ");\n"
 
+    @genCodeFor('stmt', 'motion_pointtowards')
     def pointTowards(self, level, block, deferYield=False):
         """Generate code to turn the sprite to point to something.
         """
@@ -1868,8 +3386,9 @@ class SpriteOrStage:
         if argVal == '_mouse_':
             return genIndent(level) + "pointTowardMouse();\n"
         else:  # pointing toward a sprite
-            return genIndent(level) + 'pointToward("' + argVal + '");\n'
+            return genIndent(level) + 'pointToward(' + self.spriteExpr(block, 'TOWARDS') + ');\n'
 
+    @genCodeFor('stmt', 'motion_glideto')
     def glideTo(self, level, block, deferYield=False):
         """Generate code to make the sprite glide to a certain x,y position
         in a certain amount of time.
@@ -1882,9 +3401,10 @@ class SpriteOrStage:
         elif argVal == "_random_":
             return genIndent(level) + "glideToRandomPosition(s, " + self.mathExpr(block, 'SECS') + ");\n"
         else:  # gliding to another sprite
-            return genIndent(level) + 'glideToSprite(s, "%s", %s);\n' % \
-                   (argVal, self.mathExpr(block, 'DURATION'))
+            return genIndent(level) + 'glideToSprite(s, %s, %s);\n' % \
+                   (self.spriteExpr(block, 'TO'), self.mathExpr(block, 'DURATION'))
 
+    @genCodeFor('stmt', 'looks_sayforsecs')
     def sayForSecs(self, level, block, deferYield=False):
         """Generate code to handle say <str> for <n> seconds.
         """
@@ -1895,72 +3415,84 @@ class SpriteOrStage:
         return genIndent(level) + "sayForNSeconds(s, " + message + ", " + \
                self.mathExpr(block, 'SECS') + ");\n"
 
+    @genCodeFor('stmt', 'looks_say')
     def say(self, level, block, deferYield=False):
         """Generate code to handle say <str>.
         """
         return genIndent(level) + "say(" + self.strExpr(block, 'MESSAGE') + ");\n"
 
+    @genCodeFor('stmt', 'looks_thinkforsecs')
     def thinkForSecs(self, level, block, deferYield=False):
         """Generate code to handle think <str> for <n> seconds.
         """
         return genIndent(level) + "thinkForNSeconds(s, " + self.strExpr(block, 'MESSAGE') + ", " + \
                self.mathExpr(block, 'SECS') + ");\n"
 
+    @genCodeFor('stmt', 'looks_think')
     def think(self, level, block, deferYield=False):
         """Generate code to handle think <str>.
         """
         return genIndent(level) + "think(" + self.strExpr(block, 'MESSAGE') + ");\n"
 
+    @genCodeFor('stmt', 'looks_show')
     def show(self, level, block, deferYield=False):
         """Generate code for the show block.
         """
         return genIndent(level) + "show();\n"
 
+    @genCodeFor('stmt', 'looks_hide')
     def hide(self, level, block, deferYield=False):
         """Generate code for the show block.
         """
         return genIndent(level) + "hide();\n"
 
+    @genCodeFor('stmt', 'looks_switchcostumeto')
     def switchCostumeTo(self, level, block, deferYield=False):
         """Generate code for the switch costume block.
         """
-        try:
+        if 'str' in self.exprTypes(block, 'COSTUME'):
             return genIndent(level) + "switchToCostume(" + self.strExpr(block, 'COSTUME') + ");\n"
-        except Exception:
-            # if strExpr is unable to resolve arg, use mathExpr instead
+        else:
+            # A costume number.
             return genIndent(level) + "switchToCostume(" + self.mathExpr(block, 'COSTUME') + ");\n"
 
+    @genCodeFor('stmt', 'looks_nextcostume')
     def nextCostume(self, level, block, deferYield=False):
         """Generate code for the next costume block.
         """
         assert block.getOpcode() == "looks_nextcostume"
         return genIndent(level) + "nextCostume();\n"
 
+    @genCodeFor('stmt', 'looks_switchbackdropto')
     def switchBackdropTo(self, level, block, deferYield=False):
         """Generate code to switch the backdrop.
         """
-        try:
+        if 'str' in self.exprTypes(block, 'BACKDROP'):
             return genIndent(level) + "switchBackdropTo(" + self.strExpr(block, 'BACKDROP') + ");\n"
-        except Exception:
-            # if strExpr is unable to resolve arg, use mathExpr instead
+        else:
+            # A backdrop number.
             return genIndent(level) + "switchBackdropTo(" + self.mathExpr(block, 'BACKDROP') + ");\n"
 
+    @genCodeFor('stmt', 'looks_nextbackdrop')
     def nextBackdrop(self, level, block, deferYield=False):
         """Generate code to switch to the next backdrop.
         """
         block.getOpcode()
         return genIndent(level) + "nextBackdrop();\n"
 
+    @genCodeFor('stmt', 'looks_changesizeby')
     def changeSizeBy(self, level, block, deferYield=False):
         """Generate code to change the size of the sprite
         """
         return genIndent(level) + "changeSizeBy(" + self.mathExpr(block, 'CHANGE') + ");\n"
 
+    @genCodeFor('stmt', 'looks_setsizeto')
     def setSizeTo(self, level, block, deferYield=False):
         """Generate code to change the size of the sprite to a certain percentage
         """
         return genIndent(level) + "setSizeTo(" + self.mathExpr(block, 'SIZE') + ");\n"
 
+    @genCodeFor('stmt', 'looks_gotofrontback')
     def goToFrontBack(self, level, block, deferYield=False):
         """Generate code to move the sprite to the front
         """
@@ -1970,6 +3502,7 @@ class SpriteOrStage:
         else:
             return genIndent(level) + "goToBack();\n"
 
+    @genCodeFor('stmt', 'looks_goforwardbackwardlayers')
     def goForwBackNLayers(self, level, block, deferYield=False):
         """Generate code to move the sprite back 1 layer in the paint order
         """
@@ -1979,6 +3512,7 @@ class SpriteOrStage:
         else:
             return genIndent(level) + "goBackwardNLayers(" + self.mathExpr(block, 'NUM') + ");\n"
 
+    @genCodeFor('stmt', 'looks_changeeffectby')
     def changeGraphicBy(self, level, block, deferYield=False):
         """Generate code to change the graphics effect on this sprite"""
         effect = block.getField('EFFECT')
@@ -2000,6 +3534,7 @@ class SpriteOrStage:
         else:
             return genIndent(level) + "// " + effect + " effect is not implemented\n"
 
+    @genCodeFor('stmt', 'looks_seteffectto')
     def setGraphicTo(self, level, block, deferYield=False):
         effect = block.getField('EFFECT')
         value = self.mathExpr(block, 'VALUE')
@@ -2020,18 +3555,23 @@ class SpriteOrStage:
         else:
             return genIndent(level) + "// " + effect + " effect is not implemented\n"
 
+    @genCodeFor('stmt', 'pen_clear')
     def penClear(self, level, block, deferYield=False):
         return genIndent(level) + "clear();\n"
 
+    @genCodeFor('stmt', 'pen_penDown')
     def penDown(self, level, block, deferYield=False):
         return genIndent(level) + "penDown();\n"
 
+    @genCodeFor('stmt', 'pen_penUp')
     def penUp(self, level, block, deferYield=False):
         return genIndent(level) + "penDown();\n"
 
+    @genCodeFor('stmt', 'pen_stamp')
     def penStamp(self, level, block, deferYield=False):
         return genIndent(level) + "stamp();\n"
 
+    @genCodeFor('stmt', 'pen_setPenColorToColor')
     def setPenColor(self, level, block, deferYield=False):
         # color is a string like "#a249e8"
         # TODO: TEST!
@@ -2039,12 +3579,15 @@ class SpriteOrStage:
         color = color[1:]  # lose the first # sign
         return genIndent(level) + 'setPenColor(new java.awt.Color(0x%s));\n' % color
 
+    @genCodeFor('stmt', 'pen_changePenSizeBy')
     def changePenSizeBy(self, level, block, deferYield=False):
         return genIndent(level) + "changePenSizeBy(" + self.mathExpr(block, 'SIZE') + ");\n"
 
+    @genCodeFor('stmt', 'pen_setPenSizeTo')
     def setPenSizeTo(self, level, block, deferYield=False):
         return genIndent(level) + "setPenSize(" + self.mathExpr(block, 'SIZE') + ");\n"
 
+    @genCodeFor('stmt', 'pen_changePenColorParamBy')
     def setPenColorParamBy(self, level, block, deferYield=False):
         """Change color or saturation, etc., by an amount"""
         thingToChange = block.getChild('COLOR_PARAM').getField('colorParam')
@@ -2053,6 +3596,7 @@ class SpriteOrStage:
         else:
             raise ValueError('Cannot change pen %s now' % thingToChange)
 
+    @genCodeFor('stmt', 'pen_setPenColorParamTo')
     def setPenColorParamTo(self, level, block, deferYield=False):
         """Set color or saturation, etc., to an amount"""
         thingToChange = block.getChild('COLOR_PARAM').getField('colorParam')
@@ -2106,6 +3650,7 @@ class SpriteOrStage:
             return (name, True)
         raise ValueError("Sprite " + self._name + " list " + listTok + " unknown.")
 
+    @genCodeFor('stmt', 'data_setvariableto')
     def setVariable(self, level, block, deferYield=False):
         """Set a variable's value from within the code.
         Generate code like this:
@@ -2117,7 +3662,7 @@ class SpriteOrStage:
             raise ValueError('No Variable object found for', block.getField('VARIABLE'))
 
         if var.getType() == 'Boolean':
-            val = self.boolExpr(block)
+            val = self.boolExprOrFalse(block, 'VALUE')
         elif var.getType() in ('Int', 'Double'):
             val = self.mathExpr(block, 'VALUE')
         else:
@@ -2146,6 +3691,7 @@ class SpriteOrStage:
     #         # Something like: world.counter.get();
     #         return "Stage.%s.get()" % varName
 
+    @genCodeFor('stmt', 'data_hidevariable')
     def hideVariable(self, level, block, deferYield=False):
         """Generate code to hide a variable.
         """
@@ -2157,6 +3703,7 @@ class SpriteOrStage:
         else:
             return genIndent(level) + var.getGfName() + ".hide();\n"
 
+    @genCodeFor('stmt', 'data_showvariable')
     def showVariable(self, level, block, deferYield=False):
         """Generate code to hide a variable.
         """
@@ -2167,6 +3714,7 @@ class SpriteOrStage:
         else:
             return genIndent(level) + var.getGfName() + ".show();\n"
 
+    @genCodeFor('stmt', 'data_changevariableby')
     def changeVarBy(self, level, block, deferYield=False):
         """Generate code to change the value of a variable.
         Code will be like this:
@@ -2185,6 +3733,7 @@ class SpriteOrStage:
             return genIndent(level) + varName + ".set(" + \
                    varName + ".get() + " + self.mathExpr(block, 'VALUE') + ");\n"
 
+    @genCodeFor('bool', 'data_listcontainsitem')
     def listContains(self, block):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2195,6 +3744,7 @@ class SpriteOrStage:
         else:
             return '(%s.contains(%s))' % (theList.getGfName(), item)
 
+    @genCodeFor('str', 'data_itemnumoflist')
     def listElement(self, block):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2205,6 +3755,7 @@ class SpriteOrStage:
         else:
             return "%s.indexOf(%s)" % (theList.getGfName(), item)
 
+    @genCodeFor('math', 'data_lengthoflist')
     def listLength(self, block):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2213,6 +3764,7 @@ class SpriteOrStage:
         else:
             return "%s.length()" % theList.getGfName()
 
+    @genCodeFor('stmt', 'data_addtolist')
     def listAppend(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2224,6 +3776,7 @@ class SpriteOrStage:
         else:
             return '%s%s.add(%s);\n' % (genIndent(level), theList.getGfName(), resStr)
 
+    @genCodeFor('stmt', 'data_deleteoflist')
     def listDeleteAt(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2234,6 +3787,7 @@ class SpriteOrStage:
         else:
             return "%s%s.deleteAt(%s);\n" % (genIndent(level), theList.getGfName(), index)
 
+    @genCodeFor('stmt', 'data_deletealloflist')
     def listDeleteAll(self, level, block, deferYield=False):
         """delete all the contents of the list"""
 
@@ -2246,6 +3800,7 @@ class SpriteOrStage:
             return '%s%s.deleteAll();\n' % (genIndent(level), theList.getGfName())
 
 
+    @genCodeFor('stmt', 'data_insertatlist')
     def listInsert(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2258,6 +3813,7 @@ class SpriteOrStage:
         else:
             return '%s%s.insertAt(%s, %s);\n' % (genIndent(level), theList.getGfName(), index, resStr)
 
+    @genCodeFor('stmt', 'data_replaceitemoflist')
     def listSet(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2270,6 +3826,7 @@ class SpriteOrStage:
         else:
             return '%s%s.replaceItem(%s, %s);\n' % (genIndent(level), theList.getGfName(), index, resStr)
 
+    @genCodeFor('stmt', 'hideList:')
     def hideList(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2278,6 +3835,7 @@ class SpriteOrStage:
         else:
             return "%s%s.hide();\n" % (genIndent(level), theList.getGfName())
 
+    @genCodeFor('stmt', 'showList:')
     def showList(self, level, block, deferYield=False):
         listId = block.getField('LIST', 1)   # index 1 is the list id.
         theList = getVariableByUniqueId(listId)
@@ -2286,17 +3844,32 @@ class SpriteOrStage:
         else:
             return "%s%s.show();\n" % (genIndent(level), theList.getGfName())
 
+    @genCodeFor('stmt', 'event_broadcast')
     def broadcast(self, level, block, deferYield=False):
         """Generate code to handle sending a broacast message.
         """
-        return genIndent(level) + "broadcast(" + self.strExpr(block, 'BROADCAST_INPUT') + ");\n"
+        return genIndent(level) + "broadcast(" + self.messageExpr(block, 'BROADCAST_INPUT') + ");\n"
 
+    @genCodeFor('stmt', 'event_broadcastandwait')
     def broadcastAndWait(self, level, block, deferYield=False):
         """Generate code to handle sending a broacast message and
         waiting until all the handlers have completed.
         """
-        return genIndent(level) + "broadcastAndWait(s, " + self.strExpr(block, 'BROADCAST_INPUT') + ");\n"
-
+        return genIndent(level) + "broadcastAndWait(s, " + self.messageExpr(block, 'BROADCAST_INPUT') + ");\n"
+
+    def messageExpr(self, block, key):
+        """Generate the message to broadcast: the constant for its id in the
+        World class if it is given by name, or else an expression for its
+        name, whose id is looked up when it is broadcast."""
+        if not block.hasChild(key):
+            value = block.getInput(key)[1]
+            if isinstance(value, list) and len(value) > 1:
+                constant = broadcastMessages.getConstant(value[1])
+                if constant is not None:
+                    return constant
+        return self.strExpr(block, key)
+
+    @genCodeFor('stmt', 'sensing_askandwait')
     def doAsk(self, level, block, deferYield=False):
         """Generate code to ask the user for input.  Returns the resulting string."""
 
@@ -2304,27 +3877,25 @@ class SpriteOrStage:
         return genIndent(level) + 'String answer = askStringAndWait(' + \
                question + ');\t\t// may want to replace answer with a better name\n'
 
+    @genCodeFor('stmt', 'control_wait')
     def doWait(self, level, block, deferYield=False):
         """Generate a wait call."""
         assert block.getOpcode() == "control_wait"
         # inputs: "DURATION": [ 1,  [  5,  "1" ] ]
         return genIndent(level) + "wait(s, " + self.mathExpr(block, 'DURATION') + ");\n"
 
-    def doRepeat(self, level, block, deferYield=False):
+    @genCodeFor('compound', 'control_repeat')
+    def doRepeat(self, out, level, block, deferYield=False):
         """Generate a repeat <n> times loop.
         """
-        retStr = genIndent(level) + "for (int i" + str(level) + " = 0; i" + str(level) + " < " + \
-                 self.mathExpr(block, 'TIMES') + "; i" + str(level) + "++)\n"
-        retStr += genIndent(level) + "{\n"
-        retStr += self.statements(level, block.getChild('SUBSTACK'))
-        if deferYield:
-            retStr += genIndent(level + 1) + \
-                      "deferredYield(s);   // allow other sequences to run occasionally\n"
-        else:
-            retStr += genIndent(level + 1) + \
-                      "yield(s);   // allow other sequences to run\n"
-        return retStr + genIndent(level) + "}\n"
-
+        out.write(genIndent(level) + "for (int i" + str(level) + " = 0; i" + str(level) + " < " +
+                  self.mathExpr(block, 'TIMES') + "; i" + str(level) + "++)\n")
+        out.write(genIndent(level) + "{\n")
+        self.statements(out, level, block.getChild('SUBSTACK'), deferYield)
+        out.write(self.loopYieldCode(level + 1, block, deferYield))
+        out.write(genIndent(level) + "}\n")
+
+    @genCodeFor('stmt', 'control_wait_until')
     def doWaitUntil(self, level, block, deferYield=False):
         """Generate doWaitUtil code: in java we'll do this:
            while (true) {
@@ -2338,10 +3909,15 @@ class SpriteOrStage:
         retStr += genIndent(level) + "while (true) {\n"
         retStr += genIndent(level + 1) + "if (" + condition + ")\n"
         retStr += genIndent(level + 2) + "break;\n"
-        retStr += genIndent(level + 1) + "yield(s);   // allow other sequences to run\n"
+        if deferYield:
+            retStr += genIndent(level + 1) + \
+                      "deferredYield(s);   // allow other sequences to run occasionally\n"
+        else:
+            retStr += genIndent(level + 1) + "yield(s);   // allow other sequences to run\n"
         return retStr + genIndent(level) + "}\n"
 
-    def repeatUntil(self, level, block, deferYield=False):
+    @genCodeFor('compound', 'control_repeat_until')
+    def repeatUntil(self, out, level, block, deferYield=False):
         """Generate doUntil code, which translates to this:
            while (! condition)
            {
@@ -2350,18 +3926,14 @@ class SpriteOrStage:
            }
         """
         condition = self.boolExprOrFalse(block, 'CONDITION')
-        retStr = genIndent(level) + "// repeat until code\n"
-        retStr += genIndent(level) + "while (! " + condition + ")\n"
-        retStr += genIndent(level) + "{\n"
-        retStr += self.statements(level, block.getChild('SUBSTACK'))
-        if deferYield:
-            retStr += genIndent(level + 1) + \
-                      "deferredYield(s);   // allow other sequences to run occasionally\n"
-        else:
-            retStr += genIndent(level + 1) + \
-                      "yield(s);   // allow other sequences to run\n"
-        return retStr + genIndent(level) + "}\n"
-
+        out.write(genIndent(level) + "// repeat until code\n")
+        out.write(genIndent(level) + "while (! " + condition + ")\n")
+        out.write(genIndent(level) + "{\n")
+        self.statements(out, level, block.getChild('SUBSTACK'), deferYield)
+        out.write(self.loopYieldCode(level + 1, block, deferYield))
+        out.write(genIndent(level) + "}\n")
+
+    @genCodeFor('stmt', 'control_stop')
     def stopScripts(self, level, block, deferYield=False):
         """Generate code to stop scripts: all, other, etc.
         """
@@ -2375,6 +3947,7 @@ class SpriteOrStage:
         else:
             raise ValueError("stopScripts: unknown option", option)
 
+    @genCodeFor('stmt', 'control_create_clone_of')
     def createCloneOf(self, level, block, deferYield=False):
         """Create a clone of the sprite itself or of the given sprite.
         """
@@ -2382,20 +3955,28 @@ class SpriteOrStage:
         if argVal == "_myself_":
             return genIndent(level) + "createCloneOfMyself();\n"
         else:
-            return genIndent(level) + 'createCloneOf("' + argVal + '");\n'
+            return genIndent(level) + 'createCloneOf(' + self.spriteExpr(block, 'CLONE_OPTION') + ');\n'
 
+    @genCodeFor('stmt', 'control_delete_this_clone')
     def deleteThisClone(self, level, block, deferYield=False):
         """Delete this sprite.
         """
         return genIndent(level) + "deleteThisClone();\n"
 
+    @genCodeFor('stmt', 'sensing_resettimer')
     def resetTimer(self, level, block, deferYield=False):
         return genIndent(level) + "resetTimer();\n"
 
+    @genCodeFor('hat', 'procedures_definition')
     def genProcDefCode(self, codeObj, topBlock):
         """Generate code for a custom block definition in Scratch.
         All the generated code goes into codeObj's cbCode since it doesn't
         belong in the constructor.
+        A custom block that runs without screen refresh (warp) does not
+        yield in its loops, except every so often through deferredYield(),
+        as Scratch redraws the screen if a warp script runs too long.  A
+        custom block called from a warp one also gets a second version of
+        its code like that, named with "Warp" after it.
         """
 
         # topBlock has a child, 'procedures_prototype', that has the info like this:
@@ -2422,24 +4003,27 @@ class SpriteOrStage:
 
         assert len(paramTypes) == len(paramNames)
 
-        if len(paramTypes) == 0:
-            codeObj.addToCbCode(genIndent(1) + "private void " + funcname + "(Sequence s")
-        else:
-            codeObj.addToCbCode(genIndent(1) + "private void " + funcname + "(Sequence s, ")
+        versions = [(funcname, block.isProcWarp())]
+        if block.getProcCode() in self._procsCalledInWarp:
+            versions.append((funcname + "Warp", True))
 
-        for i in range(len(paramTypes)):
-            if paramTypes[i] == 'stringOrNumber':
-                t = 'String'  # Assuming everything is a string now... nasty.
+        for (name, warp) in versions:
+            if len(paramTypes) == 0:
+                codeObj.addToCbCode(genIndent(1) + "private void " + name + "(Sequence s")
             else:
-                t = 'boolean'
-            codeObj.addToCbCode(t + " " + paramNames[i])
-            # Add following ", " if not add end of list.
-            if i < len(paramTypes) - 1:
-                codeObj.addToCbCode(", ")
-
-        codeObj.addToCbCode(")\n")
-        codeObj.addToCbCode(self.block(1, topBlock.getNext()))
-        codeObj.addToCbCode("\n")  # add blank line after function defn.
+                codeObj.addToCbCode(genIndent(1) + "private void " + name + "(Sequence s, ")
+
+            # The types found by findProcParamTypes().
+            javaTypes = self._procParamTypes[block.getProcCode()]
+            for i in range(len(paramTypes)):
+                codeObj.addToCbCode(javaTypes[i] + " " + paramNames[i])
+                # Add following ", " if not add end of list.
+                if i < len(paramTypes) - 1:
+                    codeObj.addToCbCode(", ")
+
+            codeObj.addToCbCode(")\n")
+            self.block(codeObj.cbCode, 1, topBlock.getNext(), warp)
+            codeObj.addToCbCode("\n")  # add blank line after function defn.
         return codeObj
 
     def extractInfoFromProcCode(self, block):
@@ -2479,6 +4063,7 @@ class SpriteOrStage:
             # ignore those (for now)
         return func2Call, argsList
 
+    @genCodeFor('stmt', 'procedures_call')
     def callABlock(self, level, block, deferYield=False):
         """Generate a call to a custom-defined block.
         inputs in the block look like this:
@@ -2504,13 +4089,18 @@ class SpriteOrStage:
             "warp": "false"
         }
         The name of the function to call is only found in the proccode, afaict.
-        It is (perhaps) impossible to tell if an argument is supposed to be a 
-        string or a number.  So, we'll try to evaluate as a number, and if that
-        fails, try strExpr, and if that fails, boolean expression.
+        Each argument is evaluated as the type of its parameter (see
+        findProcParamTypes()).  If the custom block is not defined, it is
+        evaluated as a number if it is one, and otherwise as a string.
+        Called from a custom block that runs without screen refresh
+        (deferYield is True), a custom block that does not do so itself is
+        called in its version that does: see genProcDefCode().
         """
 
         (func2Call, argTypes) = self.extractInfoFromProcCode(block)
         func2Call = convertToJavaId(func2Call)
+        if deferYield and block.getProcCode() in self._procsCalledInWarp:
+            func2Call += "Warp"
 
         if len(argTypes) == 0:
             return genIndent(level) + func2Call + "(s);\n"
@@ -2523,13 +4113,19 @@ class SpriteOrStage:
         argIdList = block.getProcCallArgIds()
 
         # each argId is in inputs.
+        javaTypes = self._procParamTypes.get(block.getProcCode())
         resStrs = []
         for argIdx in range(len(argIdList)):  # skip last one.
             argId = argIdList[argIdx]
             if argTypes[argIdx] == 'stringOrNumber':
-                try:
+                if javaTypes is not None:
+                    if javaTypes[argIdx] == 'String':
+                        resStrs.append(self.strExpr(block, argId))
+                    else:
+                        resStrs.append(self.mathExpr(block, argId))
+                elif 'math' in self.exprTypes(block, argId):
                     resStrs.append(self.mathExpr(block, argId))
-                except:
+                else:
                     resStrs.append(self.strExpr(block, argId))
             else:  # boolean
                 boolExprBlock = block.getChild(argId)
@@ -2538,18 +4134,21 @@ class SpriteOrStage:
         resStr += ', '.join(resStrs) + ');\n'
         return resStr
 
+    @genCodeFor('stmt', 'sound_play')
     def playSound(self, level, block, deferYield=False):
         """ Play the given sound
         """
         sound = block.getChild('SOUND_MENU').getField('SOUND_MENU')
         return genIndent(level) + 'playSound("' + sound + '");\n'
 
+    @genCodeFor('stmt', 'sound_playuntildone')
     def playSoundUntilDone(self, level, block, deferYield=False):
         """ Play the given sound without interrupting it.
         """
         sound = block.getChild('SOUND_MENU').getField('SOUND_MENU')
         return genIndent(level) + 'playSoundUntilDone("' + sound + '");\n'
 
+    @genCodeFor('stmt', 'music_playNoteForBeats')
     def playNote(self, level, block, deferYield=False):
         """ Play the given note for a given number of beats
         """
@@ -2557,12 +4156,14 @@ class SpriteOrStage:
         return genIndent(level) + "playNote(s, " + note + ", " + \
                self.mathExpr(block, 'BEATS') + ");\n"
 
+    @genCodeFor('stmt', 'music_setInstrument')
     def instrument(self, level, block, deferYield=False):
         """ Play the given instrument
         """
         instr = self.evalExprOrMenuItem(block, 'INSTRUMENT')
         return genIndent(level) + "changeInstrument(" + instr + ");\n"
 
+    @genCodeFor('stmt', 'music_playDrumForBeats')
     def playDrum(self, level, block, deferYield=False):
         """ Play the given drum
         """
@@ -2570,16 +4171,19 @@ class SpriteOrStage:
         return genIndent(level) + "playDrum(s, " + drum + ", " + \
                self.mathExpr(block, 'BEATS') + ");\n"
 
+    @genCodeFor('stmt', 'music_restForBeats')
     def rest(self, level, block, deferYield=False):
         """ Play a rest for the given number of beats.
         """
         return genIndent(level) + "rest(s, " + self.mathExpr(block, 'BEATS') + ");\n"
 
+    @genCodeFor('stmt', 'music_changeTempo')
     def changeTempoBy(self, level, block, deferYield=False):
         """ Change the tempo.
         """
         return genIndent(level) + "changeTempoBy(" + self.mathExpr(block, 'TEMPO') + ");\n"
 
+    @genCodeFor('stmt', 'music_setTempo')
     def setTempoTo(self, level, block, deferYield=False):
         """ Set the tempo
         """
@@ -2622,27 +4226,15 @@ class SpriteOrStage:
         associated with either a sprite or the main stage.
         """
 
-        codeObj = CodeAndCb()  # Holds all the code that is generated.
-
-        opcode = topBlock.getOpcode()
-        if opcode == 'event_whenflagclicked':
-            self.whenFlagClicked(codeObj, topBlock)
-        elif opcode == 'control_start_as_clone':
-            self.whenSpriteCloned(codeObj, topBlock)
-        elif opcode == 'event_whenthisspriteclicked':
-            self.whenClicked(codeObj, topBlock)
-        elif opcode == 'event_whenkeypressed':
-            self.whenKeyPressed(codeObj, topBlock)
-        elif opcode == 'event_whenbroadcastreceived':
-            self.whenIReceive(codeObj, topBlock)
-        elif opcode == 'procedures_definition':
-            self.genProcDefCode(codeObj, topBlock)
-        elif opcode == 'event_whenbackdropswitchesto':
-            self.whenSwitchToBackdrop(codeObj, topBlock)
-
-        # If not in one of the above "hat blocks", then it is an
-        # orphaned bit of code that will not be run in either Scratch
-        # or ScratchFoot.
+        # The code that is generated goes straight into this sprite's code.
+        codeObj = CodeAndCb(self._regCallbacksCode, self._cbCode)
+
+        genCodeFunc = self.getGenCodeTable('hat').get(topBlock.getOpcode())
+        if genCodeFunc is not None:
+            genCodeFunc(self, codeObj, topBlock)
+
+        # If not a "hat block", then it is an orphaned bit of code that will
+        # not be run in either Scratch or ScratchFoot.
 
         return codeObj
 
@@ -2720,10 +4312,9 @@ class Sprite(SpriteOrStage):
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(1) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.topBlock(1, block) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(1) + "public void " + cbName + "(Sequence s)\n")
+        self.topBlock(codeObj.cbCode, 1, block)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
 
 class Stage(SpriteOrStage):
@@ -2744,32 +4335,34 @@ class Stage(SpriteOrStage):
     def genListDefnCode(self, level, var):
         return genIndent(level) + 'static ScratchList %s;\n' % var.getGfName()
 
-    def genConstructorCode(self):
-        """Generate code for the constructor.
+    def genConstructorCode(self, out):
+        """Write the code for the constructor to out, a CodeEmitter.
         This code will include calls to initialize data, etc., followed by code
         to register callbacks for whenFlagClicked,
         whenKeyPressed, etc.
         Differs from super class in that the costumes code not generated
         for Stage.
         """
-        self._ctorCode = genIndent(1) + "public " + self._name + "()\n"
-
-        self._ctorCode += genIndent(1) + "{\n"
-        self._ctorCode += self._initSettingsCode
-        self._ctorCode += self._regCallbacksCode
-        self._ctorCode += genIndent(1) + "}\n"
+        out.writeLine(1, "public " + self._name + "()")
+        out.writeLine(1, "{")
+        out.write(self._initSettingsCode)
+        self._regCallbacksCode.copyTo(out)
+        out.writeLine(1, "}")
 
-    def genLoadCostumesCode(self, costumes):
+    def genLoadCostumesCode(self, costumes, renameImages=True):
         """Generate code to load backdrops from files for the Stage.
         Note that this code is actually included in the World constructor.
-        This code also renames the backdrop names to be more readable.
+        This code also renames the backdrop names to be more readable,
+        unless renameImages is False because that was done by an earlier
+        conversion.
         """
         resStr = ""
         for costume in costumes:
             fname = costume['assetId'] + ".png"
             readable_name = 'stage-' + costume['name'] + ".png"
             readable_fname = imagesDir + '/' + readable_name
-            os.rename(imagesDir + "/" + fname, readable_fname)
+            if renameImages:
+                os.rename(imagesDir + "/" + fname, readable_fname)
             resStr += genIndent(2) + 'addBackdrop("' + readable_name + \
                       '", "' + costume['name'] + '");\n'
         self._costumeCode += resStr
@@ -2784,10 +4377,9 @@ class Stage(SpriteOrStage):
 
         # Generate callback code, into the codeObj's cbCode string.
         # Add two blank lines before each method definition.
-        cbStr = "\n\n" + genIndent(1) + "public void " + cbName + \
-                "(Sequence s)\n"
-        cbStr += self.block(1, tokens) + "\n"  # add blank line after defn.
-        codeObj.addToCbCode(cbStr)
+        codeObj.addToCbCode("\n\n" + genIndent(1) + "public void " + cbName + "(Sequence s)\n")
+        self.block(codeObj.cbCode, 1, tokens)
+        codeObj.addToCbCode("\n")  # add blank line after defn.
 
     def genInitSettingsCode(self):
         """Generate code to set the Stages initial settings: 
@@ -2821,27 +4413,146 @@ class Stage(SpriteOrStage):
         # Open file with correct name and generate code into there.
         filename = os.path.join(PROJECT_DIR, convertSpriteToFileName(self._name))
         print("Writing code to " + filename + ".")
-        outFile = open(filename, "w")
-        self.genHeaderCode()
-        outFile.write(self._fileHeaderCode)
-        outFile.write(self._varDefnCode)
+        with open(filename, "w", buffering=OUTPUT_BUFFER_BYTES) as outFile:
+            out = CodeEmitter(outFile)
+            self.genHeaderCode()
+            out.write(self._fileHeaderCode)
+            out.write(self._varDefnCode)
 
-        self.genConstructorCode()
-        outFile.write(self._ctorCode)
+            self.genConstructorCode(out)
 
-        for code in self._cbCode:
-            outFile.write(code)
+            self._cbCode.copyTo(out)
+            out.write(self.genSpriteRefsCode())
 
-        outFile.write(self._addedToWorldCode)
-        outFile.write(self._bgCode)
+            self._addedToWorldCode.copyTo(out)
+            out.write(self._bgCode)
 
-        outFile.write("}\n")
-        outFile.close()
+            out.writeLine(0, "}")
+        self._regCallbacksCode.close()
+        self._cbCode.close()
+        self._addedToWorldCode.close()
 
 
 # End of Stage class definition
 # ---------------------------------------------------------------------------
 
+# Hat blocks whose scripts become callbacks.  Each one uses one script id
+# from CodeAndCb.cbScriptId (see genScriptCode()).
+CALLBACK_HAT_OPCODES = ('event_whenflagclicked', 'control_start_as_clone', 'event_whenthisspriteclicked',
+                        'event_whenkeypressed', 'event_whenbroadcastreceived', 'event_whenbackdropswitchesto')
+
+
+def countCallbackScripts(targetData):
+    """Return the number of script ids that generating code for the target
+    (a sprite or the stage) will use."""
+    return sum(1 for b in targetData.get('blocks', {}).values()
+               if isinstance(b, dict) and b.get('topLevel') and b['opcode'] in CALLBACK_HAT_OPCODES)
+
+
+_converterHash = None
+
+
+def getConverterHash():
+    """Return a hash of this program, so that fingerprints made by a different
+    version of it never match."""
+    global _converterHash
+    if _converterHash is None:
+        with open(os.path.abspath(__file__), "rb") as f:
+            _converterHash = hashlib.sha1(f.read()).hexdigest()
+    return _converterHash
+
+
+class TargetFingerprints:
+    """Remembers, in a file in the greenfoot project directory, a fingerprint
+    of each target (sprite or stage) that was converted.  When the project is
+    converted again, a target whose fingerprint has not changed is skipped:
+    its images, sounds and .java file are left untouched, so Greenfoot does
+    not have to recompile it.
+
+    A fingerprint is a hash of the target's json (except its x,y position,
+    which is only used in the World class), the stage's variables and lists,
+    which every target can refer to, the broadcast messages, whose ids every
+    target uses, the names of the sprites, which any target can refer to,
+    the types of all the variables, which the scripts of any target can
+    change, the conversion settings, and this
+    program itself.  Callback names are numbered across all targets, so a
+    target is also regenerated if its first script id has moved.
+    """
+
+    FILENAME = ".s2g-fingerprints.json"
+
+    def __init__(self, projectDir, targets, enabled=True):
+        """targets is the list of targets from project.json.  If enabled is
+        False, no target is considered unchanged, but the new fingerprints
+        are still saved for next time."""
+        self._filename = os.path.join(projectDir, self.FILENAME)
+        old = {}
+        if enabled:
+            try:
+                with open(self._filename, encoding="utf_8") as f:
+                    old = json.load(f)
+            except (OSError, ValueError):
+                pass  # never converted before, or unreadable: regenerate everything.
+
+        stageData = [t for t in targets if t['isStage']][0]
+        context = json.dumps([getConverterHash(), worldClassName, inference, name_resolution, yieldEvery,
+                              steppedScripts, stageData['variables'], stageData['lists'],
+                              broadcastMessages.getNames(), sorted(spriteClassNames),
+                              variableTypes.getTypes()], sort_keys=True)
+
+        self._new = {}
+        self._unchanged = set()
+        # Sprites are generated first, then the stage: see convertArchive().
+        scriptId = 0
+        for t in [t for t in targets if not t['isStage']] + [stageData]:
+            target = {k: v for k, v in t.items() if k not in ('x', 'y')}
+            h = hashlib.sha1((context + json.dumps(target, sort_keys=True)).encode("utf_8")).hexdigest()
+            numScripts = countCallbackScripts(t)
+            self._new[t['name']] = {'hash': h, 'firstScriptId': scriptId, 'numScripts': numScripts}
+            className = "Stage" if t['isStage'] else convertToJavaId(t['name'], True, True)
+            if old.get(t['name']) == self._new[t['name']] and \
+                    os.path.isfile(os.path.join(projectDir, convertSpriteToFileName(className))):
+                self._unchanged.add(t['name'])
+            scriptId += numScripts
+
+        # Images used only by unchanged targets do not need to be converted.
+        unchangedAssets = set()
+        changedAssets = set()
+        for t in targets:
+            assets = unchangedAssets if t['name'] in self._unchanged else changedAssets
+            assets.update(c['assetId'] for c in t['costumes'])
+        self._skippedAssetIds = unchangedAssets - changedAssets
+
+    def isUnchanged(self, targetData):
+        return targetData['name'] in self._unchanged
+
+    def getNumScripts(self, targetData):
+        return self._new[targetData['name']]['numScripts']
+
+    def getSkippedAssetIds(self):
+        """Return the set of costume assetIds used only by unchanged targets."""
+        return self._skippedAssetIds
+
+    def save(self):
+        with open(self._filename, "w", encoding="utf_8") as f:
+            json.dump(self._new, f, indent=1, sort_keys=True)
+
+
+def writeFileIfChanged(filename, text):
+    """Write text into the file, unless the file already holds exactly that
+    text, so that Greenfoot does not see it as modified."""
+    try:
+        with open(filename, encoding="utf_8") as f:
+            if f.read() == text:
+                print(filename + " is unchanged.")
+                return
+    except OSError:
+        pass
+    print("Writing code to " + filename + ".")
+    with open(filename, "w", encoding="utf_8") as f:
+        f.write(text)
+
+
 def convertSpriteToFileName(sprite):
     """Make the filename with all words from sprite capitalized and
     joined, with no spaces between."""
@@ -2882,9 +4593,278 @@ def genWorldCtorHeader(classname):
 #                ----------------- main -------------------
 # ---------------------------------------------------------------------------
 
-def convertSvgToPng(imagesDir, fullfname):
-    # fname is just the file name -- all directories removed.
-    fname = os.path.basename(fullfname)
+class ImageJob:
+    """One external command that converts an image from the .sb3 archive
+    into the png file dest in the images directory.  The image data is
+    piped into the command on stdin.  tool is the program run, and params
+    describes how it converts the image, e.g., "resize 50%"."""
+
+    def __init__(self, fname, dest, tool, params, cmd, descr, data):
+        self.fname = fname
+        self.dest = dest
+        self.tool = tool
+        self.params = params
+        self.cmd = cmd
+        self.descr = descr
+        self.data = data
+
+    def getAssetId(self):
+        # Files in the .sb3 archive are named by their assetId, an md5 of the contents.
+        return os.path.splitext(self.fname)[0]
+
+    def run(self):
+        """Run the command, returning None on success or an error message.
+        Output is captured, not printed, so that jobs can be run in parallel."""
+        try:
+            res = run(self.cmd, shell=True, input=self.data, stdout=PIPE, stderr=PIPE)
+        except OSError as e:
+            return "Execution failed: " + str(e)
+        if res.returncode < 0:
+            return "Terminated by signal %d" % -res.returncode
+        if res.returncode != 0:
+            return res.stderr.decode(errors="replace").strip() or \
+                   "Exited with status %d" % res.returncode
+        return None
+
+
+class ImageCache:
+    """A directory of converted png files, shared by all conversions, so that
+    an image that is in many projects (e.g., from the Scratch sprite library)
+    is converted only once.  Each file is named by a hash of the image's
+    assetId, the conversion done to it and the version of the tool that
+    did it.  When the cache grows beyond maxBytes, the least recently used
+    files are removed.
+    """
+
+    def __init__(self, cacheDir, maxBytes):
+        self._dir = cacheDir
+        self._maxBytes = maxBytes
+        self._toolVersions = {}
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def _getToolVersion(self, tool):
+        if tool not in self._toolVersions:
+            try:
+                res = run(tool + " --version", shell=True, stdout=PIPE, stderr=PIPE)
+                lines = res.stdout.decode(errors="replace").splitlines()
+                self._toolVersions[tool] = lines[0].strip() if lines else ""
+            except OSError:
+                self._toolVersions[tool] = ""
+        return self._toolVersions[tool]
+
+    def _getPath(self, job):
+        key = "\0".join((job.getAssetId(), job.tool, job.params, self._getToolVersion(job.tool)))
+        return os.path.join(self._dir, hashlib.sha1(key.encode("utf_8")).hexdigest() + ".png")
+
+    def fetch(self, job):
+        """If the result of job is in the cache, put it at job.dest and return
+        True.  Otherwise, return False."""
+        path = self._getPath(job)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return False
+        # A copy, not a link, so that editing the image in the Greenfoot
+        # project can never change the cached file.  The old file is removed
+        # first, as an earlier version of this tool may have linked it to
+        # the cached one.
+        if os.path.lexists(job.dest):
+            os.remove(job.dest)
+        shutil.copyfile(path, job.dest)
+        # Mark the file as recently used.
+        os.utime(path)
+        self.hits += 1
+        return True
+
+    def store(self, job):
+        """Add the file produced by job to the cache."""
+        path = self._getPath(job)
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        shutil.copyfile(job.dest, tmpPath)
+        # Atomic, so that another conversion never sees a partial file.
+        os.replace(tmpPath, path)
+
+    def evict(self):
+        """Remove least recently used files until the cache fits in maxBytes."""
+        evictLeastRecentlyUsed(self._dir, ".png", self._maxBytes)
+
+    def __str__(self):
+        return "Image cache %s: %d hits, %d misses" % (self._dir, self.hits, self.misses)
+
+
+def evictLeastRecentlyUsed(cacheDir, suffix, maxBytes):
+    """Remove the least recently used (modified) files ending with suffix from
+    cacheDir until those files total no more than maxBytes."""
+    entries = []
+    for entry in os.scandir(cacheDir):
+        if entry.is_file() and entry.name.endswith(suffix):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another conversion removed it already.
+        total -= size
+
+
+class ParsedProject:
+    """The results of parsing a project that are worth keeping between
+    conversions of the same project.json: for each target, its linked block
+    graph (as the tuples made by Block.toTuple()), and the value, type and
+    java name chosen for each of its variables."""
+
+    def __init__(self, blocks=None, varChoices=None, keepBlocks=True):
+        self._blocks = blocks or {}
+        self._varChoices = varChoices or {}
+        # If False, this is not going to be stored, so block graphs,
+        # which are large, are not kept.
+        self._keepBlocks = keepBlocks
+        # True if something has been added since this was loaded.
+        self.changed = False
+
+    def getBlocks(self, targetName):
+        return self._blocks.get(targetName)
+
+    def setBlocks(self, targetName, blocks):
+        """Keep the list of the target's Blocks, in order of id."""
+        if self._keepBlocks:
+            self._blocks[targetName] = [block.toTuple() for block in blocks]
+            self.changed = True
+
+    def getVarChoice(self, targetName, uniqId):
+        """Return (value, type, gfName) for the variable, or None."""
+        choice = self._varChoices.get(targetName + "/" + uniqId)
+        return tuple(choice) if choice is not None else None
+
+    def setVarChoice(self, targetName, uniqId, choice):
+        self._varChoices[targetName + "/" + uniqId] = choice
+        self.changed = True
+
+    def toBytes(self):
+        # json, not pickle, as the cache may be shared, and loading a pickle
+        # can run arbitrary code.  Tuples come back as lists, which
+        # Block.fromTuples() and getVarChoice() accept.
+        data = json.dumps({"blocks": self._blocks, "varChoices": self._varChoices}, separators=(",", ":"))
+        return zlib.compress(data.encode("utf_8"))
+
+    @staticmethod
+    def fromBytes(data):
+        data = json.loads(zlib.decompress(data).decode("utf_8"))
+        return ParsedProject(data["blocks"], data["varChoices"])
+
+
+class ParseCache:
+    """A directory of ParsedProjects, shared by all conversions, so that
+    converting the same project again (e.g., in a regression run over a
+    fixed set of projects) does not parse it again.  Entries are keyed by a
+    hash of project.json, the conversion settings and this program, so a
+    change to any of them is a miss.  When the directory grows beyond
+    maxBytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, cacheDir, maxBytes):
+        self._dir = cacheDir
+        self._maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def getKey(self, projectJsonHash):
+        key = "\0".join((projectJsonHash, getConverterHash(), str(inference), str(name_resolution)))
+        return hashlib.sha1(key.encode("utf_8")).hexdigest()
+
+    def _getPath(self, key):
+        return os.path.join(self._dir, key + ".parsed")
+
+    def load(self, key):
+        """Return the ParsedProject stored under key, or an empty one."""
+        path = self._getPath(key)
+        try:
+            with open(path, "rb") as f:
+                parsed = ParsedProject.fromBytes(f.read())
+        except FileNotFoundError:
+            print("Parse cache miss")
+            return ParsedProject()
+        except Exception as e:
+            print("Ignoring unreadable parse cache entry " + path + ":", e)
+            return ParsedProject()
+        # Mark the file as recently used.
+        os.utime(path)
+        print("Parse cache hit")
+        return parsed
+
+    def store(self, key, parsed):
+        if not parsed.changed:
+            return
+        path = self._getPath(key)
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmpPath, "wb") as f:
+            f.write(parsed.toBytes())
+        # Atomic, so that another conversion never sees a partial file.
+        os.replace(tmpPath, path)
+        evictLeastRecentlyUsed(self._dir, ".parsed", self._maxBytes)
+
+
+def runImageJobs(jobs, numWorkers, cache=None):
+    """Run the ImageJobs on a pool of at most numWorkers threads -- the work is
+    done in child processes, so threads are enough.  Jobs whose results are
+    in the cache are not run.  Report each job's result in the order of jobs,
+    not the order they finish, so that the output is the same from run to run.
+    Exit if any job failed."""
+    if cache is not None:
+        toRun = [job for job in jobs if not cache.fetch(job)]
+    else:
+        toRun = jobs
+    with ThreadPoolExecutor(max_workers=numWorkers) as pool:
+        errors = dict(zip(toRun, pool.map(ImageJob.run, toRun)))
+    failed = False
+    for job in jobs:
+        if job not in errors:
+            print("Using cached image for " + job.fname)
+            continue
+        print("Executing shell command: " + job.cmd)
+        err = errors[job]
+        if err is None:
+            print("Command to " + job.descr + " succeeded")
+            if cache is not None:
+                cache.store(job)
+        else:
+            print("Command to " + job.descr + " for " + job.fname + " failed:", err, file=sys.stderr)
+            failed = True
+    if cache is not None:
+        cache.evict()
+        print(cache)
+    if failed:
+        sys.exit(1)
+
+
+def pngResizeJob(imagesDir, fname, pngData):
+    """Return the ImageJob that copies a png file to the images dir, but
+    if it is large (which probably means it is a background image)
+    converts it to 480x360."""
+    try:
+        width, height = getImageSize(fname, pngData)
+    except ValueError as e:
+        print("Could not read size of image " + fname + ":", e)
+        sys.exit(1)
+    dest = os.path.join(imagesDir, fname)
+    if width >= 480:
+        # For now, just make 480x360.  This may not be correct in all cases.
+        size = "480x360"
+    else:
+        size = "50%"
+    return ImageJob(fname, dest, "convert", "resize " + size,
+                    "convert -resize " + size + " png:- " + dest,
+                    "copy and resize png file", pngData)
+
+
+def svgToPngJob(imagesDir, fname, svgData):
+    """Return the ImageJob that converts an svg file to a png in the images dir."""
+    # fname is the name of the svg file in the archive; svgData is its contents,
+    # which is piped into the converter so that the svg is never written to disk.
     dest = os.path.join(imagesDir, fname)
     dest = os.path.splitext(dest)[0] + ".png"  # remove extension and add .png
     # background -None keeps the transparent part of the image transparent.
@@ -2892,7 +4872,8 @@ def convertSvgToPng(imagesDir, fullfname):
     # same size as you see on the screen with Scratch in the web browser.
     # TODO: on my Mac, convert is not converting the Ball svg images correctly, but
     # rsvg-convert does.  So, let's try that:
-    execOrDie("rsvg-convert " + fullfname + " -o " + dest, "convert svg file to png")
+    return ImageJob(fname, dest, "rsvg-convert", "svg to png", "rsvg-convert -o " + dest,
+                    "convert svg file to png", svgData)
 
 
 # execOrDie("convert -background None " + f + " " + dest,
@@ -2900,25 +4881,47 @@ def convertSvgToPng(imagesDir, fullfname):
 
 
 def convert():
-    global SCRATCH_FILE
+    if isinstance(SCRATCH_FILE, str) and not os.path.exists(SCRATCH_FILE):
+        print("Scratch download file " + SCRATCH_FILE + " not found.")
+        sys.exit(1)
+
+    # Costumes, sounds and project.json are all read straight out of the
+    # .sb3 (zip) file, so nothing is unpacked into the project directory.
+    resetConversionState()
+    with Sb3Archive(SCRATCH_FILE) as archive:
+        convertArchive(archive)
+
+
+def convertArchive(archive):
     global PROJECT_DIR
-    global SCRATCH_PROJ_DIR
 
     global imagesDir
     global soundsDir
     global worldClassName
     global stage
     global onlyDecode
-
-    # Make a directory into which to unzip the scratch zip file.
-    scratch_dir = os.path.join(PROJECT_DIR, SCRATCH_PROJ_DIR)
+    global parsedProject
+    global broadcastMessages
+    global spriteClassNames
+    global variableTypes
+
+    data = archive.getProjectJson()
+    broadcastMessages = BroadcastMessages(data['targets'])
+    variableTypes = VariableTypes(data['targets'])
+    spriteClassNames = {t['name']: convertToJavaId(t['name'], True, True)
+                        for t in data['targets'] if not t['isStage']}
+
+    parseCache = None
+    if imageCacheDir is not None and not useGui:
+        parseCache = ParseCache(os.path.join(imageCacheDir, "parsed"), parseCacheMaxMB * 1024 * 1024)
+        parseCacheKey = parseCache.getKey(archive.getProjectJsonHash())
+        parsedProject = parseCache.load(parseCacheKey)
+    else:
+        parsedProject = ParsedProject(keepBlocks=False)
 
     if not onlyDecode:
-        print("------------ Processing " + SCRATCH_FILE + ' ---------------\n')
+        print("------------ Processing " + archive.getName() + ' ---------------\n')
 
-        if not os.path.exists(SCRATCH_FILE):
-            print("Scratch download file " + SCRATCH_FILE + " not found.")
-            sys.exit(1)
         if not os.path.exists(PROJECT_DIR):
             if useGui:
                 if (tkinter.messagebox.askokcancel("Make New Directory",
@@ -2938,92 +4941,76 @@ def convert():
             print("Greenfoot folder " + PROJECT_DIR + " is not a directory.")
             sys.exit(1)
 
-        try:
-            os.mkdir(scratch_dir)
-        except FileExistsError as e:
-            pass  # If the directory exists already, no problem.
-
-        # Unzip the .sb3 file into the project/scratch_code directory.
-        print("Unpacking Scratch download file.")
-        shutil.unpack_archive(SCRATCH_FILE, scratch_dir, "zip")
-
         # Make directories if they don't exist yet
         if not os.path.exists(imagesDir):
             os.makedirs(imagesDir)
         if not os.path.exists(soundsDir):
             os.makedirs(soundsDir)
 
+        worldClassName = convertToJavaId(os.path.basename(PROJECT_DIR).replace(" ", ""), True, True) + "World"
+
+        fingerprints = TargetFingerprints(PROJECT_DIR, data['targets'], incremental)
+        skippedAssetIds = fingerprints.getSkippedAssetIds()
+
         print("Copying image files to " + imagesDir)
 
-        files2Copy = glob.glob(os.path.join(scratch_dir, "*.png"))
-        for f in files2Copy:
-            # Copy png files over to the images dir, but if they are large
-            # (which probably means they are background images) convert
-            # them to 480x360.
-            res = getstatusoutput("identify " + f)
-            if res[0] != 0:
-                print(res[1])
-                sys.exit(1)
-            # Output from identify is like this:
-            # 3.png PNG 960x720 960x720+0+0 8-bit sRGB 428KB 0.000u 0:00.000
-            size = res[1].split()[2]  # got the geometry.
-            width, height = size.split("x")  # got the width and height, as strings
-            width = int(width)
-            height = int(height)
-            if width >= 480:
-                # For now, just make 480x360.  This may not be correct in all cases.
-                dest = os.path.join(imagesDir, os.path.basename(f))
-                execOrDie("convert -resize 480x360 " + f + " " + dest,
-                          "copy and resize png file")
-            else:
-                dest = os.path.join(imagesDir, os.path.basename(f))
-                execOrDie("convert -resize 50% " + f + " " + dest,
-                          "copy and resize png file")
+        # Build the list of image conversions, then run them in parallel.
+        imageJobs = [pngResizeJob(imagesDir, f, archive.readMember(f))
+                     for f in archive.getMemberNames(".png")
+                     if os.path.splitext(f)[0] not in skippedAssetIds]
 
         # Convert svg images files to png files in the images dir.
-        files2Copy = glob.glob(os.path.join(scratch_dir, "*.svg"))
-        for f in files2Copy:
-            convertSvgToPng(imagesDir, f)
+        for f in archive.getMemberNames(".svg"):
+            if os.path.splitext(f)[0] in skippedAssetIds:
+                continue
+            svgData = archive.readMember(f)
+            if debug:
+                try:
+                    print("Image %s is %gx%g" % ((f,) + getImageSize(f, svgData)))
+                except ValueError as e:
+                    print("Could not read size of image " + f + ":", e)
+            imageJobs.append(svgToPngJob(imagesDir, f, svgData))
+
+        cache = None
+        if imageCacheDir is not None:
+            cache = ImageCache(imageCacheDir, imageCacheMaxMB * 1024 * 1024)
+        runImageJobs(imageJobs, numImageWorkers, cache)
 
         # Copy Scratch.java and ScratchWorld.java to GF project directory
-        # They must be in the same directory as s2g.py
+        # They must be in the same directory as s2g.py (SCRIPT_DIR)
         try:
-            # If the file already exists, skip copying it
-            if not os.path.isfile(os.path.join(PROJECT_DIR, "Scratch.java")):
-                shutil.copyfile("Scratch.java", os.path.join(PROJECT_DIR, "Scratch.java"))
-                print("Scratch.java copied successfully")
-            else:
-                print("Scratch.java was already in the project directory")
-            if not os.path.isfile(os.path.join(PROJECT_DIR, "ScratchWorld.java")):
-                shutil.copyfile("ScratchWorld.java", os.path.join(PROJECT_DIR, "ScratchWorld.java"))
-                print("ScratchWorld.java copied successfully")
-            else:
-                print("ScratchWorld.java was already in the project directory")
+            # The generated code needs the versions of them that this s2g.py
+            # goes with: replace any others, e.g., from an older conversion.
+            for runtime in ("Scratch.java", "ScratchWorld.java"):
+                src = os.path.join(SCRIPT_DIR, runtime)
+                dest = os.path.join(PROJECT_DIR, runtime)
+                if not os.path.isfile(dest):
+                    shutil.copyfile(src, dest)
+                    print(runtime + " copied successfully")
+                elif not filecmp.cmp(src, dest, shallow=False):
+                    shutil.copyfile(src, dest)
+                    print(runtime + " was out of date in the project directory: replaced it")
+                else:
+                    print(runtime + " was already in the project directory")
         except Exception as e:
             print("\n\tScratch.java and ScratchWorld.java were NOT copied!", e)
 
         try:
             # If the file already exists, skip copying it
-            shutil.copyfile("say.png", os.path.join(imagesDir, "say.png"))
-            print("say.png copied successfully")
-            shutil.copyfile("say2.png", os.path.join(imagesDir, "say2.png"))
-            print("say2.png copied successfully")
-            shutil.copyfile("say3.png", os.path.join(imagesDir, "say3.png"))
-            print("say3.png copied successfully")
-            shutil.copyfile("think.png", os.path.join(imagesDir, "think.png"))
-            print("think.png copied successfully")
+            for img in ("say.png", "say2.png", "say3.png", "think.png"):
+                if not os.path.isfile(os.path.join(imagesDir, img)):
+                    shutil.copyfile(os.path.join(SCRIPT_DIR, img), os.path.join(imagesDir, img))
+                    print(img + " copied successfully")
         except Exception as e:
             print("\n\tImages for say/think were NOT all copied!", e)
 
-        worldClassName = convertToJavaId(os.path.basename(PROJECT_DIR).replace(" ", ""), True, True) + "World"
-
         # End of preparing directories, copying files, etc,
         # ---------------------------------------------------------------------------
 
-    # Now, (finally!), open the project.json file and start processing it.
-    with open(os.path.join(scratch_dir, "project.json"), encoding="utf_8") as data_file:
-        data = json.load(data_file)
+    else:
+        fingerprints = TargetFingerprints(PROJECT_DIR, data['targets'], False)
 
+    # Now, (finally!), process the project.json file.
     spritesData = data['targets']
 
     # We'll need to write configuration "code" to the greenfoot.project file.  Store
@@ -3063,24 +5050,30 @@ def convert():
 
         sprite = Sprite(sprData)
 
-        # Copy the sounds associated with this sprite to the appropriate directory
-        sprite.copySounds(soundsDir)
-
         # Generate world construct code that adds the sprite to the world.
         sprite.genAddSpriteCall()
-        sprite.genLoadCostumesCode(sprData['costumes'])
-        # Like location, direction, shown or hidden, etc.
-        sprite.genInitSettingsCode()
-
-        # Handle variables defined for this sprite.  This has to be done
-        # before handling the scripts, as the scripts may refer to the
-        # variables.
-        # Variable initializations have to be done in a method called
-        # addedToWorld(), which is not necessary if no variable defns exist.
-        sprite.genVariablesDefnCode(sprData['variables'], sprData['lists'], data['targets'], cloudVars)
-
-        sprite.genCodeForScripts()
-        sprite.writeCodeToFile()
+
+        if fingerprints.isUnchanged(sprData):
+            # Its .java file, images and sounds are still there from the last conversion.
+            print("Sprite %s is unchanged since the last conversion: skipping it." % sprite.getName())
+            CodeAndCb.cbScriptId += fingerprints.getNumScripts(sprData)
+        else:
+            # Copy the sounds associated with this sprite to the appropriate directory
+            sprite.copySounds(soundsDir, archive)
+
+            sprite.genLoadCostumesCode(sprData['costumes'])
+            # Like location, direction, shown or hidden, etc.
+            sprite.genInitSettingsCode()
+
+            # Handle variables defined for this sprite.  This has to be done
+            # before handling the scripts, as the scripts may refer to the
+            # variables.
+            # Variable initializations have to be done in a method called
+            # addedToWorld(), which is not necessary if no variable defns exist.
+            sprite.genVariablesDefnCode(sprData['variables'], sprData['lists'], data['targets'], cloudVars)
+
+            sprite.genCodeForScripts()
+            sprite.writeCodeToFile()
         worldCtorCode += sprite.getWorldCtorCode()
 
         # Write out a line to the project.greenfoot file to indicate that this
@@ -3107,11 +5100,17 @@ def convert():
     # Create the special Stage sprite.
     worldCtorCode += genIndent(2) + 'addSprite("' + stage.getName() + '", 0, 0);\n'
 
-    stage.genInitSettingsCode()
-    stage.genLoadCostumesCode(costumes)
-    stage.genBackgroundHandlingCode()
-    stage.genCodeForScripts()
-    stage.writeCodeToFile()
+    if fingerprints.isUnchanged(stageData):
+        print("Stage is unchanged since the last conversion: skipping it.")
+        # The backdrops are still needed for the World constructor.
+        stage.genLoadCostumesCode(costumes, renameImages=False)
+        CodeAndCb.cbScriptId += fingerprints.getNumScripts(stageData)
+    else:
+        stage.genInitSettingsCode()
+        stage.genLoadCostumesCode(costumes)
+        stage.genBackgroundHandlingCode()
+        stage.genCodeForScripts()
+        stage.writeCodeToFile()
 
     # ----------------------- Create subclass of World ------------------------------
 
@@ -3119,11 +5118,11 @@ def convert():
     # Now, to make the *World file -- a subclass of ScratchWorld.
     #
     filename = os.path.join(PROJECT_DIR, worldClassName + ".java")
-    outFile = open(filename, "w")
-    print("Writing code to " + filename + ".")
 
     worldCode = genWorldHeaderCode(worldClassName)
+    worldCode += broadcastMessages.genWorldCode()
     worldCode += genWorldCtorHeader(worldClassName)
+    worldCode += genIndent(2) + "setMessages(MESSAGE_NAMES, MESSAGE_RECEIVERS);\n"
 
     worldCode += stage.getWorldCtorCode()
 
@@ -3143,8 +5142,9 @@ def convert():
     worldCode += genIndent(1) + "}\n"
     worldCode += "}\n"
 
-    outFile.write(worldCode)
-    outFile.close()
+    # The World class lists every sprite, so it is generated every time, but
+    # it is only rewritten if it has changed.
+    writeFileIfChanged(filename, worldCode)
 
     projectFileCode.append("class." + worldClassName + ".superclass=ScratchWorld\n")
     projectFileCode.append("world.lastInstantiated=" + worldClassName + "\n")
@@ -3190,30 +5190,277 @@ def convert():
                 print("DEBUG: writing this line to project.greenfoot file:", p)
             projF.write(p)
 
+    if not onlyDecode:
+        fingerprints.save()
+    if parseCache is not None:
+        parseCache.store(parseCacheKey, parsedProject)
+
+
+# ---------------------------------------------------------------------------
+#                ------------- library interface ---------------
+# ---------------------------------------------------------------------------
+
+class ConversionOptions:
+    """Settings for convertProject().  These correspond to the command-line
+    arguments.  The defaults never stop to ask the user anything: variable
+    types are inferred and names are converted to legal java ids."""
+
+    def __init__(self, debug=False, inference=True, nameResolution=True, numImageWorkers=None,
+                 imageCacheDir=None, imageCacheMaxMB=512, parseCacheMaxMB=128, incremental=True,
+                 yieldEvery=1, steppedScripts=False):
+        self.debug = debug
+        self.inference = inference
+        self.nameResolution = nameResolution
+        self.numImageWorkers = numImageWorkers or os.cpu_count() or 1
+        self.imageCacheDir = imageCacheDir
+        self.imageCacheMaxMB = imageCacheMaxMB
+        self.parseCacheMaxMB = parseCacheMaxMB
+        self.incremental = incremental
+        self.yieldEvery = yieldEvery
+        self.steppedScripts = steppedScripts
+
+
+class ConversionResult:
+    """What convertProject() did: status is 'ok' or 'failed', in which case
+    error describes why.  seconds is how long the conversion took."""
+
+    def __init__(self, projectDir):
+        self.projectDir = projectDir
+        self.status = 'ok'
+        self.error = None
+        self.seconds = 0.0
+
+    def ok(self):
+        return self.status == 'ok'
+
+    def __str__(self):
+        if self.ok():
+            return 'Converted to %s in %.2fs' % (self.projectDir, self.seconds)
+        return 'Conversion to %s failed: %s' % (self.projectDir, self.error)
 
-if not useGui:  # Everything provided on command line.
+
+def resetConversionState():
+    """Reset the module-level state that a conversion builds up, so that
+    another project can be converted cleanly in the same process."""
+    global allVars
+    global stage
+    global worldClassName
+    global cloudVars
+    global parsedProject
+    global broadcastMessages
+    global spriteClassNames
+    global variableTypes
+
+    allVars = VariableRegistry()
+    broadcastMessages = None
+    variableTypes = None
+    spriteClassNames = {}
+    parsedProject = None
+    stage = None
+    worldClassName = ""
+    cloudVars = 0
+    CodeAndCb.cbScriptId = 0
+
+
+def convertProject(scratchFile, projectDir, options=None):
+    """Convert a Scratch 3 project into the Greenfoot scenario in projectDir,
+    which is created if necessary.  scratchFile is the path of the .sb3 file
+    or its contents as bytes.  options is a ConversionOptions.  Return a
+    ConversionResult.  This may be called repeatedly in the same process.
+    """
+    global SCRATCH_FILE
+    global PROJECT_DIR
+    global imagesDir
+    global soundsDir
+    global debug
+    global inference
+    global name_resolution
+    global useGui
+    global onlyDecode
+    global numImageWorkers
+    global imageCacheDir
+    global imageCacheMaxMB
+    global parseCacheMaxMB
+    global incremental
+    global yieldEvery
+    global steppedScripts
+
+    if options is None:
+        options = ConversionOptions()
+
+    debug = options.debug
+    inference = options.inference
+    name_resolution = options.nameResolution
+    useGui = False
+    onlyDecode = False
+    numImageWorkers = max(1, options.numImageWorkers)
+    imageCacheDir = options.imageCacheDir
+    imageCacheMaxMB = options.imageCacheMaxMB
+    parseCacheMaxMB = options.parseCacheMaxMB
+    incremental = options.incremental
+    yieldEvery = options.yieldEvery
+    steppedScripts = options.steppedScripts
+
+    SCRATCH_FILE = scratchFile
+    PROJECT_DIR = projectDir.rstrip("/")
     imagesDir = os.path.join(PROJECT_DIR, "images")
     soundsDir = os.path.join(PROJECT_DIR, "sounds")
-    convert()
-else:
+
+    result = ConversionResult(PROJECT_DIR)
+    start = time.time()
+    try:
+        if isinstance(scratchFile, str) and scratchFile.endswith('.sb2'):
+            raise ValueError('Scratch conversion only works with Scratch 3.0')
+        os.makedirs(PROJECT_DIR, exist_ok=True)
+        convert()
+    except SystemExit as e:
+        # The conversion code exits on errors, after printing why.
+        if e.code not in (None, 0):
+            result.status = 'failed'
+            result.error = 'exited with status %s' % e.code
+    except Exception as e:
+        result.status = 'failed'
+        result.error = '%s: %s' % (type(e).__name__, e)
+    result.seconds = time.time() - start
+    return result
+
+
+# ---------------------------------------------------------------------------
+#                ------------- batch conversion ---------------
+# ---------------------------------------------------------------------------
+
+def findBatchProjects(batchSpec):
+    """Return the list of .sb3 files to convert.  batchSpec is either a directory,
+    in which case all .sb3 files in it are converted, or a manifest file listing
+    one .sb3 file per line.  Blank lines and lines starting with # are ignored."""
+    if os.path.isdir(batchSpec):
+        return sorted(glob.glob(os.path.join(batchSpec, "*.sb3")))
+    projects = []
+    with open(batchSpec, encoding="utf_8") as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                projects.append(line)
+    return projects
+
+
+def getPeakRssKb():
+    """Return the peak resident set size of this process in kilobytes, or None
+    if it cannot be determined on this platform."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere.
+    return rss // 1024 if platform.system() == 'Darwin' else rss
+
+
+def convertBatchProject(job):
+    """Convert one project of a batch.  This runs in a worker process, which
+    converts only this project (see convertBatch()).  All output goes to
+    s2g.log in the project's directory.  Return a dictionary summarizing
+    the result."""
+    scratchFile, projDir, options = job
+
+    os.makedirs(projDir, exist_ok=True)
+    with open(os.path.join(projDir, "s2g.log"), "w", encoding="utf_8") as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        res = convertProject(scratchFile, projDir, options)
+
+    return {'project': scratchFile,
+            'greenfoot_dir': projDir,
+            'status': res.status,
+            'error': res.error,
+            'seconds': round(res.seconds, 3),
+            'peak_rss_kb': getPeakRssKb()}
+
+
+def convertBatch(batchSpec, outRoot, numWorkers, reportFile, options=None):
+    """Convert each project in batchSpec (see findBatchProjects()) into its own
+    directory under outRoot, numWorkers projects at a time.  Each project is
+    converted in a fresh worker process, so no state can leak from one
+    conversion to the next.  Write a json report with the status, duration
+    and peak memory use of each project to reportFile.  Return True if all
+    projects were converted."""
+    if options is None:
+        # The projects themselves are converted in parallel, so don't also
+        # run each project's image conversions in parallel.
+        options = ConversionOptions(numImageWorkers=1)
+    projects = findBatchProjects(batchSpec)
+    jobs = []
+    usedDirs = set()
+    for scratchFile in projects:
+        name = os.path.splitext(os.path.basename(scratchFile))[0]
+        projDir = os.path.join(outRoot, name)
+        suffix = 2
+        while projDir in usedDirs:
+            projDir = os.path.join(outRoot, "%s_%d" % (name, suffix))
+            suffix += 1
+        usedDirs.add(projDir)
+        jobs.append((scratchFile, projDir, options))
+
+    # Only batch mode needs multiprocessing, so don't make every run import it.
+    import multiprocessing
+
+    print("Converting %d projects with %d workers." % (len(jobs), numWorkers))
+    start = time.time()
+    results = []
+    # maxtasksperchild=1 gives each project a new process.
+    with multiprocessing.Pool(max(1, numWorkers), maxtasksperchild=1) as pool:
+        for result in pool.imap(convertBatchProject, jobs, chunksize=1):
+            print("%-7s %8.2fs  %s%s" % (result['status'], result['seconds'], result['project'],
+                                         "  (" + result['error'] + ")" if result['error'] else ""))
+            results.append(result)
+
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    report = {'projects': results,
+              'total': len(results),
+              'failed': failed,
+              'seconds': round(time.time() - start, 3)}
+    with open(reportFile, "w", encoding="utf_8") as f:
+        json.dump(report, f, indent=2)
+    print("Converted %d of %d projects in %.1fs.  Report written to %s." %
+          (len(results) - failed, len(results), report['seconds'], reportFile))
+    return failed == 0
+
+
+# ---------------------------------------------------------------------------
+#                ----------------- gui -------------------
+# ---------------------------------------------------------------------------
+
+def importTkinter():
+    """Import the tkinter modules used by the GUI."""
+    global tkinter
+    import tkinter
+    import tkinter.filedialog
+    import tkinter.messagebox
+
+
+def runGui():
+    """Show a window for choosing the scratch file and greenfoot directory,
+    and convert when the Convert button is pressed."""
+    global root
+    global scrEntryVar
+    global gfEntryVar
+
+    importTkinter()
+
     def findScratchFile():
-        global scrEntryVar, SCRATCH_FILE
+        global SCRATCH_FILE
         SCRATCH_FILE = tkinter.filedialog.askopenfilename(initialdir=SCRATCH_FILE,
                                                           filetypes=[('Scratch3 files', '.sb3'),
                                                                      ('All files', '.*')])
         scrEntryVar.set(SCRATCH_FILE)
 
-
     def findGfDir():
-        global gfEntryVar, PROJECT_DIR
+        global PROJECT_DIR
         PROJECT_DIR = tkinter.filedialog.askdirectory(initialdir=PROJECT_DIR)
         gfEntryVar.set(PROJECT_DIR)
 
-
     def exitTk():
         sys.exit(0)
 
-
     root = tkinter.Tk()
     root.title("Convert Scratch to Greenfoot")
     root.protocol('WM_DELETE_WINDOW', exitTk)
@@ -3240,11 +5487,9 @@ else:
     gfEntry.pack(side=tkinter.TOP)
     tkinter.Button(gfFrame, text="Find directory", command=findGfDir).pack(side=tkinter.TOP)
 
-
     def convertButtonCb():
         global SCRATCH_FILE
         global PROJECT_DIR
-        global SCRATCH_PROJ_DIR
 
         global imagesDir
         global soundsDir
@@ -3253,13 +5498,120 @@ else:
         PROJECT_DIR = gfEntryVar.get().strip().rstrip("/")
 
         print("--------" + SCRATCH_FILE)
-        SCRATCH_PROJ_DIR = "scratch_code"
 
         imagesDir = os.path.join(PROJECT_DIR, "images")
         soundsDir = os.path.join(PROJECT_DIR, "sounds")
         convert()
 
-
     convertButton = tkinter.Button(root, text="Convert", command=convertButtonCb)
     convertButton.pack(side=tkinter.BOTTOM)
     root.mainloop()
+
+
+# ---------------------------------------------------------------------------
+#                ----------------- main -------------------
+# ---------------------------------------------------------------------------
+
+def main(argv=None):
+    global debug
+    global inference
+    global name_resolution
+    global useGui
+    global numImageWorkers
+    global imageCacheDir
+    global imageCacheMaxMB
+    global parseCacheMaxMB
+    global incremental
+    global yieldEvery
+    global steppedScripts
+    global onlyDecode
+    global SCRATCH_FILE
+    global PROJECT_DIR
+    global imagesDir
+    global soundsDir
+
+    # Set up arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output")
+    parser.add_argument("-d", "--dotypeinference", action="store_true", help="Automatically infer variable types")
+    parser.add_argument("-r", "--resolvevariablenames", action="store_true", help="Automatically convert to java ids")
+    parser.add_argument("-g", "--gui", action="store_true", help="Use GUI converter (Experimental)")
+    parser.add_argument("-j", "--jobs", type=int, default=numImageWorkers,
+                        help="Number of image conversions to run in parallel (default: number of cores)")
+    parser.add_argument("--cache_dir", help="Directory in which to cache converted images and parsed projects "
+                                            "between runs", default=None, required=False)
+    parser.add_argument("--cache_size", type=int, default=imageCacheMaxMB,
+                        help="Maximum size of the image cache in megabytes (default: %(default)s)")
+    parser.add_argument("--parse_cache_size", type=int, default=parseCacheMaxMB,
+                        help="Maximum size of the parsed project cache in megabytes (default: %(default)s)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Regenerate every sprite, even those unchanged since the last conversion")
+    parser.add_argument("--yield_every", type=int, default=yieldEvery,
+                        help="Let loops that cannot wait and do not read the timer, mouse or keyboard yield to "
+                             "other scripts only every this many iterations, or every half second if 0 "
+                             "(default: %(default)s, every iteration, as in Scratch)")
+    parser.add_argument("--stepped_scripts", action="store_true",
+                        help="Compile \"when flag clicked\" and \"when I start as a clone\" scripts to state "
+                             "machines run on the Greenfoot thread, instead of a thread per script, where possible")
+    parser.add_argument("--batch", help="Convert every .sb3 file in this directory, or listed in this manifest "
+                                        "file (one per line), each into its own directory under --greenfoot_dir",
+                        default=None, required=False)
+    parser.add_argument("--batch_workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of projects to convert in parallel in batch mode (default: number of cores)")
+    parser.add_argument("--batch_report", help="File to write the batch summary report (json) to "
+                                               "(default: batch_report.json in --greenfoot_dir)",
+                        default=None, required=False)
+    parser.add_argument('-o', "--onlydecode", action="store_true",
+                        help="Only decode the project.json, don't move files, etc.")
+    parser.add_argument("--scratch_file", help="Location of scratch sb2/sb3 file", default=os.getcwd(),
+                        required=False)
+    parser.add_argument("--greenfoot_dir", help="Location of greenfoot project directory", default=os.getcwd(),
+                        required=False)
+    args = parser.parse_args(argv)
+
+    # Apply arguments
+    if args.verbose:
+        debug = True
+    if args.dotypeinference:
+        inference = True
+    if args.resolvevariablenames:
+        name_resolution = True
+    if args.gui:
+        useGui = True
+    numImageWorkers = max(1, args.jobs)
+    imageCacheDir = args.cache_dir
+    imageCacheMaxMB = args.cache_size
+    parseCacheMaxMB = args.parse_cache_size
+    incremental = not args.rebuild
+    if args.yield_every < 0:
+        parser.error("--yield_every must not be negative")
+    yieldEvery = args.yield_every
+    steppedScripts = args.stepped_scripts
+    onlyDecode = args.onlydecode
+
+    SCRATCH_FILE = args.scratch_file.strip()
+    # Take off spaces and a possible trailing "/"
+    PROJECT_DIR = args.greenfoot_dir.strip().rstrip("/")
+    if SCRATCH_FILE.endswith('.sb2'):
+        print('Scratch conversion only works with Scratch 3.0')
+        sys.exit(-1)
+
+    if args.batch is not None:
+        if not os.path.isdir(PROJECT_DIR):
+            os.makedirs(PROJECT_DIR)
+        reportFile = args.batch_report or os.path.join(PROJECT_DIR, "batch_report.json")
+        options = ConversionOptions(debug=debug, numImageWorkers=1, imageCacheDir=imageCacheDir,
+                                    imageCacheMaxMB=imageCacheMaxMB, parseCacheMaxMB=parseCacheMaxMB,
+                                    incremental=incremental,
+                                    yieldEvery=yieldEvery, steppedScripts=steppedScripts)
+        sys.exit(0 if convertBatch(args.batch, PROJECT_DIR, args.batch_workers, reportFile, options) else 1)
+    elif not useGui:  # Everything provided on command line.
+        imagesDir = os.path.join(PROJECT_DIR, "images")
+        soundsDir = os.path.join(PROJECT_DIR, "sounds")
+        convert()
+    else:
+        runGui()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,707 @@
+import contextlib
+import io
+import json
+import os
+import re
+import struct
+import textwrap
+import zipfile
+
+import pytest
+
+import s2g
+
+
+def makePng(width, height):
+    return (s2g.PNG_SIGNATURE + struct.pack('>I', 13) + b'IHDR' +
+            struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+
+def test_getPngSize():
+    assert s2g.getPngSize(makePng(480, 360)) == (480, 360)
+    assert s2g.getPngSize(bytearray(makePng(1, 2))) == (1, 2)
+
+
+def test_getPngSize_notPng():
+    with pytest.raises(ValueError):
+        s2g.getPngSize(b'GIF89a' + b'\0' * 20)
+    with pytest.raises(ValueError):
+        s2g.getPngSize(makePng(10, 10)[:20])
+
+
+@pytest.mark.parametrize('attrs, size', [
+    ('width="96" height="48"', (96, 48)),
+    ('width="96px" height=" 48.5px "', (96, 48.5)),
+    ('width="100pt" height="75pt" viewBox="0 0 10 10"', (400 / 3, 100)),
+    ('width="1in" height="2.54cm"', (96, 96)),
+    ('width="25.4mm" height="1pc"', (96, 16)),
+    ('width="1e2" height=".5"', (100, 0.5)),
+    ('width="100%" height="2em" viewBox="0 0 10 20"', (10, 20)),
+    ('viewBox="0,0,30.5,40"', (30.5, 40)),
+    ('height="7" viewBox="0 0 30 40"', (30, 7)),
+])
+def test_getSvgSize(attrs, size):
+    data = ('<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg" %s>'
+            '<rect width="1000" height="1000"/></svg>' % attrs).encode()
+    assert s2g.getSvgSize(data) == pytest.approx(size)
+
+
+def test_getSvgSize_noSize():
+    with pytest.raises(ValueError):
+        s2g.getSvgSize(b'<svg width="100%" height="100%"></svg>')
+    with pytest.raises(ValueError):
+        s2g.getSvgSize(b'<html></html>')
+
+
+def test_getImageSize():
+    assert s2g.getImageSize('a.png', makePng(3, 4)) == (3, 4)
+    assert s2g.getImageSize('a.svg', b'<svg width="3" height="4"/>') == (3, 4)
+
+
+def test_parsedProjectRoundTrip():
+    blocks = [s2g.Block(0, 'control_forever'), s2g.Block(1, 'looks_show'), s2g.Block(2, 'looks_hide')]
+    blocks[0].setChild('SUBSTACK', blocks[1])
+    blocks[1].setNext(blocks[2])
+    parsed = s2g.ParsedProject()
+    parsed.setBlocks('Cat', blocks)
+    parsed.setVarChoice('Cat', 'v1', (0, 'Int', 'score'))
+    loaded = s2g.ParsedProject.fromBytes(parsed.toBytes())
+    assert loaded.getVarChoice('Cat', 'v1') == (0, 'Int', 'score')
+    rebuilt = s2g.Block.fromTuples(loaded.getBlocks('Cat'))
+    assert [b.getOpcode() for b in rebuilt] == ['control_forever', 'looks_show', 'looks_hide']
+    assert rebuilt[0].getChild('SUBSTACK') is rebuilt[1]
+    assert rebuilt[1].getNext() is rebuilt[2]
+
+
+@pytest.mark.parametrize('code, val', [
+    ('0', 0), ('-12', -12), ('2147483647', 2 ** 31 - 1), ('-2147483648', -2 ** 31),
+    ('2147483648', None), ('010', None), ('1.5', 1.5), ('.5', 0.5), ('2.', 2.0), ('1e3', 1000.0),
+    ('-0.0', -0.0), ('1e400', None), ('x', None), ('(1 + 2)', None), ('getX()', None),
+])
+def test_parseJavaNumber(code, val):
+    parsed = s2g.parseJavaNumber(code)
+    assert parsed == val and type(parsed) is type(val)
+    if val == 0 and isinstance(val, float):
+        assert str(parsed) == str(val)
+
+
+def test_javaNumber():
+    assert s2g.javaNumber(3) == '3'
+    assert s2g.javaNumber(2 ** 31) is None
+    assert s2g.javaNumber(-2 ** 31) == '-2147483648'
+    assert s2g.javaNumber(0.1) == '0.1'
+    assert s2g.javaNumber(-0.0) == '-0.0'
+    assert s2g.javaNumber(float('inf')) is None
+    assert s2g.javaNumber(float('nan')) is None
+    assert s2g.javaNumber(None) is None
+    for code in ('7', '-7', '0.1', '-0.0', '1e+300'):
+        assert s2g.javaNumber(s2g.parseJavaNumber(code)) == repr(s2g.parseJavaNumber(code))
+
+
+def fold(opcode, code1, code2):
+    """The literal that the arithmetic block is folded to, or None."""
+    return s2g.javaNumber(s2g.foldArithmetic('operator_' + opcode, s2g.parseJavaNumber(code1),
+                                             s2g.parseJavaNumber(code2)))
+
+
+def test_foldArithmetic():
+    assert fold('add', '1', '2') == '3'
+    assert fold('subtract', '1', '2.5') == '-1.5'
+    assert fold('multiply', '0.1', '3') == repr(0.1 * 3)
+    assert fold('add', 'getX()', '1') is None
+
+
+def test_foldArithmetic_intOverflow():
+    # Java would wrap these around, so they are left to Java.
+    assert fold('add', '2147483647', '1') is None
+    assert fold('subtract', '-2147483648', '1') is None
+    assert fold('multiply', '65536', '65536') is None
+    assert fold('divide', '-2147483648', '-1') is None
+    # But not if either is a double.
+    assert fold('add', '2147483647', '1.0') == '2147483648.0'
+
+
+def test_foldArithmetic_intDivision():
+    assert fold('divide', '6', '3') == '2'
+    assert fold('divide', '-6', '3') == '-2'
+    # Java's int division truncates, and Scratch's does not.
+    assert fold('divide', '7', '2') is None
+    assert fold('divide', '-7', '2') is None
+    assert fold('divide', '7.0', '2') == '3.5'
+    assert fold('divide', '1', '0') is None
+    assert fold('divide', '1.0', '0.0') is None
+
+
+def test_foldArithmetic_negativeZero():
+    assert fold('multiply', '-0.0', '1') == '-0.0'
+    assert fold('multiply', '0.0', '-1') == '-0.0'
+    assert fold('add', '-0.0', '0.0') == '0.0'
+    assert fold('subtract', '0', '0') == '0'
+    assert fold('divide', '0', '-5') == '0'
+    assert fold('divide', '-0.0', '5') == '-0.0'
+
+
+@pytest.mark.parametrize('mathop, code, folded', [
+    ('abs', '-3', '3'), ('abs', '-0.0', '0.0'), ('abs', '-2147483648', None),
+    ('floor', '2.5', '2.0'), ('floor', '-2.5', '-3.0'), ('floor', '-0.0', '-0.0'), ('floor', '7', '7.0'),
+    ('ceiling', '-0.5', '-0.0'), ('ceiling', '0.5', '1.0'),
+    ('sqrt', '16', '4.0'), ('sqrt', '-0.0', '-0.0'), ('sqrt', '-1', None),
+    ('10 ^', '3', '1000.0'), ('10 ^', '23', None), ('10 ^', '-1', None), ('10 ^', '0.5', None),
+    ('sin', '0', None), ('ln', '1', None), ('e ^', '0', None),
+    ('abs', 'getX()', None),
+])
+def test_foldMathOp(mathop, code, folded):
+    assert s2g.javaNumber(s2g.foldMathOp(mathop, s2g.parseJavaNumber(code))) == folded
+
+
+def block(opcode, parent=None, inputs=None, fields=None, **rest):
+    b = {'opcode': opcode, 'next': None, 'parent': parent, 'inputs': inputs or {}, 'fields': fields or {},
+         'shadow': False, 'topLevel': parent is None}
+    b.update(rest)
+    return b
+
+
+def setVar(uniqId, value, opcode='data_setvariableto'):
+    return block(opcode, 'hat', {'VALUE': value}, {'VARIABLE': [uniqId, uniqId]})
+
+
+def varInput(uniqId):
+    return [3, [12, uniqId, uniqId], [10, '']]
+
+
+def inferTypes(variables, blocks, spriteBlocks=None):
+    """Return the VariableTypes for a stage with the variables, given as
+    {uniqId: initial value}, and the blocks, and a sprite with spriteBlocks."""
+    stage = {'isStage': True, 'name': 'Stage', 'blocks': blocks,
+             'variables': {uniqId: [uniqId, value] for uniqId, value in variables.items()}}
+    sprite = {'isStage': False, 'name': 'Cat', 'blocks': spriteBlocks or {}, 'variables': {}}
+    return s2g.VariableTypes([stage, sprite])
+
+
+def test_variableTypes_literals():
+    types = inferTypes({'i': 0, 'd': 0, 's': 'hi', 'n': '', 'b': 'true', 'e': 1.5}, {
+        'd1': setVar('d', [1, [4, '2.5']]),
+        'n1': setVar('n', [1, [10, '7']]),
+        'b1': setVar('b', [2, 'md']), 'md': block('sensing_mousedown', 'b1'),
+    })
+    assert [types.getType(v) for v in 'idsnbe'] == ['Int', 'Double', 'String', 'Int', 'Boolean', 'Double']
+    assert all(types.getConflict(v) is None for v in 'idsnbe')
+
+
+def test_variableTypes_conflict():
+    types = inferTypes({'v': 0, 'w': 'false'}, {
+        'v1': setVar('v', [1, [10, 'hello']]),
+        'w1': setVar('w', [1, [4, '3']]),
+        'w2': setVar('w', [2, 'md']), 'md': block('sensing_mousedown', 'w2'),
+    })
+    assert types.getType('v') == 'String'
+    assert types.getConflict('v') == ['String', 'number']
+    assert types.getConflict('w') == ['Boolean', 'number']
+
+
+def test_variableTypes_changeBy():
+    types = inferTypes({'i': 0, 'd': 0, 'e': ''}, {
+        'i1': setVar('i', [1, [4, '1']], 'data_changevariableby'),
+        'd1': setVar('d', [1, [4, '0.5']], 'data_changevariableby'),
+        # An empty input is 0 where a number is expected.
+        'e1': setVar('e', [1, [4, '']], 'data_changevariableby'),
+    })
+    assert [types.getType(v) for v in 'ide'] == ['Int', 'Double', 'Int']
+
+
+def test_variableTypes_dataflow():
+    # a is set to b, which is set to (c + 1), and c is set in the sprite to 0.5.
+    types = inferTypes({'a': 0, 'b': 0, 'c': 0, 'd': ''}, {
+        'a1': setVar('a', varInput('b')),
+        'b1': setVar('b', [3, 'add', [4, '']]),
+        'add': block('operator_add', 'b1', {'NUM1': varInput('c'), 'NUM2': [1, [4, '1']]}),
+        'd1': setVar('d', varInput('a')),
+    }, {
+        'c1': setVar('c', [1, [4, '0.5']]),
+    })
+    assert [types.getType(v) for v in 'abcd'] == ['Double'] * 4
+    assert types.getTypes() == {'a': 'Double', 'b': 'Double', 'c': 'Double', 'd': 'Double'}
+
+
+def test_variableTypes_cycle():
+    # Set to each other and to ints only: they stay Int.
+    types = inferTypes({'a': 0, 'b': ''}, {
+        'a1': setVar('a', varInput('b')),
+        'b1': setVar('b', [3, 'add', [4, '']]),
+        'add': block('operator_add', 'b1', {'NUM1': varInput('a'), 'NUM2': [1, [4, '1']]}),
+    })
+    assert types.getType('a') == types.getType('b') == 'Int'
+
+
+def procBlocks(proccode, params, uses):
+    """Return the blocks of the definition of a custom block with the number
+    or text params, whose body is the blocks in uses, each of which is
+    (opcode, input key, shadow type) with the first param in that input."""
+    argIds = ['arg%d' % i for i in range(len(params))]
+    blocks = {
+        'def': block('procedures_definition', None, {'custom_block': [1, 'proto']}),
+        'proto': block('procedures_prototype', 'def', {argId: [1, argId + 'r'] for argId in argIds}, shadow=True,
+                       mutation={'proccode': proccode, 'argumentids': json.dumps(argIds),
+                                 'argumentnames': json.dumps(params)}),
+    }
+    for argId, name in zip(argIds, params):
+        blocks[argId + 'r'] = block('argument_reporter_string_number', 'proto', {}, {'VALUE': [name, None]},
+                                    shadow=True)
+    for i, (opcode, key, shadowType) in enumerate(uses):
+        blocks['use%d' % i] = block(opcode, 'def', {key: [3, 'param%d' % i, [shadowType, '']]})
+        blocks['param%d' % i] = block('argument_reporter_string_number', 'use%d' % i, {},
+                                      {'VALUE': [params[0], None]})
+    return blocks
+
+
+def callBlock(proccode, numArgs, value, parent='hat'):
+    argIds = ['arg%d' % i for i in range(numArgs)]
+    return block('procedures_call', parent, {argId: value for argId in argIds},
+                 mutation={'proccode': proccode, 'argumentids': json.dumps(argIds)})
+
+
+@pytest.mark.parametrize('uses, value, paramType', [
+    ([('motion_movesteps', 'STEPS', 4)], [1, [10, '3']], 'Int'),
+    ([('motion_movesteps', 'STEPS', 4)], [1, [10, '2.5']], 'Double'),
+    # Used as a number, but passed nothing that tells which kind.
+    ([('motion_movesteps', 'STEPS', 4)], [1, [10, '']], 'Double'),
+    ([('looks_say', 'MESSAGE', 10)], [1, [10, '3']], 'String'),
+    ([('looks_say', 'MESSAGE', 10), ('motion_movesteps', 'STEPS', 4)], [1, [10, '3']], 'Int'),
+    ([('motion_movesteps', 'STEPS', 4)], [1, [10, 'abc']], 'String'),
+])
+def test_variableTypes_params(uses, value, paramType):
+    blocks = procBlocks('f %s', ['n'], uses)
+    blocks['call'] = callBlock('f %s', 1, value)
+    types = inferTypes({}, {}, blocks)
+    assert types.getParamType('Cat', 'f %s', 'n') == paramType
+    assert types.getTypes() == {}
+
+
+def test_variableTypes_paramToVariable():
+    # A variable set to a parameter gets the type of what is passed to it.
+    blocks = procBlocks('f %s', ['n'], [('motion_movesteps', 'STEPS', 4)])
+    blocks['set'] = block('data_setvariableto', 'def', {'VALUE': [3, 'p', [10, '']]}, {'VARIABLE': ['v', 'v']})
+    blocks['p'] = block('argument_reporter_string_number', 'set', {}, {'VALUE': ['n', None]})
+    blocks['call'] = callBlock('f %s', 1, [1, [10, '1.5']])
+    types = inferTypes({'v': 0}, {}, blocks)
+    assert types.getParamType('Cat', 'f %s', 'n') == 'Double'
+    assert types.getType('v') == 'Double'
+
+
+@pytest.fixture
+def imageTools(tmp_path, monkeypatch):
+    """Put stand-ins for ImageMagick's convert and rsvg-convert on the PATH,
+    which copy the image on stdin to the file named last."""
+    binDir = tmp_path / 'bin'
+    binDir.mkdir()
+    for tool in ('convert', 'rsvg-convert'):
+        script = binDir / tool
+        script.write_text('#!/bin/sh\nfor a; do last=$a; done\ncat > "$last"\n')
+        script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(binDir) + os.pathsep + os.environ['PATH'])
+
+
+def target(name, blocks=None, **rest):
+    """Return the json of a sprite, or the Stage, with one costume."""
+    t = {'isStage': name == 'Stage', 'name': name, 'variables': {}, 'lists': {}, 'broadcasts': {},
+         'blocks': blocks or {}, 'comments': {}, 'currentCostume': 0,
+         'costumes': [{'assetId': name.lower() + '0', 'name': 'costume1', 'md5ext': name.lower() + '0.png',
+                       'dataFormat': 'png'}],
+         'sounds': [], 'volume': 100, 'layerOrder': 0}
+    if name != 'Stage':
+        t.update({'visible': True, 'x': 0, 'y': 0, 'size': 100, 'direction': 90, 'draggable': False,
+                  'rotationStyle': 'all around'})
+    t.update(rest)
+    return t
+
+
+def convertTargets(projectDir, targets, **options):
+    """Convert a project of the targets into projectDir, and return the
+    output of the conversion."""
+    sb3 = io.BytesIO()
+    with zipfile.ZipFile(sb3, 'w') as z:
+        z.writestr('project.json', json.dumps({'targets': targets, 'monitors': [], 'extensions': [],
+                                               'meta': {'semver': '3.0.0'}}))
+        for t in targets:
+            z.writestr(t['costumes'][0]['md5ext'], makePng(4, 4))
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        result = s2g.convertProject(sb3.getvalue(), str(projectDir), s2g.ConversionOptions(**options))
+    assert result.ok(), result.error + '\n' + out.getvalue()
+    return out.getvalue()
+
+
+def readJava(projectDir, className):
+    return (projectDir / (className + '.java')).read_text()
+
+
+def script(prefix, hat, *stmts, **hatFields):
+    """Return the blocks of a script: the hat block, with the fields, and the
+    statements, each (opcode, inputs, fields[, other keys]), one after
+    another."""
+    ids = [prefix + 'hat'] + [prefix + str(i) for i in range(len(stmts))]
+    blocks = {ids[0]: block(hat, None, {}, hatFields, next=ids[1] if stmts else None)}
+    for i, (opcode, inputs, fields, *rest) in enumerate(stmts):
+        blocks[ids[i + 1]] = block(opcode, ids[i], inputs, fields,
+                                   next=ids[i + 2] if i + 2 < len(ids) else None, **(rest[0] if rest else {}))
+    return blocks
+
+
+def broadcastProject(message='go', steps='10', ballStmt='looks_hide'):
+    cat = script('c', 'event_whenflagclicked',
+                 ('motion_movesteps', {'STEPS': [1, [4, steps]]}, {}),
+                 ('event_broadcast', {'BROADCAST_INPUT': [1, [11, message, 'm1']]}, {}))
+    cat.update(script('r', 'event_whenbroadcastreceived', ('looks_show', {}, {}),
+                      BROADCAST_OPTION=[message, 'm1']))
+    ball = script('b', 'event_whenflagclicked', (ballStmt, {}, {}))
+    ball.update(script('k', 'event_whenkeypressed', ('looks_show', {}, {}), KEY_OPTION=['space', None]))
+    return [target('Stage', broadcasts={'m1': message}), target('Cat', cat), target('Ball', ball)]
+
+
+def skipped(output):
+    return sorted(re.findall(r'(\w+) is unchanged since the last conversion', output))
+
+
+def test_fingerprints_unchanged(tmp_path, imageTools):
+    convertTargets(tmp_path, broadcastProject())
+    cat = readJava(tmp_path, 'Cat')
+    assert skipped(convertTargets(tmp_path, broadcastProject())) == ['Ball', 'Cat', 'Stage']
+    assert readJava(tmp_path, 'Cat') == cat
+    # Unless told to regenerate everything.
+    assert skipped(convertTargets(tmp_path, broadcastProject(), incremental=False)) == []
+
+
+def test_fingerprints_renamedBroadcast(tmp_path, imageTools):
+    convertTargets(tmp_path, broadcastProject('go'))
+    # Every target may use the message ids, so all are regenerated.
+    assert skipped(convertTargets(tmp_path, broadcastProject('start'))) == []
+    assert 'MSG_START' in readJava(tmp_path, 'Cat')
+
+
+def test_fingerprints_yieldEvery(tmp_path, imageTools):
+    convertTargets(tmp_path, broadcastProject())
+    assert skipped(convertTargets(tmp_path, broadcastProject(), yieldEvery=0)) == []
+    assert skipped(convertTargets(tmp_path, broadcastProject(), yieldEvery=0)) == ['Ball', 'Cat', 'Stage']
+
+
+def test_fingerprints_scriptIds(tmp_path, imageTools):
+    # Ball's callbacks are numbered after Cat's, whether or not Cat is
+    # generated again.
+    fresh = tmp_path / 'fresh' / 'Game'
+    convertTargets(fresh, broadcastProject(ballStmt='looks_show'))
+    incremental = tmp_path / 'incremental' / 'Game'
+    convertTargets(incremental, broadcastProject())
+    assert skipped(convertTargets(incremental, broadcastProject(ballStmt='looks_show'))) == ['Cat', 'Stage']
+    assert readJava(incremental, 'Ball') == readJava(fresh, 'Ball')
+    assert 'whenFlagClickedCb2' in readJava(fresh, 'Ball')
+
+
+def test_exprCache():
+    cache = s2g.ExprCache()
+    add = s2g.Block(0, 'operator_add')
+    assert cache.get(add, 'math') is None
+    assert cache.put(add, 'math', '(1 + x)') == '(1 + x)'
+    assert cache.get(add, 'math') == '(1 + x)'
+    assert cache.get(add, 'str') is None
+    assert str(cache) == 'Expression cache: 1 hits, 2 misses'
+    cache.clear()
+    assert cache.get(add, 'math') is None and cache.hits == 0
+
+
+def test_findReachableBlocks():
+    blocks = procBlocks('f %s', ['n'], [('motion_movesteps', 'STEPS', 4)])
+    blocks['def']['next'] = 'use0'
+    blocks.update(script('s', 'event_whenflagclicked',
+                         ('looks_switchcostumeto', {'COSTUME': [1, 'menu']}, {}),
+                         ('procedures_call', {}, {})))
+    blocks['menu'] = block('looks_costume', 's0', {}, {'COSTUME': ['costume1', None]}, shadow=True)
+    # A script with no hat, and its input, and a loose variable reporter.
+    blocks['loose'] = block('motion_movesteps', None, {'STEPS': [3, 'add', [4, '10']]}, next='loose2')
+    blocks['add'] = block('operator_add', 'loose', {'NUM1': [1, [4, '1']], 'NUM2': [1, [4, '2']]})
+    blocks['loose2'] = block('looks_hide', 'loose')
+    blocks['var'] = [12, 'v', 'v', 10, 20]
+    s2g.resetConversionState()
+    with contextlib.redirect_stdout(io.StringIO()):
+        sprite = s2g.Sprite({'name': 'Cat'})
+    assert sprite.findReachableBlocks(blocks) == (
+        {'def', 'proto', 'arg0r', 'use0', 'param0', 'shat', 's0', 's1', 'menu'})
+
+
+def procDefn(prefix, proccode, warp, *stmts):
+    """Return the blocks of the definition of a custom block with no params,
+    whose body is the statements, as in script()."""
+    blocks = script(prefix, 'procedures_definition', *stmts)
+    blocks[prefix + 'hat']['inputs'] = {'custom_block': [1, prefix + 'proto']}
+    blocks[prefix + 'proto'] = block('procedures_prototype', prefix + 'hat', shadow=True,
+                                     mutation={'proccode': proccode, 'argumentids': '[]',
+                                               'argumentnames': '[]', 'warp': json.dumps(warp)})
+    return blocks
+
+
+def call(proccode):
+    return ('procedures_call', {}, {}, {'mutation': {'proccode': proccode, 'argumentids': '[]'}})
+
+
+def method(code, name):
+    """Return the code of the method whose name matches the regex."""
+    return re.search(r'\n    (?:private|public) \w+ ' + name + r'\(.*?\n    }\n', code, re.S).group(0)
+
+
+def test_findWarpProcs(tmp_path, imageTools):
+    # fast (warp) calls middle, which calls helper: both run without
+    # screen refresh when called from fast, but not from the flag script.
+    loop = ('control_repeat', {'TIMES': [1, [6, '10']], 'SUBSTACK': [2, 'hloop']}, {})
+    cat = procDefn('f', 'fast', True, call('middle'))
+    cat.update(procDefn('m', 'middle', False, call('helper')))
+    cat.update(procDefn('h', 'helper', False, loop))
+    cat['hloop'] = block('motion_movesteps', 'h0', {'STEPS': [1, [4, '1']]})
+    cat.update(script('s', 'event_whenflagclicked', call('fast'), call('helper')))
+    convertTargets(tmp_path, [target('Stage'), target('Cat', cat)])
+    code = readJava(tmp_path, 'Cat')
+
+    assert 'fastWarp' not in code
+    assert 'middleWarp(s);' in method(code, 'fast')
+    assert 'helperWarp(s);' in method(code, 'middleWarp')
+    assert 'deferredYield(s);' in method(code, 'helperWarp')
+    assert 'deferredYield' not in method(code, 'helper')
+    assert 'yield(s);' in method(code, 'helper')
+    # Called from the flag script, helper still yields.
+    assert re.search(r'\bhelper\(s\);', code)
+
+
+def repeatProject(bodyOpcode, inputs, *reporters, **rest):
+    """Return a project whose Cat has a script that repeats a statement,
+    with the inputs and other keys, and reporter blocks, each (id, opcode,
+    inputs, fields[, other keys]), that are inputs of it, or of each other.
+    The Cat also has a custom block f."""
+    cat = script('s', 'event_whenflagclicked',
+                 ('control_repeat', {'TIMES': [1, [6, '10']], 'SUBSTACK': [2, 'body']}, {}))
+    cat['body'] = block(bodyOpcode, 's0', inputs, **rest)
+    for (blockId, opcode, inputs, fields, *other) in reporters:
+        cat[blockId] = block(opcode, 'body', inputs, fields, **(other[0] if other else {}))
+    cat.update(procDefn('f', 'f', False, ('looks_show', {}, {})))
+    return [target('Stage'), target('Cat', cat)]
+
+
+@pytest.mark.parametrize('project', [
+    repeatProject('motion_setx', {'X': [3, 'r', [4, '0']]}, ('r', 'sensing_timer', {}, {})),
+    repeatProject('motion_setx', {'X': [3, 'r', [4, '0']]}, ('r', 'sensing_mousex', {}, {})),
+    repeatProject('motion_goto', {'TO': [1, 'r']}, ('r', 'motion_goto_menu', {}, {'TO': ['_mouse_', None]},
+                                                    {'shadow': True})),
+    repeatProject('looks_say', {'MESSAGE': [3, 'r', [10, '']]}, ('r', 'sensing_keypressed', {'KEY_OPTION': [1, 'k']}, {}),
+                  ('k', 'sensing_keyoptions', {}, {'KEY_OPTION': ['space', None]}, {'shadow': True})),
+    repeatProject('control_wait', {'DURATION': [1, [5, '1']]}),
+    repeatProject('procedures_call', {}, mutation={'proccode': 'f', 'argumentids': '[]'}),
+], ids=['timer', 'mouse', 'mouseMenu', 'keyboard', 'wait', 'procCall'])
+def test_loopYield_kept(tmp_path, imageTools, project):
+    convertTargets(tmp_path, project, yieldEvery=5)
+    code = readJava(tmp_path, 'Cat')
+    assert 'yield(s);   // allow other sequences to run\n' in method(code, r'whenFlagClickedCb\d+')
+    assert 'batchedYield' not in code and 'deferredYield' not in code
+
+
+@pytest.mark.parametrize('yieldEvery, loopYield', [
+    (1, 'yield(s);'),
+    (5, 'batchedYield(s, 5);'),
+    (0, 'deferredYield(s);'),
+])
+def test_loopYield_batched(tmp_path, imageTools, yieldEvery, loopYield):
+    convertTargets(tmp_path, repeatProject('motion_movesteps', {'STEPS': [1, [4, '1']]}), yieldEvery=yieldEvery)
+    assert re.search(r'\s' + re.escape(loopYield), method(readJava(tmp_path, 'Cat'), r'whenFlagClickedCb\d+'))
+
+
+def steppedStates(tmp_path, stmts, blocks=None):
+    """Convert a Cat with a flag script of the statements, and the other
+    blocks, with steppedScripts, and return the cases of its step()."""
+    cat = script('s', 'event_whenflagclicked', *stmts)
+    cat.update(blocks or {})
+    convertTargets(tmp_path, [target('Stage'), target('Cat', cat)], steppedScripts=True)
+    code = readJava(tmp_path, 'Cat')
+    return textwrap.dedent(re.search(r'switch \(stepPc\) \{\n(.*?)\n *default:', code, re.S).group(1))
+
+
+def test_stepped_forever(tmp_path, imageTools):
+    assert steppedStates(tmp_path, [('control_forever', {'SUBSTACK': [2, 'a']}, {})],
+                         {'a': block('motion_movesteps', 's0', {'STEPS': [1, [4, '10']]})}) == textwrap.dedent('''\
+        case 0:
+        case 1:
+            move(10);
+            stepPc = 1;
+            return true;''')
+
+
+def test_stepped_repeat(tmp_path, imageTools):
+    # The counter is reset each time the repeat starts.
+    blocks = {'a': block('control_repeat', 's0', {'TIMES': [1, [6, '3']], 'SUBSTACK': [2, 'b']}, next='c'),
+              'b': block('motion_movesteps', 'a', {'STEPS': [1, [4, '10']]}),
+              'c': block('looks_hide', 'a')}
+    assert steppedStates(tmp_path, [('control_forever', {'SUBSTACK': [2, 'a']}, {})], blocks) == textwrap.dedent('''\
+        case 0:
+        case 1:
+            stepCount0 = 0;
+        case 2:
+            if (stepCount0 >= 3) { stepPc = 3; continue; }
+            stepCount0++;
+            move(10);
+            stepPc = 2;
+            return true;
+        case 3:
+            hide();
+            stepPc = 1;
+            return true;''')
+    assert 'private int stepCount0;' in readJava(tmp_path, 'Cat')
+
+
+def test_stepped_ifWithWait(tmp_path, imageTools):
+    blocks = {'m': block('sensing_mousedown', 's0'),
+              'w': block('control_wait', 's0', {'DURATION': [1, [5, '1']]})}
+    assert steppedStates(tmp_path, [('control_if', {'CONDITION': [2, 'm'], 'SUBSTACK': [2, 'w']}, {}),
+                                    ('looks_show', {}, {})], blocks) == textwrap.dedent('''\
+        case 0:
+            if (! (isMouseDown())) { stepPc = 1; continue; }
+            stepWaitEnd = System.currentTimeMillis() + (long) (1000.0 * 1);
+        case 2:
+            if (System.currentTimeMillis() < stepWaitEnd) { stepPc = 2; return true; }
+        case 1:
+            show();
+            return false;''')
+
+
+def test_stepped_stopThisScript(tmp_path, imageTools):
+    # What follows the stop is never run, and left out.
+    assert steppedStates(tmp_path, [('motion_movesteps', {'STEPS': [1, [4, '10']]}, {}),
+                                    ('control_stop', {}, {'STOP_OPTION': ['this script', None]}),
+                                    ('looks_hide', {}, {})]) == textwrap.dedent('''\
+        case 0:
+            move(10);
+            return false;''')
+
+
+def test_stepped_deleteThisClone(tmp_path, imageTools):
+    assert steppedStates(tmp_path, [('looks_show', {}, {}), ('control_delete_this_clone', {}, {}),
+                                    ('looks_hide', {}, {})]) == textwrap.dedent('''\
+        case 0:
+            show();
+            deleteThisClone();
+            if (getWorld() == null) return false;
+            hide();
+            return false;''')
+
+
+def nestedIfs(depth):
+    """Return the blocks of a flag script of ifs nested depth deep, with a
+    show in the innermost."""
+    blocks = script('s', 'event_whenflagclicked', ('control_if', {'SUBSTACK': [2, 'if1']}, {}))
+    for i in range(1, depth):
+        blocks['if%d' % i] = block('control_if', 's0' if i == 1 else 'if%d' % (i - 1),
+                                   {'SUBSTACK': [2, 'if%d' % (i + 1)]})
+    blocks['if%d' % depth] = block('looks_show', 'if%d' % (depth - 1))
+    return blocks
+
+
+@pytest.mark.parametrize('blocks, stepped', [
+    (script('s', 'event_whenflagclicked', ('looks_sayforsecs', {'MESSAGE': [1, [10, 'hi']],
+                                                                'SECS': [1, [4, '2']]}, {})), False),
+    (nestedIfs(s2g.MAX_STATEMENT_NESTING), True),
+    (nestedIfs(s2g.MAX_STATEMENT_NESTING + 1), False),
+], ids=['sayForSecs', 'maxNesting', 'tooDeep'])
+def test_canStepScript(tmp_path, imageTools, blocks, stepped):
+    convertTargets(tmp_path, [target('Stage'), target('Cat', blocks)], steppedScripts=True)
+    code = readJava(tmp_path, 'Cat')
+    assert ('whenFlagClickedStepped(' in code) == stepped
+    assert ('public void whenFlagClickedCb' in code) != stepped
+
+
+def test_broadcastMessages_worldCode():
+    # "stop" has no receiver, and "hit" is broadcast but missing from the
+    # stage's list; "Game over" and "game-over" map to the same name.
+    cat = script('c', 'event_whenbroadcastreceived', ('looks_show', {}, {}), BROADCAST_OPTION=['go', 'm1'])
+    cat.update(script('h', 'event_whenflagclicked',
+                      ('event_broadcast', {'BROADCAST_INPUT': [1, [11, 'hit', 'm4']]}, {})))
+    ball = script('b', 'event_whenbroadcastreceived', ('looks_hide', {}, {}), BROADCAST_OPTION=['go', 'm1'])
+    ball.update(script('o', 'event_whenbroadcastreceived', ('looks_hide', {}, {}),
+                       BROADCAST_OPTION=['game-over', 'm3']))
+    stage = target('Stage', broadcasts={'m1': 'go', 'm2': 'stop', 'm0': 'Game over', 'm3': 'game-over'})
+    messages = s2g.BroadcastMessages([stage, target('Cat', cat), target('Ball', ball)])
+    assert messages.getNames() == ['go', 'stop', 'Game over', 'game-over', 'hit']
+    assert messages.genWorldCode() == textwrap.indent(textwrap.dedent('''\
+        // Broadcast messages, by id.
+        public static final int MSG_GO = 0;
+        public static final int MSG_STOP = 1;
+        public static final int MSG_GAME_OVER = 2;
+        public static final int MSG_GAME_OVER_3 = 3;
+        public static final int MSG_HIT = 4;
+        // Each message's name, and the classes with scripts that receive it.
+        private static final String[] MESSAGE_NAMES = {
+            "go",
+            "stop",
+            "Game over",
+            "game-over",
+            "hit",
+        };
+        private static final Class<?>[][] MESSAGE_RECEIVERS = {
+            { Cat.class, Ball.class, },
+            { },
+            { },
+            { Ball.class, },
+            { },
+        };
+        '''), '    ')
+
+
+def test_runtimeFilesReplaced(tmp_path, imageTools):
+    # Runtime files left by a conversion with another version of s2g.py
+    # are replaced, and the same ones are left alone.
+    (tmp_path / 'Scratch.java').write_text('// old\n')
+    output = convertTargets(tmp_path, [target('Stage')])
+    assert 'Scratch.java was out of date' in output and 'ScratchWorld.java copied' in output
+    for runtime in ('Scratch.java', 'ScratchWorld.java'):
+        with open(os.path.join(s2g.SCRIPT_DIR, runtime), 'rb') as f:
+            assert (tmp_path / runtime).read_bytes() == f.read()
+    assert 'Scratch.java was already in the project directory' in convertTargets(tmp_path, [target('Stage')])
+
+
+def test_procParamTypes_java(tmp_path, imageTools):
+    # f is called with an int, a double, text and a boolean; n is also used
+    # as text.
+    params = ['n', 'x', 't', 'b']
+    argIds = ['a0', 'a1', 'a2', 'a3']
+    proccode = 'f %s %s %s %b'
+    cat = procDefn('f', proccode, False,
+                   ('motion_movesteps', {'STEPS': [3, 'p0', [4, '']]}, {}),
+                   ('looks_say', {'MESSAGE': [3, 'p1', [10, '']]}, {}),
+                   ('motion_turnright', {'DEGREES': [3, 'p2', [4, '']]}, {}),
+                   ('looks_say', {'MESSAGE': [3, 'p3', [10, '']]}, {}),
+                   ('control_if', {'CONDITION': [2, 'p4'], 'SUBSTACK': [2, 'show']}, {}))
+    cat['fproto'].update(inputs={argId: [1, argId + 'r'] for argId in argIds},
+                         mutation={'proccode': proccode, 'argumentids': json.dumps(argIds),
+                                   'argumentnames': json.dumps(params), 'warp': 'false'})
+    for argId, name in zip(argIds, params):
+        opcode = 'argument_reporter_boolean' if name == 'b' else 'argument_reporter_string_number'
+        cat[argId + 'r'] = block(opcode, 'fproto', {}, {'VALUE': [name, None]}, shadow=True)
+    for i, name in enumerate(['n', 'n', 'x', 't', 'b']):
+        opcode = 'argument_reporter_boolean' if name == 'b' else 'argument_reporter_string_number'
+        cat['p%d' % i] = block(opcode, 'f%d' % i, {}, {'VALUE': [name, None]})
+    cat['show'] = block('looks_show', 'f4')
+    cat.update(script('s', 'event_whenflagclicked',
+                      ('procedures_call', {'a0': [1, [10, '3']], 'a1': [1, [10, '2.5']], 'a2': [1, [10, 'abc']],
+                                           'a3': [2, 'mouse']}, {},
+                       {'mutation': {'proccode': proccode, 'argumentids': json.dumps(argIds)}})))
+    cat['mouse'] = block('sensing_mousedown', 's0')
+    convertTargets(tmp_path, [target('Stage'), target('Cat', cat)])
+    code = readJava(tmp_path, 'Cat')
+
+    assert 'f(s, 3, 2.5, "abc", (isMouseDown()));' in code
+    assert method(code, 'f') == textwrap.indent(textwrap.dedent('''
+        private void f(Sequence s, int n, double x, String t, boolean b)
+        {
+            move(n);
+            say(String.valueOf(n));
+            turnRightDegrees(x);
+            say(t);
+            if (b)
+            {
+                show();
+            }
+        }
+        '''), '    ', lambda line: line.strip())